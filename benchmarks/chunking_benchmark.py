@@ -0,0 +1,133 @@
+# Chunking strategies compared on the bundled PDFs: index size, ingestion time and retrieval hit rate
+# Usage: python -m benchmarks.chunking_benchmark [--strategies recursive,token,page,heading] [--queries 300] [--k 4] [--openai]
+# Queries are sentences of the PDFs with some words dropped; a chunk is a hit if it contains the
+# middle of the sentence. Retrieval is the hybrid BM25 + vector fusion of the chatbot. Without
+# --openai the vectors come from the hashed trigram stand-in of the hybrid retrieval benchmark, so
+# ingestion time then covers chunking, the chunk store and BM25 only.
+import argparse
+import glob
+import os
+import random
+import re
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.hybrid_retrieval_benchmark import hashed_embeddings, openai_embeddings
+from modules import pdf_extraction
+from modules.bm25_index import BM25Index, document_key, reciprocal_rank_fusion
+from modules.chunk_store import ChunkStore
+from modules.chunking import STRATEGIES, clean_text, get_chunker
+from modules.history_window import count_tokens
+from modules.ingestion_manifest import IngestionManifest
+
+# Dimension of text-embedding-3-large, for the vector index size
+EMBEDDING_DIM = 3072
+
+# Words of the middle of a sentence a chunk must contain to answer the query
+PASSAGE_WORDS = 6
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def load_pages(pattern: str) -> dict:
+    files = [(os.path.basename(path), path) for path in sorted(glob.glob(pattern))]
+    documents = pdf_extraction.extract_files(files)
+    return {file_name: [doc for doc in documents if doc.metadata['filename'] == file_name] for file_name, _ in files}
+
+
+def build_queries(pages_by_file: dict, count: int, seed: int = 0) -> list:
+    """
+    Returns (query, passage) pairs: a sentence of 12 to 40 words with a third of its words
+    dropped, and the normalized middle words of the sentence.
+    """
+    rng = random.Random(seed)
+    sentences = []
+    for pages in pages_by_file.values():
+        for page in pages:
+            for sentence in re.split(r"(?<=[.?!])\s+", clean_text(page.page_content).replace("\n", " ")):
+                words = normalize(sentence).split()
+                if 12 <= len(words) <= 40:
+                    sentences.append(words)
+    queries = []
+    for words in rng.sample(sentences, min(count, len(sentences))):
+        middle = len(words) // 2 - PASSAGE_WORDS // 2
+        query_words = [word for word in words if rng.random() > 0.33]
+        queries.append((" ".join(query_words), " ".join(words[middle:middle + PASSAGE_WORDS])))
+    return queries
+
+
+def evaluate(strategy: str, pages_by_file: dict, queries: list, k: int, embed) -> dict:
+    chunker = get_chunker(strategy)
+    with tempfile.TemporaryDirectory() as directory:
+        store = ChunkStore(os.path.join(directory, 'chunks.db'))
+        start = time.perf_counter()
+        chunks = []
+        for file_name, pages in pages_by_file.items():
+            file_chunks = chunker.split(pages)
+            IngestionManifest.assign_chunk_ids(file_name, file_chunks)
+            store.replace_source(file_name, file_chunks, chunker.signature())
+            chunks.extend(file_chunks)
+        chunk_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectors = embed([chunk.page_content for chunk in chunks])
+        embed_s = time.perf_counter() - start
+        index = BM25Index(path=None)
+        start = time.perf_counter()
+        index.add(chunks)
+        bm25_s = time.perf_counter() - start
+        store_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    query_vectors = embed([query for query, _ in queries])
+    texts = {document_key(chunk): normalize(chunk.page_content) for chunk in chunks}
+    hits, reciprocal_ranks, context_tokens = [], [], []
+    for (query, passage), query_vector in zip(queries, query_vectors):
+        vector_documents = [chunks[i] for i in np.argsort(-(vectors @ query_vector))[:max(k, 10)]]
+        lexical = index.get_documents([key for _, key in index.search(query, max(k, 10))])
+        results = reciprocal_rank_fusion([vector_documents, lexical], k)
+        rank = next((rank for rank, doc in enumerate(results, 1) if passage in texts[document_key(doc)]), None)
+        hits.append(rank is not None)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        context_tokens.append(sum(count_tokens(doc.page_content) for doc in results))
+
+    tokens = sum(count_tokens(chunk.page_content) for chunk in chunks)
+    return {
+        'chunks': len(chunks),
+        'tokens': tokens,
+        'vector_mb': len(chunks) * EMBEDDING_DIM * 4 / 1e6,
+        'store_mb': store_bytes / 1e6,
+        'ingest_s': chunk_s + embed_s + bm25_s,
+        'hit_rate': float(np.mean(hits)),
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'context_tokens': float(np.mean(context_tokens)),
+    }
+
+
+def main(pattern: str, strategies: list, query_count: int, k: int, use_openai: bool):
+    pages_by_file = load_pages(pattern)
+    queries = build_queries(pages_by_file, query_count)
+    embed = openai_embeddings if use_openai else hashed_embeddings
+    print(f"{sum(len(pages) for pages in pages_by_file.values())} pages in {len(pages_by_file)} files, "
+          f"{len(queries)} queries, k={k}, vectors: {'text-embedding-3-large' if use_openai else 'hashed trigrams'}")
+    print(f"{'strategy':<10} {'chunks':>7} {'tokens':>8} {'vectors MB':>11} {'store MB':>9} {'ingest s':>9} "
+          f"{'hit@' + str(k):>7} {'MRR':>6} {'ctx tokens':>11}")
+    for strategy in strategies:
+        result = evaluate(strategy, pages_by_file, queries, k, embed)
+        print(f"{strategy:<10} {result['chunks']:>7} {result['tokens']:>8} {result['vector_mb']:>11.1f} "
+              f"{result['store_mb']:>9.2f} {result['ingest_s']:>9.2f} {result['hit_rate']:>7.3f} "
+              f"{result['mrr']:>6.3f} {result['context_tokens']:>11.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare chunking strategies on the bundled PDFs")
+    parser.add_argument("--files", default="data/*.pdf")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES))
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--openai", action="store_true", help="Embed with OpenAI through the embedding cache")
+    args = parser.parse_args()
+    main(args.files, args.strategies.split(","), args.queries, args.k, args.openai)
@@ -0,0 +1,106 @@
+# Crawl benchmark against a local HTTP stand-in with artificial latency and ETag support
+# Usage: python -m benchmarks.crawler_benchmark [--pages 40] [--latency 0.2] [--hosts 4]
+# Compares one-at-a-time loading with the concurrent crawler, then re-crawls to exercise the 304 path.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import asyncio
+import tempfile
+import threading
+import time
+import os
+
+from modules.web_crawler import WebCrawler
+
+LATENCY_SECONDS = 0.2
+requests_served = {'200': 0, '304': 0, '503': 0}
+counter_lock = threading.Lock()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves /page/<n> with a fixed delay and a per-page ETag. Every 7th page fails with
+    503 on its first request so the retry path is exercised.
+    """
+    failed_once = set()
+
+    def do_GET(self):
+        time.sleep(LATENCY_SECONDS)
+        page = self.path.rsplit('/', 1)[-1]
+        etag = f'"page-{page}"'
+        with counter_lock:
+            if page.isdigit() and int(page) % 7 == 0 and page not in self.failed_once:
+                self.failed_once.add(page)
+                requests_served['503'] += 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            status = '304' if self.headers.get('If-None-Match') == etag else '200'
+            requests_served[status] += 1
+        if status == '304':
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = (f"<html lang='en'><head><title>Page {page}</title></head>"
+                f"<body><p>Admission details for page {page}.</p></body></html>").encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_servers(count: int) -> list:
+    """
+    Starts one stand-in server per simulated host and returns their base URLs.
+    """
+    urls = []
+    for _ in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls.append(f"http://127.0.0.1:{server.server_address[1]}")
+    return urls
+
+
+def timed_crawl(crawler: WebCrawler, urls: list):
+    start = time.perf_counter()
+    documents = asyncio.run(crawler.crawl(urls))
+    return documents, time.perf_counter() - start
+
+
+def main(pages: int, hosts: int):
+    bases = start_servers(hosts)
+    urls = [f"{bases[i % hosts]}/page/{i}" for i in range(1, pages + 1)]
+    cache_dir = tempfile.mkdtemp()
+
+    sequential = WebCrawler(concurrency=1, per_host_concurrency=1, host_delay=0, cache_path=None)
+    documents, sequential_s = timed_crawl(sequential, urls)
+    print(f"sequential      {len(documents)} pages in {sequential_s:.2f}s  {sequential.stats}")
+
+    StandInHandler.failed_once.clear()
+    cache_path = os.path.join(cache_dir, 'crawl_cache.json')
+    concurrent = WebCrawler(host_delay=0.02, cache_path=cache_path)
+    documents, concurrent_s = timed_crawl(concurrent, urls)
+    print(f"concurrent      {len(documents)} pages in {concurrent_s:.2f}s  {concurrent.stats}  "
+          f"speedup {sequential_s / concurrent_s:.1f}x")
+
+    recrawl = WebCrawler(host_delay=0.02, cache_path=cache_path)
+    cached_documents, recrawl_s = timed_crawl(recrawl, urls)
+    assert recrawl.stats['not_modified'] == pages, recrawl.stats
+    assert [doc.page_content for doc in cached_documents] == [doc.page_content for doc in documents]
+    print(f"conditional GET {len(cached_documents)} pages in {recrawl_s:.2f}s  {recrawl.stats}")
+    print(f"stand-in responses: {requests_served}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sequential vs concurrent crawl against a local HTTP stand-in")
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the stand-in waits before answering")
+    parser.add_argument("--hosts", type=int, default=4)
+    args = parser.parse_args()
+    LATENCY_SECONDS = args.latency
+    main(args.pages, args.hosts)
@@ -0,0 +1,101 @@
+# Benchmark of pooled vs per-query MySQL connections
+# Usage: python -m benchmarks.db_pool_benchmark --queries 200 --threads 8
+# Runs against the MySQL server in the DATABASE_* environment variables, or a
+# stand-in connection with a simulated handshake delay when --stand-in is passed.
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+
+import mysql.connector
+
+from modules.chat_database import host, db_user, db_pass, db
+from modules.db_pool import ConnectionPool
+
+
+class StandInConnection:
+    """
+    Minimal stand-in for a MySQL connection that pays a fixed handshake
+    delay on connect and a small delay per query. Like mysql-connector with
+    autocommit off, any statement opens a transaction until commit or rollback.
+    """
+
+    def __init__(self, handshake_delay: float, query_delay: float):
+        time.sleep(handshake_delay)
+        self.query_delay = query_delay
+        self.in_transaction = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, values=None):
+        time.sleep(self.query_delay)
+        self.in_transaction = True
+
+    def start_transaction(self):
+        self.in_transaction = True
+
+    def commit(self):
+        self.in_transaction = False
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        pass
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def ping(self, reconnect=True, attempts=1, delay=0):
+        pass
+
+
+def run_query(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1")
+    cursor.fetchone()
+    cursor.close()
+
+
+def run(label: str, query, count: int, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: query(), range(count)))
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {count} queries in {elapsed:.3f}s ({elapsed * 1000 / count:.2f} ms/query)")
+    return elapsed
+
+
+def main(count: int, threads: int, stand_in: bool):
+    if stand_in:
+        connect = lambda: StandInConnection(handshake_delay=0.02, query_delay=0.001)
+    else:
+        connect = lambda: mysql.connector.connect(host=host, user=db_user, password=db_pass, database=db)
+
+    def unpooled_query():
+        connection = connect()
+        try:
+            run_query(connection)
+        finally:
+            connection.close()
+
+    pool = ConnectionPool(connect, max_size=threads, max_overflow=0)
+
+    def pooled_query():
+        with pool.connection() as connection:
+            run_query(connection)
+
+    unpooled = run("Connection per query", unpooled_query, count, threads)
+    pooled = run("Connection pool", pooled_query, count, threads)
+    print(f"Speedup: {unpooled / pooled:.1f}x")
+    print(f"Pool metrics: {pool.metrics()}")
+    pool.close_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pooled vs per-query MySQL connection benchmark")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--stand-in", action="store_true", help="Use a simulated connection instead of MySQL")
+    args = parser.parse_args()
+    main(args.queries, args.threads, args.stand_in)
@@ -0,0 +1,138 @@
+# Recall and latency of BM25, vector and hybrid (reciprocal rank fusion) retrieval on the bundled PDFs
+# Usage: python -m benchmarks.hybrid_retrieval_benchmark [--queries 300] [--k 4] [--openai]
+# Queries are built from the exact tokens of a chunk (figures, codes, abbreviations) plus a few of
+# its words. Without --openai the vector side uses a hashed character trigram stand-in, so it runs
+# offline; --openai embeds through the embedding cache with text-embedding-3-large.
+import argparse
+import glob
+import hashlib
+import random
+import re
+import time
+
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from modules import pdf_extraction
+from modules.bm25_index import BM25Index, document_key, reciprocal_rank_fusion, tokenize
+from modules.ingestion_manifest import IngestionManifest
+
+HASHED_DIM = 1024
+
+
+def load_chunks(pattern: str) -> list:
+    files = [(path.split('/')[-1], path) for path in sorted(glob.glob(pattern))]
+    documents = pdf_extraction.extract_files(files)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=100)
+    chunks = []
+    for file_name, _ in files:
+        file_chunks = splitter.split_documents([doc for doc in documents if doc.metadata['filename'] == file_name])
+        IngestionManifest.assign_chunk_ids(file_name, file_chunks)
+        chunks.extend(file_chunks)
+    return chunks
+
+
+def exact_tokens(text: str) -> set:
+    """
+    Terms a dense embedding tends to blur: figures and upper-case codes such as CSIT or TCD.
+    """
+    found = set(re.findall(r"\b\d[\d,./-]*\d\b|\b[A-Z]{2,}[A-Z0-9-]*\b", text))
+    return {term for token in found for term in tokenize(token)}
+
+
+def build_queries(chunks: list, index: BM25Index, count: int, seed: int = 0) -> list:
+    """
+    Returns (query, relevant chunk IDs) pairs. A chunk is relevant if it holds every exact
+    token of the query, since the overlapping splitter repeats text in neighbouring chunks.
+    """
+    rng = random.Random(seed)
+    candidates = [chunk for chunk in chunks if exact_tokens(chunk.page_content)]
+    queries = []
+    for chunk in rng.sample(candidates, min(count, len(candidates))):
+        terms = sorted(exact_tokens(chunk.page_content), key=lambda term: len(index.postings.get(term, {})))[:2]
+        words = [word for word in tokenize(chunk.page_content) if word.isalpha() and len(word) > 3]
+        query_words = terms + rng.sample(words, min(3, len(words)))
+        rng.shuffle(query_words)
+        relevant = set.intersection(*[set(index.postings.get(term, {})) for term in terms])
+        queries.append(("what about " + " ".join(query_words), relevant))
+    return queries
+
+
+def hashed_embeddings(texts: list) -> np.ndarray:
+    vectors = np.zeros((len(texts), HASHED_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        padded = f"  {text.lower()}  "
+        for i in range(len(padded) - 2):
+            vectors[row, int(hashlib.md5(padded[i:i + 3].encode()).hexdigest()[:8], 16) % HASHED_DIM] += 1
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+
+def openai_embeddings(texts: list) -> np.ndarray:
+    from modules.embedding_cache import get_cached_embeddings
+    vectors = np.asarray(get_cached_embeddings('text-embedding-3-large').embed_documents(texts), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def percentile_ms(samples: list, q: float) -> float:
+    return float(np.percentile(samples, q) * 1000)
+
+
+def main(pattern: str, query_count: int, k: int, use_openai: bool):
+    chunks = load_chunks(pattern)
+    index = BM25Index(path=None)
+    start = time.perf_counter()
+    index.add(chunks)
+    build_s = time.perf_counter() - start
+    print(f"{len(chunks)} chunks, {len(index.postings)} terms, BM25 build {build_s * 1000:.1f} ms")
+
+    # Incremental update: re-adding a file's chunks replaces them in place
+    file_chunks = [chunk for chunk in chunks if chunk.metadata['filename'] == chunks[0].metadata['filename']]
+    start = time.perf_counter()
+    index.remove([document_key(chunk) for chunk in file_chunks])
+    index.add(file_chunks)
+    print(f"re-index of {len(file_chunks)} chunks of {chunks[0].metadata['filename']}: "
+          f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    queries = build_queries(chunks, index, query_count)
+    embed = openai_embeddings if use_openai else hashed_embeddings
+    chunk_vectors = embed([chunk.page_content for chunk in chunks])
+    query_vectors = embed([query for query, _ in queries])
+    candidates = max(k, 10)
+
+    results = {'bm25': [], 'vector': [], 'hybrid': []}
+    latencies = {'bm25': [], 'vector': [], 'hybrid': []}
+    for (query, relevant), query_vector in zip(queries, query_vectors):
+        start = time.perf_counter()
+        lexical = [key for _, key in index.search(query, candidates)]
+        latencies['bm25'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        top = np.argsort(-(chunk_vectors @ query_vector))[:candidates]
+        vector_documents = [chunks[i] for i in top]
+        latencies['vector'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        fused = reciprocal_rank_fusion([vector_documents, index.get_documents(lexical)], k)
+        latencies['hybrid'].append(time.perf_counter() - start + latencies['bm25'][-1] + latencies['vector'][-1])
+
+        results['bm25'].append((lexical[:k], relevant))
+        results['vector'].append(([document_key(doc) for doc in vector_documents[:k]], relevant))
+        results['hybrid'].append(([document_key(doc) for doc in fused], relevant))
+
+    print(f"{len(queries)} queries, k={k}, vector side: {'text-embedding-3-large' if use_openai else 'hashed trigrams'}")
+    for name in ('bm25', 'vector', 'hybrid'):
+        hit_rate = np.mean([bool(set(got) & relevant) for got, relevant in results[name]])
+        reciprocal_ranks = [next((1 / rank for rank, key in enumerate(got, 1) if key in relevant), 0.0)
+                            for got, relevant in results[name]]
+        print(f"{name:<8} hit@{k} {hit_rate:.3f}  MRR {np.mean(reciprocal_ranks):.3f}  "
+              f"p50 {percentile_ms(latencies[name], 50):.3f} ms  p99 {percentile_ms(latencies[name], 99):.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BM25 vs vector vs hybrid retrieval on the bundled PDFs")
+    parser.add_argument("--files", default="data/*.pdf")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--openai", action="store_true", help="Embed with OpenAI through the embedding cache")
+    args = parser.parse_args()
+    main(args.files, args.queries, args.k, args.openai)
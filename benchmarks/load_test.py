@@ -0,0 +1,64 @@
+# Load test for the /llm_on_cpu pipeline using a fake delayed LLM chain
+# Usage: python -m benchmarks.load_test --requests 20 --delay 1.0
+import argparse
+import asyncio
+import time
+
+from modules import chatbot_functions as chatbot
+from modules.session_store import ChatSession
+
+
+class FakeDelayedChain:
+    """
+    Stand-in for the RAG chain that waits a fixed delay before answering,
+    like a slow LLM call would.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def ainvoke(self, inputs: dict):
+        await asyncio.sleep(self.delay)
+        return {"input": inputs["input"], "context": [], "answer": f"Answer to: {inputs['input']}"}
+
+
+def fake_save_chat_history(user_chat_ids: dict, chat_history: list):
+    """
+    Blocking stand-in for the MySQL write, to check it stays off the event loop.
+    """
+    time.sleep(0.05)
+
+
+async def run_requests(count: int, chain: FakeDelayedChain) -> float:
+    """
+    Fires `count` concurrent chatbot requests, each in its own chat, and returns the elapsed seconds.
+    """
+    sessions = [ChatSession(0, f"load-test-{i}") for i in range(count)]
+    start = time.perf_counter()
+    await asyncio.gather(*(chatbot.user_input(f"question {i}", chain, sessions[i]) for i in range(count)))
+    elapsed = time.perf_counter() - start
+    # Let the background history writes finish before the next run
+    await asyncio.gather(*chatbot.background_tasks)
+    return elapsed
+
+
+async def main(count: int, delay: float):
+    chatbot.save_chat_history = fake_save_chat_history
+    chain = FakeDelayedChain(delay)
+
+    single = await run_requests(1, chain)
+    concurrent = await run_requests(count, chain)
+
+    print(f"1 request: {single:.3f}s")
+    print(f"{count} concurrent requests: {concurrent:.3f}s")
+    if count <= chatbot.MAX_CONCURRENT_CHATS and concurrent > single * 2:
+        raise SystemExit("Requests were serialized, the pipeline is blocking the event loop")
+    print("OK: concurrent requests finished in about the time of one")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test with a fake delayed LLM")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=1.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.delay))
@@ -0,0 +1,51 @@
+# PDF extraction benchmark: the previous inline loop against the process pool extractor
+# Usage: python -m benchmarks.pdf_extraction_benchmark [--file data/UGProspectus_2024.pdf] [--copies 3]
+# --copies submits the file several times to measure the multi-file case.
+import argparse
+import time
+
+import fitz
+
+from modules import pdf_extraction
+
+
+def inline_concatenation(path: str) -> str:
+    """
+    The extraction upload_files used to do: whole file in memory, text += page text.
+    """
+    with open(path, 'rb') as pdf_file:
+        pdf_content = pdf_file.read()
+    pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
+    text = ""
+    for page in pdf_document:
+        text += page.get_text()
+    return text
+
+
+def main(path: str, copies: int):
+    pages = pdf_extraction.page_count(path)
+    print(f"{path}: {pages} pages, {copies} copies, {pdf_extraction.PDF_WORKERS} workers, "
+          f"{pdf_extraction.PDF_PAGES_PER_TASK} pages per task")
+
+    start = time.perf_counter()
+    chars = sum(len(inline_concatenation(path)) for _ in range(copies))
+    inline_s = time.perf_counter() - start
+    print(f"inline concatenation  {inline_s:.2f}s  {chars} chars")
+
+    files = [(f"copy{i}.pdf", path) for i in range(copies)]
+    pool = pdf_extraction.get_pool()
+    pdf_extraction.extract_files(files[:1], pool=pool)  # Start the worker processes outside the timing
+    start = time.perf_counter()
+    documents = pdf_extraction.extract_files(files, pool=pool)
+    pool_s = time.perf_counter() - start
+    pool_chars = sum(len(doc.page_content) for doc in documents)
+    print(f"process pool          {pool_s:.2f}s  {pool_chars} chars in {len(documents)} page documents  "
+          f"speedup {inline_s / pool_s:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inline vs process pool PDF text extraction")
+    parser.add_argument("--file", default="data/UGProspectus_2024.pdf")
+    parser.add_argument("--copies", type=int, default=3)
+    args = parser.parse_args()
+    main(args.file, args.copies)
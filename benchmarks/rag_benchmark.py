@@ -0,0 +1,355 @@
+# Offline benchmark of the RAG pipeline: retrieval quality on a golden set, per-stage latency and throughput
+# Usage: python -m benchmarks.rag_benchmark [--k 4] [--concurrency 1,8,32] [--rounds 2] [--output rag_benchmark_results.json]
+# Runs chatbot_functions.user_input over the real chain (history-aware retriever, hybrid retrieval, context
+# compression, stuffing prompt) built on data/*.pdf, with a deterministic fake chat model and hashed
+# embeddings so it needs no network. --llm-latency-ms, --embed-latency-ms and --db-latency-ms add the
+# delays of the real services. The JSON report is written to --output, a summary is printed.
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import glob
+import io
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+from typing import Any
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.retrievers import BaseRetriever
+
+from benchmarks.hybrid_retrieval_benchmark import hashed_embeddings
+from modules import chatbot_functions as chatbot
+from modules import faiss_backend
+from modules import pdf_extraction
+from modules.bm25_index import RETRIEVAL_MODE, BM25Index, HybridRetriever
+from modules.chunking import CHUNKING_STRATEGY, get_chunker
+from modules.ingestion_manifest import IngestionManifest
+from modules.session_store import ChatSession
+
+GOLDEN_SET_PATH = os.path.join(os.path.dirname(__file__), 'golden_set.json')
+
+STAGES = ('contextualize', 'embed', 'retrieve', 'generate', 'persist')
+
+# Stages on the path of the answer, the rest of its latency is reported as 'other' (routing,
+# history window, context compression, prompt formatting and chain overhead)
+ANSWER_STAGES = ('contextualize', 'embed', 'retrieve', 'generate')
+
+# Stage timings of the request running in the current task, background persistence included
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+def record(stage: str, seconds: float):
+    timings = current_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic hashed character trigram embeddings, with an optional delay per query
+    standing in for the embeddings API.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def embed_documents(self, texts: list) -> list:
+        return hashed_embeddings(texts).tolist()
+
+    def embed_query(self, text: str) -> list:
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        vector = hashed_embeddings([text])[0].tolist()
+        record('embed', time.perf_counter() - start)
+        return vector
+
+    async def aembed_query(self, text: str) -> list:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        vector = hashed_embeddings([text])[0].tolist()
+        record('embed', time.perf_counter() - start)
+        return vector
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic chat model. Contextualization prompts are answered with the previous
+    question followed by the new one, QA prompts with the start of the stuffed context.
+    """
+
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-deterministic'
+
+    @staticmethod
+    def _respond(messages: list) -> tuple:
+        system = messages[0].content if messages else ""
+        question = messages[-1].content
+        if "standalone question" in system:
+            previous = [message.content for message in messages[1:-1] if message.type == 'human']
+            return 'contextualize', " ".join(previous[-1:] + [question])
+        context = system.split("in the end and call to action")[-1]
+        return 'generate', "From the NED University documents: " + " ".join(context.split()[-60:])
+
+    def _generate(self, messages: list, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        stage, text = self._respond(messages)
+        record(stage, time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages: list, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        stage, text = self._respond(messages)
+        record(stage, time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class TimedRetriever(BaseRetriever):
+    """
+    Wraps the chain retriever and records its time, minus the query embedding, as 'retrieve'.
+    """
+
+    retriever: BaseRetriever
+
+    @staticmethod
+    def _embed_seconds() -> float:
+        timings = current_timings.get()
+        return timings.get('embed', 0.0) if timings is not None else 0.0
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> list:
+        embed_before, start = self._embed_seconds(), time.perf_counter()
+        documents = self.retriever.invoke(query)
+        record('retrieve', time.perf_counter() - start - (self._embed_seconds() - embed_before))
+        return documents
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> list:
+        embed_before, start = self._embed_seconds(), time.perf_counter()
+        documents = await self.retriever.ainvoke(query)
+        record('retrieve', time.perf_counter() - start - (self._embed_seconds() - embed_before))
+        return documents
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def build_chain(pattern: str, k: int, llm, embeddings, directory: str) -> tuple:
+    """
+    Chunks the PDFs with the configured strategy, indexes them in a local FAISS store and
+    a BM25 index, and builds the chatbot chain on them.
+
+    Returns:
+        tuple: (rag_chain, number of chunks)
+    """
+    files = [(os.path.basename(path), path) for path in sorted(glob.glob(pattern))]
+    pages = pdf_extraction.extract_files(files)
+    chunker = get_chunker()
+    chunks = []
+    for file_name, _ in files:
+        file_chunks = chunker.split([page for page in pages if page.metadata['filename'] == file_name])
+        IngestionManifest.assign_chunk_ids(file_name, file_chunks)
+        chunks.extend(file_chunks)
+
+    faiss_backend.rebuild(chunks, embeddings, directory)
+    vectorstore = faiss_backend.load_store(embeddings, directory)
+    if RETRIEVAL_MODE == 'hybrid':
+        index = BM25Index(path=None)
+        index.add(chunks)
+        retriever = HybridRetriever(vector_retriever=vectorstore.as_retriever(search_kwargs={'k': max(k, 10)}),
+                                    index=index, k=k)
+    else:
+        retriever = vectorstore.as_retriever(search_kwargs={'k': k})
+    history_retriever = chatbot.history_aware_retriever(TimedRetriever(retriever=retriever), llm)
+    return chatbot.get_conversational_chain(history_retriever, llm), len(chunks)
+
+
+def install_fake_persistence(db_latency: float):
+    """
+    Replaces the MySQL write with a delay, like benchmarks.load_test, and times persistence.
+    """
+    def fake_save_chat_history(user_chat_ids: dict, chat_history: list):
+        time.sleep(db_latency)
+
+    persist = chatbot.persist_chat_history
+
+    async def timed_persist(session: ChatSession, chat_history: list):
+        start = time.perf_counter()
+        await persist(session, chat_history)
+        record('persist', time.perf_counter() - start)
+
+    chatbot.save_chat_history = fake_save_chat_history
+    chatbot.persist_chat_history = timed_persist
+
+
+async def ask(item: dict, rag_chain, session_id: str) -> tuple:
+    """
+    Answers a golden set question in a new chat holding its history, and returns
+    (response, stage timings in seconds, latency of the answer in seconds).
+    """
+    timings = {}
+    current_timings.set(timings)
+    session = ChatSession(0, session_id, list(item.get('history', [])))
+    start = time.perf_counter()
+    response = await chatbot.user_input(item['question'], rag_chain, session)
+    return response, timings, time.perf_counter() - start
+
+
+def score(item: dict, context: list) -> tuple:
+    """
+    Returns (share of the expected passages found in the context, rank of the first
+    context document holding one, None if none does).
+    """
+    texts = [normalize(doc.page_content) for doc in context]
+    expected = [normalize(passage['text']) for passage in item['expected']]
+    found = sum(1 for passage in expected if any(passage in text for text in texts))
+    rank = next((rank for rank, text in enumerate(texts, 1) if any(passage in text for passage in expected)), None)
+    return found / len(expected), rank
+
+
+async def evaluate_quality(golden: list, rag_chain) -> tuple:
+    """
+    Asks the golden set one question at a time.
+
+    Returns:
+        tuple: (per-question results, list of stage timing dicts)
+    """
+    results, all_timings = [], []
+    for item in golden:
+        response, timings, latency = await asyncio.create_task(ask(item, rag_chain, f"quality-{item['id']}"))
+        await asyncio.gather(*chatbot.background_tasks)
+        recall, rank = score(item, response.get('context', []))
+        results.append({'id': item['id'], 'recall': recall, 'rank': rank,
+                        'latency_ms': round(latency * 1000, 3)})
+        other = latency - sum(timings.get(stage, 0.0) for stage in ANSWER_STAGES)
+        all_timings.append({**timings, 'other': other, 'total': latency})
+    return results, all_timings
+
+
+async def measure_throughput(golden: list, rag_chain, concurrency: int, rounds: int) -> dict:
+    """
+    Sends every golden set question `rounds` times from `concurrency` concurrent clients.
+    """
+    queue = asyncio.Queue()
+    for round_number in range(rounds):
+        for item in golden:
+            queue.put_nowait((round_number, item))
+    latencies = []
+
+    async def client():
+        while not queue.empty():
+            round_number, item = queue.get_nowait()
+            _, _, latency = await asyncio.create_task(ask(item, rag_chain, f"load-{concurrency}-{round_number}-{item['id']}"))
+            latencies.append(latency)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*chatbot.background_tasks)
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'requests_per_s': round(len(latencies) / elapsed, 2),
+        'latency_ms': {f'p{q}': round(float(np.percentile(latencies, q)) * 1000, 3) for q in (50, 95, 99)}
+    }
+
+
+def summarize_stages(all_timings: list) -> dict:
+    summary = {}
+    for stage in STAGES + ('other', 'total'):
+        samples = [timings.get(stage, 0.0) * 1000 for timings in all_timings]
+        summary[stage] = {'mean': round(float(np.mean(samples)), 3),
+                          'p50': round(float(np.percentile(samples, 50)), 3),
+                          'p95': round(float(np.percentile(samples, 95)), 3)}
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args) -> dict:
+    with open(args.golden) as golden_file:
+        golden = json.load(golden_file)
+    llm = FakeChatModel(latency=args.llm_latency_ms / 1000)
+    embeddings = FakeEmbeddings(latency=args.embed_latency_ms / 1000)
+    install_fake_persistence(args.db_latency_ms / 1000)
+
+    # The pipeline logs every request, keep the output to the report
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        rag_chain, chunk_count = build_chain(args.files, args.k, llm, embeddings, directory)
+        build_s = time.perf_counter() - start
+        questions, all_timings = await evaluate_quality(golden, rag_chain)
+        throughput = [await measure_throughput(golden, rag_chain, concurrency, args.rounds)
+                      for concurrency in args.concurrency]
+
+    reciprocal_ranks = [1 / result['rank'] if result['rank'] else 0.0 for result in questions]
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'config': {
+            'k': args.k,
+            'chunking_strategy': CHUNKING_STRATEGY,
+            'retrieval_mode': RETRIEVAL_MODE,
+            'llm_latency_ms': args.llm_latency_ms,
+            'embed_latency_ms': args.embed_latency_ms,
+            'db_latency_ms': args.db_latency_ms,
+            'rounds': args.rounds
+        },
+        'corpus': {'files': args.files, 'chunks': chunk_count, 'build_s': round(build_s, 3)},
+        'quality': {
+            'questions': len(questions),
+            f'recall_at_{args.k}': round(float(np.mean([result['recall'] for result in questions])), 4),
+            'mrr': round(float(np.mean(reciprocal_ranks)), 4),
+            'per_question': questions
+        },
+        'stages_ms': summarize_stages(all_timings),
+        'throughput': throughput
+    }
+
+
+def print_summary(report: dict, k: int):
+    quality = report['quality']
+    print(f"{quality['questions']} questions, {report['corpus']['chunks']} chunks "
+          f"({report['config']['chunking_strategy']}, {report['config']['retrieval_mode']}): "
+          f"recall@{k} {quality[f'recall_at_{k}']:.3f}  MRR {quality['mrr']:.3f}")
+    for stage, values in report['stages_ms'].items():
+        print(f"  {stage:<14} mean {values['mean']:>8.3f} ms  p50 {values['p50']:>8.3f} ms  p95 {values['p95']:>8.3f} ms")
+    for result in report['throughput']:
+        print(f"  concurrency {result['concurrency']:>3}: {result['requests_per_s']:>8.2f} req/s  "
+              f"p50 {result['latency_ms']['p50']:.1f} ms  p99 {result['latency_ms']['p99']:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline retrieval quality, stage latency and throughput benchmark")
+    parser.add_argument("--files", default="data/*.pdf")
+    parser.add_argument("--golden", default=GOLDEN_SET_PATH)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--concurrency", type=lambda value: [int(level) for level in value.split(",")], default=[1, 8, 32])
+    parser.add_argument("--rounds", type=int, default=2, help="Times the golden set is sent in each throughput run")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--db-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output", default="rag_benchmark_results.json", help="File the JSON report is written to")
+    args = parser.parse_args()
+    report = asyncio.run(main(args))
+    print_summary(report, args.k)
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Report written to {args.output}")
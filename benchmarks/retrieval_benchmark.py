@@ -0,0 +1,74 @@
+# Retrieval latency and recall benchmark of the local FAISS index types against exact search
+# Usage: python -m benchmarks.retrieval_benchmark [--synthetic 20000] [--queries 500] [--k 4]
+# Without --synthetic the chunks of the local store are embedded (through the embedding cache).
+import argparse
+import time
+
+import numpy as np
+
+from modules import faiss_backend
+
+
+def percentile_ms(samples: list, q: float) -> float:
+    return float(np.percentile(samples, q) * 1000)
+
+
+def synthetic_vectors(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    """
+    Clustered random vectors, closer to real embeddings than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, count // 100), dim))
+    vectors = centers[rng.integers(len(centers), size=count)] + rng.normal(scale=0.3, size=(count, dim))
+    return faiss_backend.normalize(vectors)
+
+
+def local_store_vectors() -> np.ndarray:
+    from modules.embedding_cache import get_cached_embeddings
+    documents = faiss_backend.load_documents()
+    embeddings = get_cached_embeddings('text-embedding-3-large')
+    return faiss_backend.normalize(embeddings.embed_documents([doc.page_content for doc in documents]))
+
+
+def run(index, queries: np.ndarray, k: int):
+    """
+    Searches the queries one at a time, like chatbot requests, and returns (latencies, result ids).
+    """
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids[0])
+    return latencies, results
+
+
+def main(synthetic: int, dim: int, query_count: int, k: int):
+    vectors = synthetic_vectors(synthetic, dim) if synthetic else local_store_vectors()
+    rng = np.random.default_rng(1)
+    picks = rng.integers(len(vectors), size=query_count)
+    queries = faiss_backend.normalize(vectors[picks] + rng.normal(scale=0.05, size=(query_count, vectors.shape[1])))
+    print(f"{len(vectors)} vectors of dim {vectors.shape[1]}, {query_count} queries, k={k}")
+
+    exact_latencies, exact_results = run(faiss_backend.build_index(vectors, 'flat'), queries, k)
+    print(f"{'flat (exact)':<14} p50 {percentile_ms(exact_latencies, 50):.3f} ms  p99 {percentile_ms(exact_latencies, 99):.3f} ms  recall@{k} 1.000")
+
+    for index_type in ('hnsw', 'ivfpq'):
+        start = time.perf_counter()
+        index = faiss_backend.build_index(vectors, index_type)
+        build_s = time.perf_counter() - start
+        latencies, results = run(index, queries, k)
+        recall = np.mean([len(set(got) & set(expected)) / k for got, expected in zip(results, exact_results)])
+        print(f"{index_type:<14} p50 {percentile_ms(latencies, 50):.3f} ms  p99 {percentile_ms(latencies, 99):.3f} ms  "
+              f"recall@{k} {recall:.3f}  build {build_s:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FAISS index latency/recall benchmark against exact search")
+    parser.add_argument("--synthetic", type=int, default=0, help="Number of synthetic vectors instead of the local store")
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+    main(args.synthetic, args.dim, args.queries, args.k)
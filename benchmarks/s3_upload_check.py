@@ -0,0 +1,187 @@
+# Checks the streaming S3 transfer service against a moto stand-in of S3 (pip install moto)
+# Usage: python -m benchmarks.s3_upload_check [--size-mb 40] [--files 8] [--latency 0.1]
+# Uploads the bundled prospectus and a generated large file, verifies the object and the
+# spool copy byte for byte, measures the peak memory of an upload against a client that
+# discards the parts (moto keeps every object in memory, which would hide the bound), and
+# compares serial and concurrent uploads of several files with added per-request latency,
+# then checks paged listing and batched bulk deletion beyond the 1000-key limit.
+import argparse
+import asyncio
+import hashlib
+import time
+import os
+import tempfile
+import tracemalloc
+
+import boto3
+from moto import mock_aws
+
+from modules import s3_transfer
+
+BUCKET = 'ned-chatbot-test'
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check(client, path: str, spool_dir: str):
+    key = os.path.basename(path)
+    spool_path = os.path.join(spool_dir, key)
+    with open(path, 'rb') as upload:
+        size = s3_transfer.TransferService(client).tee_upload(upload, BUCKET, key, spool_path)['size']
+
+    body = client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+    expected = sha256_file(path)
+    assert size == os.path.getsize(path), (size, os.path.getsize(path))
+    assert hashlib.sha256(body).hexdigest() == expected, f"{key}: S3 object differs"
+    assert sha256_file(spool_path) == expected, f"{key}: spool copy differs"
+    print(f"{key:<28} {size / 2**20:8.1f} MB  S3 and spool copies match")
+
+
+class DiscardingClient:
+    """
+    S3 client stand-in that accepts parts without keeping them.
+    """
+
+    def put_object(self, **kwargs):
+        return {}
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'discard'}
+
+    def upload_part(self, PartNumber, **kwargs):
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+
+def peak_memory(path: str, spool_dir: str):
+    with open(path, 'rb') as upload:
+        tracemalloc.start()
+        s3_transfer.TransferService(DiscardingClient()).tee_upload(upload, BUCKET, 'peak', os.path.join(spool_dir, 'peak'))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    part_size = s3_transfer.UPLOAD_PART_SIZE
+    in_flight = s3_transfer.S3_PART_CONCURRENCY
+    assert peak < (in_flight + 1) * part_size, f"peak {peak} bytes for {in_flight} x {part_size} byte parts"
+    print(f"peak memory of a {os.path.getsize(path) / 2**20:.0f} MB upload {peak / 2**20:.1f} MB "
+          f"({in_flight} parts of {part_size / 2**20:.0f} MB in flight)")
+
+
+class SlowClient:
+    """
+    Adds a fixed delay to every S3 request, like the round trip to a real bucket.
+    """
+
+    def __init__(self, client, latency: float):
+        self.client = client
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def delayed(**kwargs):
+            time.sleep(self.latency)
+            return method(**kwargs)
+        return delayed
+
+
+def timed_uploads(service, paths: list, spool_dir: str):
+    uploads = [(open(path, 'rb'), f"concurrent/{i}-{os.path.basename(path)}", os.path.join(spool_dir, f"c{i}"))
+               for i, path in enumerate(paths)]
+    start = time.perf_counter()
+    results = asyncio.run(service.upload_many(BUCKET, uploads))
+    elapsed = time.perf_counter() - start
+    for fileobj, _, _ in uploads:
+        fileobj.close()
+    return results, elapsed
+
+
+def concurrency(client, paths: list, spool_dir: str, latency: float):
+    slow_client = SlowClient(client, latency)
+    _, serial_s = timed_uploads(s3_transfer.TransferService(slow_client, workers=1, part_concurrency=1), paths, spool_dir)
+    results, concurrent_s = timed_uploads(s3_transfer.TransferService(slow_client), paths, spool_dir)
+    for result in results:
+        print(f"  {result['key']:<36} {result['size'] / 2**20:6.1f} MB  {result['parts']} parts  {result['seconds']:.2f}s")
+    print(f"{len(paths)} files with {latency * 1000:.0f} ms per request: serial {serial_s:.2f}s, "
+          f"concurrent {concurrent_s:.2f}s ({s3_transfer.S3_TRANSFER_WORKERS} files x "
+          f"{s3_transfer.S3_PART_CONCURRENCY} parts), speedup {serial_s / concurrent_s:.1f}x")
+
+
+def previous_behaviour(client, path: str):
+    """
+    The old handler read the file and then uploaded the same, already consumed, stream.
+    """
+    key = 'double-read-' + os.path.basename(path)
+    with open(path, 'rb') as upload:
+        upload.read()
+        client.upload_fileobj(upload, BUCKET, key)
+    stored = client.head_object(Bucket=BUCKET, Key=key)['ContentLength']
+    print(f"previous double read stored {stored} of {os.path.getsize(path)} bytes")
+
+
+def listing_and_bulk_delete(client, key_count: int):
+    service = s3_transfer.TransferService(client)
+    for i in range(key_count):
+        client.put_object(Bucket=BUCKET, Key=f"bulk/{i:05d}.pdf", Body=b'%PDF')
+    expected = {item['Key'] for page in client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET)
+                for item in page.get('Contents', [])}
+
+    listed, cursor, pages = [], None, 0
+    while True:
+        files, cursor = service.list_page(BUCKET, 1000, cursor)
+        listed.extend(item['File'] for item in files)
+        pages += 1
+        if cursor is None:
+            break
+    assert set(listed) == expected and len(listed) == len(expected), "paged listing missed keys"
+
+    start = time.perf_counter()
+    deleted, errors = asyncio.run(service.delete_keys(BUCKET, service.iter_key_pages(BUCKET)))
+    elapsed = time.perf_counter() - start
+    assert not errors and set(deleted) == expected, (len(deleted), errors[:3])
+    assert 'Contents' not in client.list_objects_v2(Bucket=BUCKET)
+    print(f"listed {len(listed)} keys in {pages} pages, deleted them in {elapsed:.2f}s "
+          f"with {-(-len(deleted) // 1000)} batch requests")
+
+
+def main(size_mb: int, file_count: int, latency: float):
+    with mock_aws(), tempfile.TemporaryDirectory() as work_dir:
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        spool_dir = os.path.join(work_dir, 'spool')
+        os.makedirs(spool_dir)
+
+        large_path = os.path.join(work_dir, 'large_upload.pdf')
+        with open(large_path, 'wb') as large_file:
+            for _ in range(size_mb):
+                large_file.write(os.urandom(1024 * 1024))
+
+        previous_behaviour(client, 'data/UGProspectus_2024.pdf')
+        check(client, 'data/UGProspectus_2024.pdf', spool_dir)
+        check(client, large_path, spool_dir)
+        uploads = client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+        assert not uploads, f"{len(uploads)} multipart uploads left open"
+        peak_memory(large_path, spool_dir)
+        concurrency(client, ['data/UGProspectus_2024.pdf'] * (file_count - 1) + [large_path], spool_dir, latency)
+        listing_and_bulk_delete(client, 2500)
+
+
+if __name__ == "__main__":
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    parser = argparse.ArgumentParser(description="Streaming S3 upload check against moto")
+    parser.add_argument("--size-mb", type=int, default=40, help="Size of the generated large file")
+    parser.add_argument("--files", type=int, default=8, help="Files uploaded in the concurrency comparison")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds added to every S3 request")
+    args = parser.parse_args()
+    main(args.size_mb, args.files, args.latency)
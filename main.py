@@ -1,26 +1,58 @@
 from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
+import os
 
 from modules import models
 from modules import chatbot_functions as chatbot
 from modules import auth
+from modules import chain_registry
+from modules import db_pool
+from modules import embedding_cache
+from modules import ingestion_jobs
 from routers import vectordb_s3_endpoints
 
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Checks the chat tables, builds the warm RAG chain objects once when the server starts,
+    and runs the ingestion job workers while the server is up.
+    """
+    chatbot.chat_obj.verify_schema()  # Refuses to start without the unique key the chat upserts need
+    chain_registry.registry.build()
+    if os.getenv('CHAIN_STARTUP_BENCHMARK'):
+        chain_registry.benchmark_startup()
+    ingestion_jobs.jobs.start()
+    yield
+    ingestion_jobs.jobs.stop()
+
+
 # FastAPI object
 app = FastAPI(
     title="FYP RAG Chatbot FastAPI",
-    summary="This is the backend of our final year project of university, which a chatbot for university admissions using LLM and RAG. The bot is powered by Langchain and FastAPI. The UI and frontend is developed in Next.js."
+    summary="This is the backend of our final year project of university, which a chatbot for university admissions using LLM and RAG. The bot is powered by Langchain and FastAPI. The UI and frontend is developed in Next.js.",
+    lifespan=lifespan
 )
 
+@app.exception_handler(db_pool.PoolTimeoutError)
+async def pool_timeout_handler(request, exc: db_pool.PoolTimeoutError):
+    """
+    Answers 503 when every database connection stays busy, so clients retry instead of
+    seeing the 401 or empty result of a failed query.
+    """
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"success": False, "message": str(exc)},
+        headers={"Retry-After": "1"}
+    )
+
 # Include vectordb and AWS S3 Buckets router
 app.include_router(vectordb_s3_endpoints.router)
 
-# Bearer token authentication scheme
-auth_scheme = HTTPBearer()
-
 # Configuring FastAPI CORS (Cross-Origin Resource Sharing)
 app.add_middleware(
     CORSMiddleware,
@@ -31,8 +63,6 @@ app.add_middleware(
 )
 
 
-is_chat_created = False
-
 # Authorization Endpoints
 
 @app.post("/register")
@@ -68,6 +98,8 @@ def register(user: models.User):
     except HTTPException as http_exc:
         # Handle specific HTTP exceptions
         raise http_exc
+    except db_pool.PoolTimeoutError:
+        raise  # Answered with 503 by pool_timeout_handler
     except (auth.DatabaseError, auth.ValidationError) as db_exc:
         # Handle known errors from the auth module
         raise HTTPException(
@@ -87,7 +119,6 @@ def login_for_access_token(login_data: models.LoginInfo):
     """
     Endpoint for user login. Returns an access token if credentials are valid.
     """
-    is_chat_created = False
     user = auth.authenticate_user(login_data.email, login_data.password)
     print(user)
     if not user:  # Check if the user credentials are valid
@@ -109,11 +140,10 @@ def login_for_access_token(login_data: models.LoginInfo):
 
 
 @app.get("/users/me", response_model=models.User)
-def read_users_me(authorization: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+def read_users_me(current_user: dict = Depends(auth.current_user)):
     """
     Endpoint to get the current logged-in user's information.
     """
-    current_user = auth.get_current_user(authorization.credentials)  # Get the current user from the token
     return current_user
 
 
@@ -121,57 +151,59 @@ def read_users_me(authorization: HTTPAuthorizationCredentials = Depends(auth_sch
 # API endpoint (POST Request)
 
 @app.post("/llm_on_cpu")
-async def final_result(item: models.validation, authorization: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+async def final_result(item: models.validation, user: dict = Depends(auth.current_user)):
     """
     Endpoint to process user input through a chatbot and return the response.
     """
-    global is_chat_created
-    access_token = authorization.credentials
-    if authorization is None:  # Check if the authorization header is missing or invalid
-        raise HTTPException(status_code=401, detail="Authorization header missing or invalid")
-
-    user = auth.get_current_user(access_token)  # Get the current user from the token
     if not user:  # Check if the user is found
         raise HTTPException(status_code=404, detail="User Not found")
     
-    if not is_chat_created:
-        chatbot.user_chat_details = {
-        'user_id': user['id'],
-        'chat_id': item.chat_id
-        }
+    session = await asyncio.to_thread(chatbot.get_chat_session, user['id'], item.chat_id)  # Conversation state of this chat
 
-        chatbot.chat_history = []
-        is_chat_created = True
+    rag_chain = chain_registry.registry.get_chain()  # Warm chain built at startup
+    response = await chatbot.user_input(item.prompt, rag_chain, session, chain_registry.registry.embeddings, chain_registry.registry.summary_llm)  # Process the user input through the chatbot
+    return response
 
 
+@app.post("/llm_on_cpu/stream")
+async def stream_result(item: models.validation, user: dict = Depends(auth.current_user)):
+    """
+    Endpoint to process user input through the chatbot and stream the response
+    as Server-Sent Events (context metadata first, then answer tokens).
+    """
+    if not user:  # Check if the user is found
+        raise HTTPException(status_code=404, detail="User Not found")
 
-    response = await chatbot.user_input(item.prompt)  # Process the user input through the chatbot
-    return response
+    session = await asyncio.to_thread(chatbot.get_chat_session, user['id'], item.chat_id)
 
+    rag_chain = chain_registry.registry.get_chain()
+    return StreamingResponse(
+        chatbot.stream_user_input(item.prompt, rag_chain, session, chain_registry.registry.embeddings, chain_registry.registry.summary_llm),
+        media_type="text/event-stream"
+    )
 
 
 @app.post("/load_create_chat")
-async def load_chat(item: models.ChatInfo, authorization: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+async def load_chat(item: models.ChatInfo, user: dict = Depends(auth.current_user)):
     """
     Endpoint to load or create a chat and fetch chat history if it exists.
     """
-    global is_chat_created
-    token = authorization.credentials
-    if authorization is None:  # Check if the authorization header is missing or invalid
-        raise HTTPException(status_code=401, detail="Authorization header missing or invalid")
-
-    user = auth.get_current_user(token)  # Get the current user from the token
-    chatbot.user_chat_details = {
+    user_chat_details = {
         'user_id': user['id'],
         'chat_id': item.chat_id
     }
     
     try:
-        is_chat_created = True
-        chat_exist = chatbot.chat_obj.does_chat_exist(chatbot.user_chat_details)  # Check if the chat exists
-        if chat_exist:
-            chatbot.fetch_chat_history()  # Fetch the chat history
-            chat_conversation = chatbot.convert_to_array_of_dicts(chatbot.chat_history)  # Convert chat history to array of dicts
+        # Fetch the chat history, or create the chat, in one database round trip
+        chat_history, start, created = await asyncio.to_thread(
+            chatbot.chat_obj.fetch_or_create_chat, user_chat_details, item.limit, item.before
+        )
+        if item.limit is None and item.before is None:
+            # Cache the conversation state, a live session of the chat is kept as it is
+            await asyncio.to_thread(chatbot.sessions.get_or_create, user['id'], item.chat_id, chat_history)
+        
+        if not created:
+            chat_conversation = chatbot.convert_to_array_of_dicts(chat_history)  # Convert chat history to array of dicts
 
             return {
                 'success': True,
@@ -179,11 +211,10 @@ async def load_chat(item: models.ChatInfo, authorization: HTTPAuthorizationCrede
                 "user_id": user['id'],
                 "chat_id": item.chat_id,
                 'username': user['username'],
-                "chat_history": chat_conversation
+                "chat_history": chat_conversation,
+                "next_cursor": start if start > 0 else None
             }
         else:
-            chatbot.chat_history = [] # Initialize an empty chat history
-            print(chatbot.chat_history) 
             return {
                 "message": "Chat created successfully",
                 "user_id": user['id'],
@@ -191,6 +222,8 @@ async def load_chat(item: models.ChatInfo, authorization: HTTPAuthorizationCrede
                 'username': user['username'],
                 'success': True
             }
+    except db_pool.PoolTimeoutError:
+        raise  # Answered with 503 by pool_timeout_handler
     except Exception as e:  # Handle any exceptions that occur
         return {
             "success": False,
@@ -199,5 +232,54 @@ async def load_chat(item: models.ChatInfo, authorization: HTTPAuthorizationCrede
         }
 
 
-# Admin Panel Endpoints
+# Admin Panel Endpoints (admins only, see auth.ADMIN_USERNAMES)
+
+@app.get("/chain_status")
+def chain_status(user: dict = Depends(auth.admin_user)):
+    """
+    Endpoint to get the configuration of the warm RAG chain, the last startup benchmark,
+    streaming latency, the answer cache hit rate, how often each retrieval path is taken, prompt sizes and context compression.
+    """
+    return {
+        "success": True,
+        "config": chain_registry.registry.config,
+        "benchmark": chain_registry.registry.benchmark,
+        "stream_metrics": chatbot.stream_metrics,
+        "answer_cache": chatbot.answer_cache.get_stats(),
+        "routing_stats": chatbot.routing_stats,
+        "prompt_stats": chatbot.prompt_stats,
+        "compression_stats": chatbot.compression_stats,
+        "embedding_cache": embedding_cache.embedding_cache_stats()
+    }
+
+
+@app.post("/reload_chain")
+def reload_chain(config: models.ChainConfig, user: dict = Depends(auth.admin_user)):
+    """
+    Endpoint to hot-swap the LLM, embeddings model, Pinecone index or retriever backend used by the chatbot.
+    """
+    reloaded = chain_registry.registry.reload(
+        llm_model=config.llm_model,
+        embedding_model=config.embedding_model,
+        index_name=config.index_name,
+        retriever_backend=config.retriever_backend,
+        summary_model=config.summary_model
+    )
+    return {
+        "success": True,
+        "reloaded": reloaded,
+        "config": chain_registry.registry.config
+    }
+
 
+@app.get("/db_pool_status")
+def db_pool_status(user: dict = Depends(auth.admin_user)):
+    """
+    Endpoint to get MySQL connection pool metrics (in-use count, wait times, connections created)
+    and the token cache hit/miss counters.
+    """
+    return {
+        "success": True,
+        "pools": db_pool.pool_metrics(),
+        "token_cache": auth.get_token_cache_stats()
+    }
@@ -0,0 +1,156 @@
+# Semantic cache of chatbot answers for repeated standalone questions
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import os
+
+# Answer cache settings from environment variables
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv('ANSWER_CACHE_TTL_SECONDS', '86400'))
+ANSWER_CACHE_MAX_SIZE = int(os.getenv('ANSWER_CACHE_MAX_SIZE', '2000'))
+
+# Touched whenever the knowledge base changes, so every worker drops its cached answers
+KNOWLEDGE_BASE_VERSION_PATH = os.getenv('KNOWLEDGE_BASE_VERSION_PATH', 'vectorstore/kb_version')
+
+
+def knowledge_base_version() -> float:
+    """
+    Returns the modification time of the knowledge base version file, 0 if it does not exist.
+    """
+    try:
+        return os.stat(KNOWLEDGE_BASE_VERSION_PATH).st_mtime
+    except OSError:
+        return 0.0
+
+
+def bump_knowledge_base_version():
+    """
+    Marks the knowledge base as changed. Called by vector_database after adding or deleting embeddings.
+    """
+    os.makedirs(os.path.dirname(KNOWLEDGE_BASE_VERSION_PATH), exist_ok=True)
+    with open(KNOWLEDGE_BASE_VERSION_PATH, 'w') as version_file:
+        version_file.write(str(time.time()))
+    answer_cache.invalidate()
+
+
+class SemanticAnswerCache:
+    """
+    LRU cache of answers keyed by question embeddings. A lookup hits when the
+    cosine similarity with a cached question is above the threshold.
+
+    Attributes:
+        threshold (float): Minimum cosine similarity for a hit.
+        ttl (int): Seconds an answer stays valid.
+        max_size (int): Maximum number of cached answers.
+        stats (dict): Hit, miss and saved LLM call counters.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, ttl: int = ANSWER_CACHE_TTL_SECONDS,
+                 max_size: int = ANSWER_CACHE_MAX_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'llm_calls_saved': 0, 'invalidations': 0}
+        self._entries = OrderedDict()  # question -> (unit embedding, response, stored_at)
+        self._matrix = None
+        self._keys = []
+        self._version = knowledge_base_version()
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        """
+        Clears the cache if another worker changed the knowledge base.
+        """
+        version = knowledge_base_version()
+        if version != self._version:
+            self._version = version
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self._matrix = None
+        self._keys = []
+        self.stats['invalidations'] += 1
+
+    def lookup(self, embedding: list, llm_calls: int = 1):
+        """
+        Returns the cached response of the most similar question above the threshold that
+        has not expired, or None on a miss. Expired entries met on the way are dropped.
+
+        Args:
+            embedding (list): Embedding of the standalone question.
+            llm_calls (int): LLM calls a hit avoids, for the saved calls counter.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.stack([self._entries[key][0] for key in self._keys])
+                similarities = self._matrix @ query
+                candidates = np.flatnonzero(similarities >= self.threshold)
+                response = None
+                for index in candidates[np.argsort(-similarities[candidates])]:
+                    key = self._keys[index]
+                    entry = self._entries[key]
+                    if now - entry[2] > self.ttl:
+                        del self._entries[key]
+                        self._matrix = None
+                        continue
+                    self._entries.move_to_end(key)
+                    response = entry[1]
+                    break
+                if response is not None:
+                    self.stats['hits'] += 1
+                    self.stats['llm_calls_saved'] += llm_calls
+                    return response
+            self.stats['misses'] += 1
+            return None
+
+    def store(self, question: str, embedding: list, response: dict):
+        """
+        Caches the response of a question asked on the first turn of a chat, so the answer
+        does not depend on any chat history.
+
+        Args:
+            question (str): The standalone question.
+            embedding (list): Embedding of the question.
+            response (dict): Chain output with 'answer' and 'context'.
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self._check_version()
+            self._entries[question] = (vector, {'answer': response['answer'], 'context': response.get('context', [])}, time.time())
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def invalidate(self):
+        """
+        Drops every cached answer.
+        """
+        with self._lock:
+            self._version = knowledge_base_version()
+            self._clear()
+
+    def get_stats(self) -> dict:
+        """
+        Returns the counters, hit rate and current size of the cache.
+        """
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'size': len(self._entries),
+                'hit_rate': self.stats['hits'] / lookups if lookups else 0.0
+            }
+
+
+# Answer cache shared by the chatbot
+answer_cache = SemanticAnswerCache()
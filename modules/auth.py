@@ -1,10 +1,13 @@
 import os
 from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
+from fastapi.security import OAuth2PasswordBearer, HTTPAuthorizationCredentials, HTTPBearer
 from datetime import datetime, timedelta
+from collections import OrderedDict
+import threading
+import time
 import jwt
-import mysql.connector
 from mysql.connector import Error
+from modules.db_pool import get_pool
 
 # Fetching database credentials from environment variables
 DB_HOST = os.getenv('DATABASE_HOST')
@@ -12,6 +15,9 @@ DB_PASSWORD = os.getenv('DATABASE_PW')
 DB_USER = os.getenv('DATABASE_USER')
 DB_NAME = os.getenv('DATABASE')
 
+# Connection pool shared with ChatDatabase
+db_pool = get_pool(DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)
+
 # Secret key to encode and decode JWT tokens
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
@@ -19,6 +25,19 @@ ALGORITHM = "HS256"
 # OAuth2 password flow for obtaining the token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Bearer token authentication scheme
+bearer_scheme = HTTPBearer()
+
+# Cache of validated tokens to user records
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv('TOKEN_CACHE_TTL_SECONDS', '300'))
+TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', '10000'))
+_token_cache = OrderedDict()  # token -> (user, expires_at)
+_token_cache_lock = threading.Lock()
+token_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+# Usernames allowed on the admin endpoints, comma separated (users with a true is_admin column are admins too)
+ADMIN_USERNAMES = {name.strip() for name in os.getenv('ADMIN_USERNAMES', '').split(',') if name.strip()}
+
 
 def create_access_token(data: dict, expires_delta: timedelta = timedelta(minutes=2880)):
     """
@@ -50,17 +69,11 @@ def get_user_from_db(username: str):
         dict: User record if found, else None.
     """
     try:
-        connection = mysql.connector.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))  # Query to fetch user by username
-        user = cursor.fetchone()
-        cursor.close()
-        connection.close()
+        with db_pool.connection() as connection:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute("SELECT * FROM users WHERE username = %s", (username,))  # Query to fetch user by username
+            user = cursor.fetchone()
+            cursor.close()
         return user
     except Error as e:
         print(f"Error connecting to MySQL: {e}")
@@ -80,17 +93,11 @@ def get_user_from_db_email(email: str):
         dict: User record if found, else None.
     """
     try:
-        connection = mysql.connector.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE email = %s", (email,))  # Query to fetch user by email
-        user = cursor.fetchone()
-        cursor.close()
-        connection.close()
+        with db_pool.connection() as connection:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute("SELECT * FROM users WHERE email = %s", (email,))  # Query to fetch user by email
+            user = cursor.fetchone()
+            cursor.close()
         return user
     except Error as e:
         print(f"Error connecting to MySQL: {e}")
@@ -109,18 +116,13 @@ def create_user_in_db(username: str, email: str, password: str):
         password (str): Password for the new user.
     """
     try:
-        connection = mysql.connector.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
-        cursor = connection.cursor()
-        cursor.execute("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)", (username, email, password))  # Insert new user
-        connection.commit()
-        print(f'User Registered: {username}, {email}')
-        cursor.close()
-        connection.close()
+        with db_pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)", (username, email, password))  # Insert new user
+            connection.commit()
+            print(f'User Registered: {username}, {email}')
+            cursor.close()
+        invalidate_user(username)
     except Error as e:
         print(f"Error connecting to MySQL: {e}")
         return e
@@ -144,9 +146,47 @@ def authenticate_user(email: str, password: str):
 
 
 
+def invalidate_user(username: str):
+    """
+    Removes cached tokens of a user. Must be called whenever a user record is updated or deleted.
+
+    Args:
+        username (str): Username whose cached tokens are removed.
+    """
+    with _token_cache_lock:
+        tokens = [token for token, (user, _) in _token_cache.items() if user['username'] == username]
+        for token in tokens:
+            del _token_cache[token]
+        token_cache_stats['invalidations'] += len(tokens)
+
+
+def clear_token_cache():
+    """
+    Removes all cached tokens.
+    """
+    with _token_cache_lock:
+        token_cache_stats['invalidations'] += len(_token_cache)
+        _token_cache.clear()
+
+
+def get_token_cache_stats() -> dict:
+    """
+    Returns token cache hit/miss counters and its current size.
+    """
+    with _token_cache_lock:
+        lookups = token_cache_stats['hits'] + token_cache_stats['misses']
+        return {
+            **token_cache_stats,
+            'size': len(_token_cache),
+            'hit_rate': token_cache_stats['hits'] / lookups if lookups else 0.0
+        }
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
     """
-    Gets the current user based on the JWT token.
+    Gets the current user based on the JWT token. Validated tokens are cached
+    for TOKEN_CACHE_TTL_SECONDS (never past the token expiry), so repeated
+    requests with the same token skip the users table query.
 
     Args:
         token (str): JWT token.
@@ -157,6 +197,17 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: If the token is invalid or user is not found.
     """
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+        if cached and cached[1] > now:
+            _token_cache.move_to_end(token)
+            token_cache_stats['hits'] += 1
+            return dict(cached[0])
+        if cached:
+            del _token_cache[token]
+        token_cache_stats['misses'] += 1
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -172,4 +223,54 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
     user = get_user_from_db(username)  # Fetch the user from the database
     if user is None:  # Check if user exists
         raise credentials_exception
+
+    expires_at = min(now + TOKEN_CACHE_TTL_SECONDS, payload.get("exp", now + TOKEN_CACHE_TTL_SECONDS))
+    with _token_cache_lock:
+        _token_cache[token] = (dict(user), expires_at)
+        while len(_token_cache) > TOKEN_CACHE_MAX_SIZE:
+            _token_cache.popitem(last=False)
+    return user
+
+
+def current_user(authorization: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
+    """
+    FastAPI dependency that resolves the bearer token of the request to the user record.
+    FastAPI runs it once per request and in a worker thread, so handlers receive the user directly.
+
+    Returns:
+        dict: User record.
+    """
+    return get_current_user(authorization.credentials)
+
+
+def is_admin(user: dict) -> bool:
+    """
+    Checks whether a user may call the admin endpoints: the is_admin flag of the user record,
+    or a username listed in ADMIN_USERNAMES.
+
+    Args:
+        user (dict): User record.
+
+    Returns:
+        bool: True if the user is an admin.
+    """
+    return bool(user.get('is_admin')) or user['username'] in ADMIN_USERNAMES
+
+
+def admin_user(user: dict = Depends(current_user)):
+    """
+    FastAPI dependency for the admin endpoints: resolves the user like current_user and
+    rejects users who are not admins. Registration is open, so being logged in is not enough.
+
+    Returns:
+        dict: User record.
+
+    Raises:
+        HTTPException: 403 if the user is not an admin.
+    """
+    if not is_admin(user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail={"success": False, "message": "Admin access required"},
+        )
     return user
@@ -0,0 +1,255 @@
+# Local BM25 inverted index over the ingested chunks, and the hybrid BM25 + vector retriever
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.documents import Document
+from collections import Counter
+from typing import Any
+import threading
+import asyncio
+import hashlib
+import pickle
+import heapq
+import math
+import re
+import os
+
+# Path of the persisted index, next to the local vector store
+BM25_INDEX_PATH = os.getenv('BM25_INDEX_PATH', 'vectorstore/bm25_index.pkl')
+
+# 'hybrid' fuses BM25 and vector results, 'vector' uses the vector store only
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'hybrid')
+
+# BM25 parameters, and the rank constant of reciprocal rank fusion
+BM25_K1 = float(os.getenv('BM25_K1', '1.2'))
+BM25_B = float(os.getenv('BM25_B', '0.75'))
+RRF_K = int(os.getenv('RRF_K', '60'))
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'does', 'for', 'from', 'how',
+    'i', 'in', 'is', 'it', 'me', 'my', 'of', 'on', 'or', 'the', 'to', 'what', 'when', 'where',
+    'which', 'who', 'will', 'with', 'you', 'your'
+}
+
+
+def tokenize(text: str) -> list:
+    """
+    Lowercases and splits text into terms. Thousands separators are removed so fee figures
+    such as 12,500 match 12500, and codes such as CS-101 give the terms cs and 101.
+    """
+    text = re.sub(r"(?<=\d),(?=\d{3})", "", text.lower())
+    return [term for term in re.findall(r"[a-z0-9]+", text) if term not in STOP_WORDS]
+
+
+def document_key(document) -> str:
+    """
+    Returns the ID used to fuse results: the chunk ID assigned at ingestion, or a hash of
+    the text for vectors ingested before chunk IDs existed.
+    """
+    return document.metadata.get('chunk_id') or text_key(document)
+
+
+def text_key(document) -> str:
+    """
+    Returns a hash of the chunk text. Results are fused on it, so vectors ingested before
+    chunk IDs existed still meet the BM25 entry of the same chunk, which has a chunk ID.
+    """
+    return hashlib.sha256(document.page_content.encode('utf-8')).hexdigest()[:40]
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index, updated incrementally when chunks are added or removed
+    and persisted with pickle (not persisted if path is None). Reloaded when the file is
+    changed by another process.
+
+    Attributes:
+        postings (dict): term -> {chunk ID: term frequency}
+        lengths (dict): chunk ID -> number of terms
+        documents (dict): chunk ID -> (text, metadata)
+    """
+
+    def __init__(self, path: str = BM25_INDEX_PATH):
+        self.path = path
+        self.postings = {}
+        self.lengths = {}
+        self.documents = {}
+        self.total_length = 0
+        self._mtime = None
+        self._lock = threading.Lock()
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        # Called with the lock held
+        if not self.path:
+            return
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        mtime = (stat.st_mtime_ns, stat.st_size)
+        if mtime == self._mtime:
+            return
+        with open(self.path, 'rb') as index_file:
+            self.postings, self.lengths, self.documents = pickle.load(index_file)
+        self.total_length = sum(self.lengths.values())
+        self._mtime = mtime
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as index_file:
+                pickle.dump((self.postings, self.lengths, self.documents), index_file)
+            os.replace(temp_path, self.path)
+            stat = os.stat(self.path)
+            self._mtime = (stat.st_mtime_ns, stat.st_size)
+
+    def add(self, documents: list):
+        """
+        Indexes chunks, replacing chunks with the same ID.
+        """
+        with self._lock:
+            self._reload()
+            for document in documents:
+                key = document_key(document)
+                if key in self.documents:
+                    self._remove(key)
+                terms = Counter(tokenize(document.page_content))
+                for term, frequency in terms.items():
+                    self.postings.setdefault(term, {})[key] = frequency
+                self.lengths[key] = sum(terms.values())
+                self.total_length += self.lengths[key]
+                self.documents[key] = (document.page_content, dict(document.metadata))
+
+    def _remove(self, key: str):
+        text, _ = self.documents.pop(key)
+        for term in set(tokenize(text)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.lengths.pop(key)
+
+    def remove(self, chunk_ids: list):
+        with self._lock:
+            self._reload()
+            for key in chunk_ids:
+                if key in self.documents:
+                    self._remove(key)
+
+    def remove_where(self, field: str, values: list):
+        """
+        Removes the chunks whose metadata field is one of values (e.g. uploaded file names).
+        """
+        names = set(values)
+        with self._lock:
+            self._reload()
+            for key in [key for key, (_, metadata) in self.documents.items() if metadata.get(field) in names]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.postings, self.lengths, self.documents = {}, {}, {}
+            self.total_length = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    def search(self, query: str, k: int = 4) -> list:
+        """
+        Returns the k best BM25 matches as (score, chunk ID), best first.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            self._reload()
+            count = len(self.lengths)
+            if not count:
+                return []
+            average_length = self.total_length / count
+            scores = {}
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, frequency in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[key] / average_length)
+                    scores[key] = scores.get(key, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return heapq.nlargest(k, ((score, key) for key, score in scores.items()))
+
+    def get_documents(self, keys: list) -> list:
+        with self._lock:
+            stored = [self.documents[key] for key in keys if key in self.documents]
+        return [Document(page_content=text, metadata=dict(metadata)) for text, metadata in stored]
+
+
+def reciprocal_rank_fusion(result_lists: list, k: int, rrf_k: int = RRF_K) -> list:
+    """
+    Fuses ranked document lists: each document scores the sum of 1 / (rrf_k + rank) over
+    the lists it appears in. Documents are matched by text, see text_key.
+
+    Returns:
+        list: The k best documents.
+    """
+    scores = {}
+    documents = {}
+    for results in result_lists:
+        for rank, document in enumerate(results, 1):
+            key = text_key(document)
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank)
+            documents.setdefault(key, document)
+    best = heapq.nlargest(k, scores, key=scores.get)
+    return [documents[key] for key in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieves with the vector store and the local BM25 index and fuses both rankings with
+    reciprocal rank fusion, so exact tokens (programme codes, department abbreviations,
+    fee figures, dates) are found even when the embedding misses them.
+    """
+
+    vector_retriever: BaseRetriever
+    index: Any
+    k: int = 4
+    candidates: int = 10
+
+    def _lexical(self, query: str) -> list:
+        return self.index.get_documents([key for _, key in self.index.search(query, self.candidates)])
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> list:
+        vector_documents = self.vector_retriever.invoke(query)
+        return reciprocal_rank_fusion([vector_documents, self._lexical(query)], self.k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> list:
+        # BM25 scoring and the index reload check are blocking, run them in a worker thread
+        vector_documents, lexical_documents = await asyncio.gather(
+            self.vector_retriever.ainvoke(query),
+            asyncio.to_thread(self._lexical, query)
+        )
+        return reciprocal_rank_fusion([vector_documents, lexical_documents], self.k)
+
+
+# Index shared by ingestion and retrieval in this process
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> BM25Index:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = BM25Index()
+        return _index
+
+
+def hybrid_retriever(vectorstore, k: int = 4):
+    """
+    Returns the retriever of the chain: hybrid when RETRIEVAL_MODE is 'hybrid', the plain
+    vector store retriever otherwise.
+    """
+    vector_retriever = vectorstore.as_retriever(search_kwargs={'k': max(k, 10)})
+    if RETRIEVAL_MODE != 'hybrid':
+        return vectorstore.as_retriever(search_kwargs={'k': k})
+    return HybridRetriever(vector_retriever=vector_retriever, index=get_index(), k=k)
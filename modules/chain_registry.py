@@ -0,0 +1,178 @@
+# Process-wide registry of warm RAG chain objects
+from langchain_pinecone import PineconeVectorStore
+from modules import chatbot_functions as chatbot
+from modules.embedding_cache import get_cached_embeddings
+from modules.vector_database import RETRIEVER_BACKEND
+from modules import faiss_backend
+from modules.bm25_index import hybrid_retriever
+import threading
+import time
+import os
+
+# Default chain configuration, overridable from environment variables
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o')
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-large')
+INDEX_NAME = os.getenv('PINECONE_INDEX_NAME', 'langchain-ned-data')
+
+
+class ChainRegistry:
+    """
+    Holds the embeddings, vector store, LLM and RAG chain objects so they are
+    created once per process and reused by every request.
+
+    Attributes:
+        config (dict): Configuration the current objects were built with.
+        embeddings: The embeddings client, backed by the persistent embedding cache.
+        vectorstore: The Pinecone or local FAISS vector store.
+        llm: The language model.
+        summary_llm: The cheaper model writing the rolling chat summaries.
+        rag_chain: The conversational retrieval chain.
+        benchmark (dict): Result of the last startup benchmark, if any.
+    """
+
+    def __init__(self):
+        self.config = {}
+        self.embeddings = None
+        self.vectorstore = None
+        self.llm = None
+        self.summary_llm = None
+        self.rag_chain = None
+        self.benchmark = {}
+        self._faiss_version = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def build(self, llm_model: str = LLM_MODEL, embedding_model: str = EMBEDDING_MODEL, index_name: str = INDEX_NAME,
+              retriever_backend: str = RETRIEVER_BACKEND, summary_model: str = SUMMARY_MODEL):
+        """
+        Builds a fresh set of chain objects and swaps them in atomically, so
+        in-flight requests keep using the objects they already picked up.
+
+        Args:
+            llm_model (str): Name of the OpenAI chat model.
+            embedding_model (str): Name of the OpenAI embeddings model.
+            index_name (str): Name of the Pinecone index.
+            retriever_backend (str): 'pinecone' or 'faiss'.
+            summary_model (str): Name of the OpenAI chat model summarizing older turns.
+        """
+        # Builds run one at a time, a reload and a background refresh cannot interleave
+        with self._build_lock:
+            embeddings = get_cached_embeddings(embedding_model)
+            if retriever_backend == 'faiss':
+                faiss_version = faiss_backend.index_version()
+                vectorstore = faiss_backend.load_store(embeddings)
+            else:
+                faiss_version = None
+                vectorstore = PineconeVectorStore(index_name=index_name, embedding=embeddings)
+            llm = chatbot.load_llm(llm_model)
+            summary_llm = chatbot.load_llm(summary_model)
+            history_retriever = chatbot.history_aware_retriever(hybrid_retriever(vectorstore), llm)
+            rag_chain = chatbot.get_conversational_chain(history_retriever, llm)
+
+            with self._lock:
+                self.embeddings = embeddings
+                self.vectorstore = vectorstore
+                self.llm = llm
+                self.summary_llm = summary_llm
+                self.rag_chain = rag_chain
+                self._faiss_version = faiss_version
+                self.config = {
+                    'llm_model': llm_model,
+                    'embedding_model': embedding_model,
+                    'index_name': index_name,
+                    'retriever_backend': retriever_backend,
+                    'summary_model': summary_model
+                }
+            print(f"Chain registry built with {self.config}")
+
+    def reload(self, **config) -> bool:
+        """
+        Hot-swaps the chain objects if the given configuration differs from the current one.
+
+        Args:
+            **config: Any of llm_model, embedding_model, index_name, retriever_backend and summary_model.
+
+        Returns:
+            bool: True if the objects were rebuilt, False if nothing changed.
+        """
+        new_config = {**self.config, **{key: value for key, value in config.items() if value}}
+        if self.rag_chain is not None and new_config == self.config:
+            return False
+        self.build(**new_config)
+        # Answers cached with the previous model or index are no longer valid
+        chatbot.answer_cache.invalidate()
+        return True
+
+    def get_chain(self):
+        """
+        Returns the warm RAG chain, building it on first use. After ingestion changed the
+        local FAISS index, the index is reloaded in a background thread and the current
+        chain keeps serving requests until the new one is swapped in.
+        """
+        if self.rag_chain is None:
+            self.build()
+        elif self._faiss_version is not None and faiss_backend.index_version() != self._faiss_version:
+            self.refresh_in_background()
+        return self.rag_chain
+
+    def refresh_in_background(self):
+        """
+        Starts rebuilding the chain objects in a background thread, unless a refresh is already running.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            # A reload may have rebuilt the chain since the refresh was requested
+            if self._faiss_version is not None and faiss_backend.index_version() != self._faiss_version:
+                self.build(**self.config)
+        except Exception as e:
+            print(f"Reloading the chain after an index change failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+# Shared registry used by the API
+registry = ChainRegistry()
+
+
+def benchmark_startup(iterations: int = 5) -> dict:
+    """
+    Compares the per-request cost of building the chain from scratch (old behaviour)
+    against fetching the warm chain from the registry.
+
+    Args:
+        iterations (int): Number of times each path is measured.
+
+    Returns:
+        dict: Average milliseconds per request for the cold and warm paths.
+    """
+    cold_start = time.perf_counter()
+    for _ in range(iterations):
+        ChainRegistry().build(**registry.config)
+    cold_ms = (time.perf_counter() - cold_start) * 1000 / iterations
+
+    warm_start = time.perf_counter()
+    for _ in range(iterations):
+        registry.get_chain()
+    warm_ms = (time.perf_counter() - warm_start) * 1000 / iterations
+
+    registry.benchmark = {
+        'iterations': iterations,
+        'per_request_build_ms': round(cold_ms, 3),
+        'registry_lookup_ms': round(warm_ms, 3)
+    }
+    print(f"Chain startup benchmark: {registry.benchmark}")
+    return registry.benchmark
+
+
+if __name__ == "__main__":
+    registry.build()
+    benchmark_startup()
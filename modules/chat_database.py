@@ -1,5 +1,5 @@
-import mysql.connector
 from mysql.connector import Error
+from modules.db_pool import get_pool
 import json
 import os
 
@@ -9,6 +9,10 @@ db_pass = os.getenv('DATABASE_PW')
 db_user = os.getenv('DATABASE_USER')
 db = os.getenv('DATABASE')
 
+# 'blob' stores the whole history as JSON in chats.chat_history,
+# 'messages' appends each message as a row of chat_messages
+CHAT_STORAGE_MODE = os.getenv('CHAT_STORAGE_MODE', 'blob')
+
 class ChatDatabase:
     """
     A class used to interact with the chat database.
@@ -18,9 +22,17 @@ class ChatDatabase:
         user (str): Database user.
         password (str): Database password.
         database (str): Database name.
+        pool (ConnectionPool): Shared connection pool for these credentials.
+        storage_mode (str): 'blob' or 'messages'.
+    """
+
+    # Insert used to append rows to chat_messages
+    append_query = """
+    INSERT IGNORE INTO chat_messages (user_id, chat_id, position, role, content)
+    VALUES (%s, %s, %s, %s, %s)
     """
 
-    def __init__(self, host: str, user: str, password: str, database: str):
+    def __init__(self, host: str, user: str, password: str, database: str, storage_mode: str = CHAT_STORAGE_MODE):
         """
         Initializes the ChatDatabase with connection parameters.
 
@@ -29,31 +41,14 @@ class ChatDatabase:
             user (str): Database user.
             password (str): Database password.
             database (str): Database name.
+            storage_mode (str): 'blob' or 'messages'.
         """
         self.host = host
         self.user = user
         self.password = password
         self.database = database
-
-    def create_connection(self):
-        """
-        Creates and returns a database connection.
-
-        Returns:
-            mysql.connector.connection_cext.CMySQLConnection: Database connection object if successful, None otherwise.
-        """
-        try:
-            connection = mysql.connector.connect(
-                host=self.host,
-                user=self.user,
-                password=self.password,
-                database=self.database
-            )
-            if connection.is_connected():
-                return connection
-        except Error as e:
-            print(f"Error: {e}")
-            return None
+        self.pool = get_pool(host, user, password, database)
+        self.storage_mode = storage_mode
 
     def create_new_chat(self, user_id: int, chat_id: int, chat_history: list):
         """
@@ -72,18 +67,13 @@ class ChatDatabase:
         chat_history_json = json.dumps(chat_dict)
         values = (user_id, chat_id, chat_history_json)
         
-        connection = self.create_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute(insert_query, values)
-                    connection.commit()
-                    print("Chat created successfully")
-            except Error as e:
-                print(f"Error: {e}")
-            finally:
-                connection.close()
-                print("Connection closed")
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(insert_query, values)
+                connection.commit()
+                print("Chat created successfully")
+        except Error as e:
+            print(f"Error: {e}")
 
     def update_existing_chat(self, user_id: int, chat_id: int, chat_history: list):
         """
@@ -103,18 +93,13 @@ class ChatDatabase:
         chat_history_json = json.dumps(chat_dict)
         values = (chat_history_json, user_id, chat_id)
         
-        connection = self.create_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute(update_query, values)
-                    connection.commit()
-                    print("Chat updated successfully")
-            except Error as e:
-                print(f"Error: {e}")
-            finally:
-                connection.close()
-                print("Connection closed")
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(update_query, values)
+                connection.commit()
+                print("Chat updated successfully")
+        except Error as e:
+            print(f"Error: {e}")
 
     def delete_chat(self, user_id: int, chat_id: int):
         """
@@ -130,18 +115,13 @@ class ChatDatabase:
         """
         values = (user_id, chat_id)
         
-        connection = self.create_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute(delete_query, values)
-                    connection.commit()
-                    print("Chat deleted successfully")
-            except Error as e:
-                print(f"Error: {e}")
-            finally:
-                connection.close()
-                print("Connection closed")
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(delete_query, values)
+                connection.commit()
+                print("Chat deleted successfully")
+        except Error as e:
+            print(f"Error: {e}")
 
     def does_chat_exist(self, user_chat_ids: dict) -> bool:
         """
@@ -160,19 +140,14 @@ class ChatDatabase:
         """
         values = (user_chat_ids['user_id'], user_chat_ids['chat_id'])
         
-        connection = self.create_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute(fetch_query, values)
-                    result = cursor.fetchone()
-                    return result is not None
-            except Error as e:
-                print(f"Error: {e}")
-                return False
-            finally:
-                connection.close()
-                print("Connection closed")
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(fetch_query, values)
+                result = cursor.fetchone()
+                return result is not None
+        except Error as e:
+            print(f"Error: {e}")
+            return False
 
     def fetch_chat_data(self, user_chat_ids: dict) -> list:
         """
@@ -191,25 +166,338 @@ class ChatDatabase:
         """
         values = (user_chat_ids['user_id'], user_chat_ids['chat_id'])
         
-        connection = self.create_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
+        if self.storage_mode == 'messages':
+            messages, _ = self._fetch_messages(user_chat_ids)
+            if messages:
+                return messages
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(fetch_query, values)
+                chat = cursor.fetchone()
+                if chat:
+                    chat_json = chat[0]
+                    chat_dict = json.loads(chat_json)
+                    if self.storage_mode == 'messages' and chat_dict['chat_history']:
+                        # Chat saved before the switch to messages mode, migrate it on first read
+                        self.append_messages(user_chat_ids['user_id'], user_chat_ids['chat_id'], chat_dict['chat_history'], 0)
+                    return chat_dict['chat_history']
+                else:
+                    return []
+        except Error as e:
+            print(f"Error: {e}")
+            return []
+
+    def upsert_chat(self, user_id: int, chat_id: str, chat_history: list):
+        """
+        Creates the chat or replaces its history in a single atomic statement.
+        Relies on the unique key on chats (user_id, chat_id), see add_chats_unique_key.
+        A history shorter than the stored one is an older snapshot and is not written,
+        so out-of-order saves from several workers cannot lose turns.
+
+        Args:
+            user_id (int): ID of the user.
+            chat_id (str): ID of the chat.
+            chat_history (list): History of the chat messages.
+        """
+        upsert_query = """
+        INSERT INTO chats (user_id, chat_id, chat_history)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE chat_history = IF(
+            JSON_LENGTH(chat_history, '$.chat_history') > JSON_LENGTH(VALUES(chat_history), '$.chat_history'),
+            chat_history, VALUES(chat_history))
+        """
+        chat_dict = {'chat_history': chat_history}
+        values = (user_id, chat_id, json.dumps(chat_dict))
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(upsert_query, values)
+                connection.commit()
+                print("Chat saved successfully")
+        except Error as e:
+            print(f"Error: {e}")
+
+    def save_turn(self, user_id: int, chat_id: str, chat_history: list):
+        """
+        Saves the latest human/chatbot pair of a chat in one round trip, creating
+        the chat if needed. In 'blob' mode the whole history is upserted, in
+        'messages' mode only the new pair is appended.
+
+        Args:
+            user_id (int): ID of the user.
+            chat_id (str): ID of the chat.
+            chat_history (list): Full history of the chat, ending with the new pair.
+        """
+        if self.storage_mode != 'messages':
+            self.upsert_chat(user_id, chat_id, chat_history)
+            return
+        
+        create_query = """
+        INSERT IGNORE INTO chats (user_id, chat_id, chat_history)
+        VALUES (%s, %s, %s)
+        """
+        start_position = len(chat_history) - 2
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                if start_position == 0:
+                    cursor.execute(create_query, (user_id, chat_id, json.dumps({'chat_history': []})))
+                cursor.executemany(self.append_query, self._message_rows(user_id, chat_id, chat_history[-2:], start_position))
+                connection.commit()
+                print("Chat turn saved successfully")
+        except Error as e:
+            print(f"Error: {e}")
+
+    def fetch_or_create_chat(self, user_chat_ids: dict, limit: int = None, before: int = None) -> tuple:
+        """
+        Fetches the chat history, creating an empty chat if it does not exist, on a
+        single connection and without a separate existence check.
+
+        Args:
+            user_chat_ids (dict): Dictionary containing 'user_id' and 'chat_id'.
+            limit (int, optional): Number of most recent turns to fetch. Defaults to all.
+            before (int, optional): Position to fetch before, used as a cursor for older pages.
+
+        Returns:
+            tuple: (chat_history, start_position, created) where created is True for a new chat.
+        """
+        create_query = """
+        INSERT IGNORE INTO chats (user_id, chat_id, chat_history)
+        VALUES (%s, %s, %s)
+        """
+        fetch_query = """
+        SELECT chat_history
+        FROM chats
+        WHERE user_id = %s AND chat_id = %s
+        """
+        values = (user_chat_ids['user_id'], user_chat_ids['chat_id'])
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(create_query, values + (json.dumps({'chat_history': []}),))
+                connection.commit()
+                if cursor.rowcount == 1:
+                    return [], 0, True
+                if self.storage_mode != 'messages':
                     cursor.execute(fetch_query, values)
                     chat = cursor.fetchone()
-                    if chat:
-                        chat_json = chat[0]
-                        chat_dict = json.loads(chat_json)
-                        return chat_dict['chat_history']
-                    else:
-                        return []
-            except Error as e:
-                print(f"Error: {e}")
-                return []
-            finally:
-                connection.close()
-                print("Connection closed")
+                    chat_history = json.loads(chat[0])['chat_history'] if chat else []
+                    return (*self._page(chat_history, limit, before), False)
+        except Error as e:
+            print(f"Error: {e}")
+            return [], 0, False
+        
+        return (*self.fetch_chat_page(user_chat_ids, limit, before), False)
+
+    def has_chats_unique_key(self) -> bool:
+        """
+        Checks that chats has a unique key on exactly (user_id, chat_id).
+        """
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SHOW INDEX FROM chats WHERE Non_unique = 0")
+            columns = [dict(zip(cursor.column_names, row)) for row in cursor.fetchall()]
+        keys = {}
+        for column in columns:
+            keys.setdefault(column['Key_name'], set()).add(column['Column_name'])
+        return {'user_id', 'chat_id'} in keys.values()
+
+    def has_messages_table(self) -> bool:
+        """
+        Checks that the chat_messages table of the 'messages' storage mode exists.
+        """
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SHOW TABLES LIKE 'chat_messages'")
+            return cursor.fetchone() is not None
+
+    def verify_schema(self):
+        """
+        Checks the schema the upsert queries rely on when the server starts: the unique key
+        on chats (user_id, chat_id) and, in 'messages' mode, the chat_messages table. Without
+        the key INSERT IGNORE and ON DUPLICATE KEY UPDATE insert a new row for every turn, so
+        the server must not start without it. The schema is only read, migrations run once
+        from the command line rather than in every worker.
+
+        Raises:
+            RuntimeError: If the unique key or the chat_messages table is missing.
+        """
+        if not self.has_chats_unique_key():
+            raise RuntimeError(
+                "The chats table needs a unique key on (user_id, chat_id). Remove any duplicate "
+                "chats and run: python -m modules.chat_database add-unique-key"
+            )
+        if self.storage_mode == 'messages' and not self.has_messages_table():
+            raise RuntimeError(
+                "CHAT_STORAGE_MODE is 'messages' but the chat_messages table is missing. "
+                "Run: python -m modules.chat_database migrate"
+            )
+
+    def add_chats_unique_key(self):
+        """
+        Adds the unique key on chats (user_id, chat_id) needed by the upsert queries.
+        """
+        alter_query = """
+        ALTER TABLE chats
+        ADD UNIQUE KEY user_chat (user_id, chat_id)
+        """
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(alter_query)
+                connection.commit()
+                print("Unique key added to chats")
+        except Error as e:
+            print(f"Error: {e}")
+
+    def create_messages_table(self):
+        """
+        Creates the append-only chat_messages table used by the 'messages' storage mode.
+        """
+        create_query = """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            chat_id VARCHAR(255) NOT NULL,
+            position INT NOT NULL,
+            role VARCHAR(16) NOT NULL,
+            content MEDIUMTEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY chat_position (user_id, chat_id, position)
+        )
+        """
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(create_query)
+                connection.commit()
+                print("Messages table created successfully")
+        except Error as e:
+            print(f"Error: {e}")
+
+    def append_messages(self, user_id: int, chat_id: str, messages: list, start_position: int):
+        """
+        Appends messages to a chat without rewriting the earlier ones. Messages at
+        even positions are from the human and odd positions from the chatbot.
+
+        Args:
+            user_id (int): ID of the user.
+            chat_id (str): ID of the chat.
+            messages (list): New messages, in order.
+            start_position (int): Position of the first new message in the chat history.
+        """
+        values = self._message_rows(user_id, chat_id, messages, start_position)
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.executemany(self.append_query, values)
+                connection.commit()
+                print(f"{len(values)} messages appended successfully")
+        except Error as e:
+            print(f"Error: {e}")
+
+    @staticmethod
+    def _message_rows(user_id: int, chat_id: str, messages: list, start_position: int) -> list:
+        """
+        Builds chat_messages rows, even positions are from the human and odd ones from the chatbot.
+        """
+        return [
+            (user_id, chat_id, position, 'human' if position % 2 == 0 else 'chatbot', message)
+            for position, message in enumerate(messages, start=start_position)
+        ]
+
+    @staticmethod
+    def _page(chat_history: list, limit: int = None, before: int = None) -> tuple:
+        """
+        Slices the last `limit` turns before a position out of a full chat history.
+        """
+        end = len(chat_history) if before is None else min(before, len(chat_history))
+        start = 0 if limit is None else max(0, end - limit * 2)
+        return chat_history[start:end], start
+
+    def fetch_chat_page(self, user_chat_ids: dict, limit: int = None, before: int = None) -> tuple:
+        """
+        Fetches the last `limit` turns (human and chatbot message pairs) of a chat before a position.
+
+        Args:
+            user_chat_ids (dict): Dictionary containing 'user_id' and 'chat_id'.
+            limit (int, optional): Number of turns to fetch. Defaults to all.
+            before (int, optional): Position to fetch before, used as a cursor for older pages.
+
+        Returns:
+            tuple: (messages, start_position) where start_position is the position of the first message.
+        """
+        if self.storage_mode == 'messages':
+            messages, start = self._fetch_messages(user_chat_ids, limit, before)
+            if messages or before is not None:
+                return messages, start
+        
+        # Blob storage, or a chat not migrated to chat_messages yet
+        return self._page(self.fetch_chat_data(user_chat_ids), limit, before)
+
+    def _fetch_messages(self, user_chat_ids: dict, limit: int = None, before: int = None) -> tuple:
+        """
+        Reads a page of messages from chat_messages, see fetch_chat_page.
+        """
+        fetch_query = """
+        SELECT position, content
+        FROM chat_messages
+        WHERE user_id = %s AND chat_id = %s AND position < %s
+        ORDER BY position DESC
+        """
+        values = [user_chat_ids['user_id'], user_chat_ids['chat_id'], 2 ** 31 - 1 if before is None else before]
+        if limit is not None:
+            fetch_query += "LIMIT %s"
+            values.append(limit * 2)
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(fetch_query, tuple(values))
+                rows = cursor.fetchall()[::-1]
+                if rows and rows[0][0] % 2 == 1:
+                    # Start the page on a human message
+                    rows = rows[1:]
+                start = rows[0][0] if rows else (before or 0)
+                return [content for _, content in rows], start
+        except Error as e:
+            print(f"Error: {e}")
+            return [], before or 0
+
+    def migrate_blob_chats(self) -> int:
+        """
+        Copies the JSON chat_history of every chat into chat_messages. Safe to re-run,
+        messages that were already migrated are skipped.
+
+        Returns:
+            int: Number of chats migrated.
+        """
+        fetch_query = """
+        SELECT user_id, chat_id, chat_history
+        FROM chats
+        """
+        self.create_messages_table()
+        migrated = 0
+        
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(fetch_query)
+                chats = cursor.fetchall()
+        except Error as e:
+            print(f"Error: {e}")
+            return migrated
+        
+        for user_id, chat_id, chat_json in chats:
+            chat_history = json.loads(chat_json)['chat_history'] if chat_json else []
+            if chat_history:
+                self.append_messages(user_id, chat_id, chat_history, 0)
+                migrated += 1
+        print(f"Migrated {migrated} chats to chat_messages")
+        return migrated
 
 if __name__ == "__main__":
+    # Usage: python -m modules.chat_database [migrate|add-unique-key]
+    import sys
     chat = ChatDatabase(host, db_user, db_pass, db)
-    print(chat.host)
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        chat.migrate_blob_chats()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'add-unique-key':
+        chat.add_chats_unique_key()
+    else:
+        print(chat.host)
@@ -8,9 +8,14 @@ from langchain_community.vectorstores.faiss import FAISS
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.messages import HumanMessage
-from langchain.chains import create_history_aware_retriever
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableBranch, RunnableLambda
+from langchain_core.output_parsers import StrOutputParser
 from modules.chat_database import ChatDatabase, host, db_pass, db_user, db
+from modules.session_store import SessionStore, ChatSession, create_shared_store
+from modules.answer_cache import answer_cache
+from modules import history_window
+from modules import context_compression
 from dotenv import load_dotenv
 import os
 
@@ -19,6 +24,9 @@ from langchain_pinecone import PineconeVectorStore
 from pinecone import Pinecone
 
 import asyncio
+import json
+import time
+import re
 
 # Load environment variables from .env file
 load_dotenv()
@@ -41,18 +49,88 @@ DB_FAISS_PATH = 'vectorstore/db_faiss'
 # Initialize ChatDatabase object
 chat_obj = ChatDatabase(host, db_user, db_pass, db)
 
-# Initialize user chat details and history
-user_chat_details = {}
-chat_history = []
-print(chat_history)
+# Upper bound on chain invocations running at the same time in this worker
+MAX_CONCURRENT_CHATS = int(os.getenv('MAX_CONCURRENT_CHATS', '32'))
+_chat_semaphores = {}  # event loop -> semaphore
 
-def fetch_chat_history():
+# References to pending background tasks so they are not garbage collected
+background_tasks = set()
+
+# Time-to-first-byte and time-to-first-token statistics for streamed answers
+stream_metrics = {
+    'streams': 0,
+    'last_ttfb_ms': None,
+    'avg_ttfb_ms': None,
+    'last_ttft_ms': None,
+    'avg_ttft_ms': None
+}
+
+# How often each retrieval path is taken: first turn, standalone follow-up or rewritten follow-up
+routing_stats = {
+    'no_history': 0,
+    'standalone': 0,
+    'rewritten': 0
+}
+
+# Prompt size of answered questions, measured with the local tokenizer
+prompt_stats = {
+    'requests': 0,
+    'last_prompt_tokens': None,
+    'avg_prompt_tokens': None,
+    'summaries': 0
+}
+
+# Tokens removed from the retrieved context by merging, deduplication and the context budget
+compression_stats = {
+    'queries': 0,
+    'last_tokens_saved': None,
+    'total_tokens_saved': 0,
+    'total_tokens_before': 0
+}
+
+# Words that usually point back to earlier messages of the conversation
+CONTEXT_REFERENCE_WORDS = {
+    'it', 'its', 'this', 'that', 'these', 'those', 'they', 'them', 'their', 'there',
+    'he', 'him', 'his', 'she', 'her', 'same', 'above', 'previous', 'mentioned',
+    'also', 'else', 'more', 'another', 'other', 'one', 'ones', 'former', 'latter'
+}
+FOLLOW_UP_PREFIXES = ('and ', 'but ', 'what about', 'how about', 'why', 'ok', 'okay', 'yes', 'no', 'so ', 'then')
+
+# Per-chat conversation state, keyed by (user_id, chat_id)
+sessions = SessionStore(backend=create_shared_store())
+
+def chat_semaphore() -> asyncio.Semaphore:
+    """
+    Returns the chat semaphore of the running event loop. It is created lazily inside the
+    loop, as Python 3.9 binds asyncio primitives to the loop current at creation, which at
+    import time is not the loop uvicorn serves requests on.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _chat_semaphores.get(loop)
+    if semaphore is None:
+        _chat_semaphores.clear()  # Semaphores of closed loops, e.g. of earlier asyncio.run calls
+        semaphore = _chat_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
+    return semaphore
+
+def fetch_chat_history(user_chat_ids: dict) -> list:
     """
     Fetches the chat history from the database for the given user details.
+    
+    Args:
+        user_chat_ids (dict): Dictionary containing 'user_id' and 'chat_id'.
+    
+    Returns:
+        list: Chat history if found, empty list otherwise.
     """
-    global chat_history
-    chat_history = chat_obj.fetch_chat_data(user_chat_details)
+    chat_history = chat_obj.fetch_chat_data(user_chat_ids)
     print(chat_history)
+    return chat_history
+
+def get_chat_session(user_id: int, chat_id: str) -> ChatSession:
+    """
+    Returns the conversation state of a chat, loading its history from the database on a cache miss.
+    """
+    return sessions.get_or_load(user_id, chat_id, fetch_chat_history)
     
     
 def convert_to_array_of_dicts(chat_history):
@@ -71,10 +149,13 @@ def convert_to_array_of_dicts(chat_history):
     
     return chat_array
 
-def load_llm():
+def load_llm(model_name: str = 'gpt-4o'):
     """
     Loads the language model for the chatbot.
     
+    Args:
+        model_name (str): Name of the OpenAI chat model.
+    
     Returns:
         llm (ChatGroq): The loaded language model.
     """
@@ -82,12 +163,13 @@ def load_llm():
     # llm = ChatGroq(groq_api_key=groq_api_key, model_name="Llama3-8b-8192", temperature=0.5)
     
     # Open AI Model
-    llm = ChatOpenAI(model='gpt-4o', temperature=0.5, api_key=open_ai_key)
+    llm = ChatOpenAI(model=model_name, temperature=0.5, api_key=open_ai_key)
     return llm
 
 def history_aware_retriever(retriever, llm):
     """
-    Creates a history-aware retriever for contextualizing user questions.
+    Creates a history-aware retriever for contextualizing user questions. The question
+    is only rewritten by the LLM when there is history and it is not standalone.
     
     Args:
         retriever: The retriever object for fetching documents.
@@ -109,12 +191,72 @@ def history_aware_retriever(retriever, llm):
         ]
     )
     
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
-    )
+    # Only follow-up questions that depend on the history pay for the rewrite LLM call
+    rewrite_retriever = contextualize_q_prompt | llm | StrOutputParser() | retriever
+    direct_retriever = (lambda inputs: inputs["input"]) | retriever
+    
+    history_aware_retriever = RunnableBranch(
+        (needs_contextualization, rewrite_retriever),
+        direct_retriever
+    ).with_config(run_name="chat_retriever_chain")
     
     return history_aware_retriever
 
+def is_standalone_question(question: str) -> bool:
+    """
+    Cheap local heuristic telling whether a question can be understood without the chat history.
+    Short questions, follow-up openers and pronouns referring back to the conversation need a rewrite.
+    
+    Args:
+        question (str): The question input by the user.
+    
+    Returns:
+        bool: True if the question is standalone.
+    """
+    text = question.strip().lower()
+    words = re.findall(r"[a-z']+", text)
+    if len(words) <= 3 or text.startswith(FOLLOW_UP_PREFIXES):
+        return False
+    return not CONTEXT_REFERENCE_WORDS.intersection(words)
+
+def needs_contextualization(inputs: dict) -> bool:
+    """
+    Routes a chain input to the rewrite path or the direct retrieval path and counts the decision.
+    
+    Args:
+        inputs (dict): Chain input with 'input' and 'chat_history'.
+    
+    Returns:
+        bool: True if the question must be rewritten with the chat history.
+    """
+    if not inputs.get("chat_history"):
+        routing_stats['no_history'] += 1
+        return False
+    if is_standalone_question(inputs["input"]):
+        routing_stats['standalone'] += 1
+        return False
+    routing_stats['rewritten'] += 1
+    return True
+
+def compress_context(documents: list) -> list:
+    """
+    Compresses the retrieved chunks before they are stuffed into the QA prompt and
+    records the tokens saved.
+    
+    Args:
+        documents (list): Retrieved documents, best ranked first.
+    
+    Returns:
+        list: The compressed documents.
+    """
+    compressed, stats = context_compression.compress(documents)
+    compression_stats['queries'] += 1
+    compression_stats['last_tokens_saved'] = stats['tokens_saved']
+    compression_stats['total_tokens_saved'] += stats['tokens_saved']
+    compression_stats['total_tokens_before'] += stats['tokens_before']
+    print(f"Context compression: {stats}")
+    return compressed
+
 def get_conversational_chain(history_aware_retriever, llm):
     """
     Sets up the question-answering chain with history-aware retriever.
@@ -149,63 +291,275 @@ def get_conversational_chain(history_aware_retriever, llm):
     )
 
     question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    # Overlapping and near-duplicate chunks are merged or dropped before stuffing
+    retriever = history_aware_retriever | RunnableLambda(compress_context)
+    rag_chain = create_retrieval_chain(retriever, question_answer_chain)
     
     return rag_chain
 
-async def update_chat_history(user_question, answer):
-    chat_history.extend([user_question, answer])
-    print(chat_history)
+def save_chat_history(user_chat_ids: dict, chat_history: list):
+    """
+    Saves the latest turn of the chat in the database (blocking, run in a worker thread).
     
-    # Check and update the database asynchronously, if applicable
-    if chat_obj.does_chat_exist(user_chat_details):
-        chat_obj.update_existing_chat(
-            user_chat_details['user_id'],
-            user_chat_details['chat_id'],
-            chat_history
-        )
-    else:
-        chat_obj.create_new_chat(
-            user_chat_details['user_id'],
-            user_chat_details['chat_id'],
-            chat_history
-        )
-
-async def user_input(user_question):
-    """
-    Asynchronously processes the user input, retrieves vector embeddings, generate response,
-    and updates the chat history asynchronously.
+    Args:
+        user_chat_ids (dict): Dictionary containing 'user_id' and 'chat_id'.
+        chat_history (list): Chat history to be saved.
+    """
+    chat_obj.save_turn(
+        user_chat_ids['user_id'],
+        user_chat_ids['chat_id'],
+        chat_history
+    )
+
+async def persist_chat_history(session: ChatSession, chat_history: list):
+    """
+    Saves the chat history of a session to the database. The session store is updated
+    during the turn, before the session lock is released.
+    
+    Args:
+        session (ChatSession): Conversation state of the chat.
+        chat_history (list): Chat history as of the turn being saved.
+    """
+    # Offload the blocking MySQL work so the event loop stays free
+    await asyncio.to_thread(save_chat_history, session.user_chat_details, chat_history)
+
+async def persist_after(previous, session: ChatSession, chat_history: list):
+    """
+    Saves the chat history once the previous save of the session has finished.
+    """
+    if previous is not None:
+        await asyncio.wait([previous])
+    await persist_chat_history(session, chat_history)
+
+def schedule_persist(session: ChatSession, chat_history: list):
+    """
+    Schedules saving the chat history behind the previous save of the session, so turns
+    reach the database in order. Must be called while holding the session lock.
+    
+    Args:
+        session (ChatSession): Conversation state of the chat.
+        chat_history (list): Chat history as of the turn being saved.
+    """
+    session.persist_task = schedule_background(persist_after(session.persist_task, session, chat_history))
+
+async def lookup_cached_answer(user_question, session: ChatSession, embeddings):
+    """
+    Looks up the semantic answer cache for standalone questions (first turn of a chat or
+    follow-ups that do not reference the history).
     
     Args:
         user_question (str): The question input by the user.
+        session (ChatSession): Conversation state of the chat.
+        embeddings: Embeddings client used to embed the question, the cache is skipped if None.
     
     Returns:
-        response: The response from the language model.
+        tuple: (question embedding or None, cached response or None)
     """
-    # Set OPEN AI embeddings
-    embeddings = OpenAIEmbeddings(model='text-embedding-3-large')
-    
-    # Asynchronously create the vector store and retriever
-    db = PineconeVectorStore(index_name="langchain-ned-data", embedding=embeddings)
-    retriever = db.as_retriever()
+    if embeddings is None or (session.chat_history and not is_standalone_question(user_question)):
+        return None, None
+    question_embedding = await embeddings.aembed_query(user_question)
+    return question_embedding, answer_cache.lookup(question_embedding)
+
+def log_prompt_tokens(user_question: str, history_stats: dict, context: list) -> dict:
+    """
+    Counts the question and context tokens, adds the history token counts and prints the total.
     
-    # Load the language model
-    llm = load_llm()
+    Args:
+        user_question (str): The question input by the user.
+        history_stats (dict): Token counts from history_window.build_history.
+        context (list): Retrieved documents stuffed into the prompt.
     
-    # Create a history-aware retriever
-    history_retriever = history_aware_retriever(retriever, llm)
+    Returns:
+        dict: Token counts of the parts of the prompt.
+    """
+    tokens = {
+        'question_tokens': history_window.count_tokens(user_question),
+        'context_tokens': sum(history_window.count_tokens(doc.page_content) for doc in context),
+        **history_stats
+    }
+    total = tokens['question_tokens'] + tokens['context_tokens'] + tokens['history_tokens'] + tokens['summary_tokens']
+    tokens['prompt_tokens'] = total
+    
+    count = prompt_stats['requests'] + 1
+    average = prompt_stats['avg_prompt_tokens'] or 0
+    prompt_stats['requests'] = count
+    prompt_stats['last_prompt_tokens'] = total
+    prompt_stats['avg_prompt_tokens'] = round((average * (count - 1) + total) / count, 1)
+    print(f"Prompt tokens: {tokens}")
+    return tokens
+
+async def summarize_older_turns(session: ChatSession, llm):
+    """
+    Folds the turns that fell out of the history window into the session's rolling summary,
+    after the answer has been sent so it adds no latency to the request. The session lock
+    is only held to copy the state and to apply the result, not during the LLM call, so
+    the next turn of the chat does not wait for the summary.
     
-    # Set up the conversational QA chain
-    rag_chain = get_conversational_chain(history_retriever, llm)
+    Args:
+        session (ChatSession): Conversation state of the chat.
+        llm: Chat model writing the summary.
+    """
+    async with session.lock:
+        chat_history = list(session.chat_history)
+        summary, summarized_upto = session.summary, session.summarized_upto
+    try:
+        result = await history_window.update_summary(chat_history, summary, summarized_upto, llm)
+    except Exception as e:
+        print(f"Updating the chat summary failed: {e}")
+        return
+    if result is None:
+        return
+    async with session.lock:
+        # Another update already moved the summary on, or the history was replaced meanwhile
+        if (session.summary, session.summarized_upto) != (summary, summarized_upto) \
+                or session.chat_history[:result[1]] != chat_history[:result[1]]:
+            return
+        session.summary, session.summarized_upto = result
+        prompt_stats['summaries'] += 1
+        await sessions.aput(session)
+
+def schedule_background(coroutine):
+    """
+    Runs a coroutine in the background, keeping a reference until it finishes.
+    """
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def user_input(user_question, rag_chain, session: ChatSession, embeddings=None, llm=None):
+    """
+    Asynchronously processes the user input through the warm RAG chain, generate response,
+    and updates the chat history asynchronously.
     
-    # Asynchronously invoke the chain with user input and chat history
-    response = rag_chain.invoke({"input": user_question, "chat_history": chat_history})
+    Args:
+        user_question (str): The question input by the user.
+        rag_chain: The conversational QA chain from the chain registry.
+        session (ChatSession): Conversation state of the chat.
+        embeddings: Embeddings client for the semantic answer cache, optional.
+        llm: Chat model summarizing the turns that no longer fit in the history window, optional.
     
-    # Asynchronously update chat history
-    asyncio.create_task(update_chat_history(user_question, response["answer"]))
+    Returns:
+        response: The response from the language model.
+    """
+    # Asynchronously invoke the chain with user input and chat history, bounded by the semaphore
+    async with session.lock, chat_semaphore():
+        previous_history = list(session.chat_history)
+        question_embedding, cached = await lookup_cached_answer(user_question, session, embeddings)
+        if cached:
+            response = {"input": user_question, **cached}
+        else:
+            # Only the recent turns that fit in the token budget are sent, older ones as a summary
+            chat_history, history_stats = history_window.build_history(session)
+            response = await rag_chain.ainvoke({"input": user_question, "chat_history": chat_history})
+            log_prompt_tokens(user_question, history_stats, response.get("context", []))
+            # Later answers were generated with the chat history, only first-turn answers are shared
+            if question_embedding is not None and not previous_history:
+                answer_cache.store(user_question, question_embedding, response)
+        response = {**response, "chat_history": previous_history}
+        session.chat_history.extend([user_question, response["answer"]])
+        chat_history = list(session.chat_history)
+        # Other workers read the session from the shared store, update it before the next turn can start
+        await sessions.aput(session)
+        # Asynchronously persist chat history, queued in turn order
+        schedule_persist(session, chat_history)
+    
+    # Fold old turns into the summary
+    if llm is not None:
+        schedule_background(summarize_older_turns(session, llm))
     
     return response
 
+def format_sse(event: str, data) -> str:
+    """
+    Formats a payload as a Server-Sent Events message.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def record_stream_metric(name: str, value_ms: float):
+    """
+    Updates the last value and running average of a streaming latency metric.
+    """
+    count = stream_metrics['streams']
+    average = stream_metrics[f'avg_{name}_ms'] or 0
+    stream_metrics[f'last_{name}_ms'] = round(value_ms, 3)
+    stream_metrics[f'avg_{name}_ms'] = round((average * (count - 1) + value_ms) / count, 3)
+
+async def cached_chunks(cached: dict):
+    """
+    Replays a cached response in the same chunk format as rag_chain.astream.
+    """
+    yield {"context": cached["context"]}
+    yield {"answer": cached["answer"]}
+
+async def stream_user_input(user_question, rag_chain, session: ChatSession, embeddings=None, llm=None):
+    """
+    Streams the response to the user input as Server-Sent Events. The retrieved context
+    metadata is sent first, then the answer tokens, and the chat history is saved once
+    the stream completes.
+    
+    Args:
+        user_question (str): The question input by the user.
+        rag_chain: The conversational QA chain from the chain registry.
+        session (ChatSession): Conversation state of the chat.
+        embeddings: Embeddings client for the semantic answer cache, optional.
+        llm: Chat model summarizing the turns that no longer fit in the history window, optional.
+    
+    Yields:
+        str: SSE formatted messages.
+    """
+    start = time.perf_counter()
+    first_byte_sent = False
+    answer_parts = []
+    stream_metrics['streams'] += 1
+    
+    async with session.lock, chat_semaphore():
+        first_turn = not session.chat_history
+        question_embedding, cached = await lookup_cached_answer(user_question, session, embeddings)
+        if cached:
+            chunks = cached_chunks(cached)
+        else:
+            chat_history, history_stats = history_window.build_history(session)
+            chunks = rag_chain.astream({"input": user_question, "chat_history": chat_history})
+        context = []
+        async for chunk in chunks:
+            if "context" in chunk:
+                context = chunk["context"]
+                sources = [doc.metadata for doc in context]
+                message = format_sse("context", {"sources": sources})
+            elif "answer" in chunk:
+                if not answer_parts:
+                    record_stream_metric('ttft', (time.perf_counter() - start) * 1000)
+                answer_parts.append(chunk["answer"])
+                message = format_sse("token", {"token": chunk["answer"]})
+            else:
+                continue
+            
+            if not first_byte_sent:
+                record_stream_metric('ttfb', (time.perf_counter() - start) * 1000)
+                first_byte_sent = True
+            yield message
+        
+        answer = "".join(answer_parts)
+        if not cached:
+            log_prompt_tokens(user_question, history_stats, context)
+            if question_embedding is not None and first_turn:
+                answer_cache.store(user_question, question_embedding, {"answer": answer, "context": context})
+        session.chat_history.extend([user_question, answer])
+        chat_history = list(session.chat_history)
+        await sessions.aput(session)
+        # Persist the chat history once, when the whole answer has been generated
+        schedule_persist(session, chat_history)
+    
+    yield format_sse("done", {
+        "answer": answer,
+        "ttfb_ms": stream_metrics['last_ttfb_ms'],
+        "ttft_ms": stream_metrics['last_ttft_ms']
+    })
+    
+    if llm is not None:
+        schedule_background(summarize_older_turns(session, llm))
+
 # def user_input(user_question):
 #     """
 #     Processes the user input, retrieves vector embeddings, generate response,
@@ -0,0 +1,117 @@
+# Persisted store of the chunks of every ingested source, keyed by their stable chunk IDs
+from langchain.docstore.document import Document
+from modules.history_window import count_tokens
+from contextlib import contextmanager
+import sqlite3
+import json
+import os
+
+# SQLite database of the chunk store, next to the local vector store
+CHUNK_STORE_PATH = os.getenv('CHUNK_STORE_PATH', 'vectorstore/chunks.db')
+
+
+class ChunkStore:
+    """
+    Keeps the text and metadata of every embedded chunk with the chunker that produced it,
+    so chunks can be looked up by vector ID, re-indexed without splitting the sources again,
+    and compared across chunking strategies.
+
+    Attributes:
+        path (str): SQLite database file.
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_PATH):
+        self.path = path
+        self._create_table()
+
+    @contextmanager
+    def _connect(self):
+        """
+        Yields a connection that commits on success, rolls back on error and is closed afterwards.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _create_table(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    chunk_id TEXT PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    chunker TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    tokens INTEGER NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks (source, position)")
+
+    def replace_source(self, key: str, chunks: list, chunker: str):
+        """
+        Replaces the stored chunks of a source.
+
+        Args:
+            key (str): Source key (file name, PDF path or URL).
+            chunks (list): Chunks with their 'chunk_id' metadata, in source order.
+            chunker (str): Signature of the chunker that produced them.
+        """
+        rows = [
+            (chunk.metadata['chunk_id'], key, position, chunker, chunk.page_content,
+             json.dumps(chunk.metadata), count_tokens(chunk.page_content))
+            for position, chunk in enumerate(chunks)
+        ]
+        with self._connect() as connection:
+            connection.execute("DELETE FROM chunks WHERE source = ?", (key,))
+            connection.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove_sources(self, keys: list):
+        with self._connect() as connection:
+            connection.executemany("DELETE FROM chunks WHERE source = ?", [(key,) for key in keys])
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM chunks")
+
+    def _documents(self, rows) -> list:
+        return [Document(page_content=row['text'], metadata=json.loads(row['metadata'])) for row in rows]
+
+    def source_chunks(self, key: str) -> list:
+        """
+        Returns the stored chunks of a source in order, an empty list if it is not stored.
+        """
+        with self._connect() as connection:
+            rows = connection.execute("SELECT text, metadata FROM chunks WHERE source = ? ORDER BY position",
+                                      (key,)).fetchall()
+        return self._documents(rows)
+
+    def get(self, chunk_ids: list) -> list:
+        """
+        Returns the stored chunks of vector IDs, in the order of the IDs found.
+        """
+        with self._connect() as connection:
+            rows = {}
+            for start in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[start:start + 500]
+                query = f"SELECT chunk_id, text, metadata FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})"
+                rows.update((row['chunk_id'], row) for row in connection.execute(query, batch))
+        return self._documents([rows[chunk_id] for chunk_id in chunk_ids if chunk_id in rows])
+
+    def stats(self) -> dict:
+        """
+        Returns the number of sources, chunks and tokens stored for each chunker.
+        """
+        with self._connect() as connection:
+            rows = connection.execute("""
+                SELECT chunker, COUNT(DISTINCT source) AS sources, COUNT(*) AS chunks, SUM(tokens) AS tokens
+                FROM chunks GROUP BY chunker
+            """).fetchall()
+        return {row['chunker']: {'sources': row['sources'], 'chunks': row['chunks'], 'tokens': row['tokens']}
+                for row in rows}
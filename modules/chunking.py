@@ -0,0 +1,242 @@
+# Chunking strategies splitting the loaded documents of a source into the chunks that are embedded
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.docstore.document import Document
+from modules.history_window import count_tokens
+import re
+import os
+
+# Strategy used by ingestion: 'recursive' (300/100 characters, the original splitter), 'token',
+# 'page' or 'heading'. Changing it re-embeds every source on the next ingestion
+CHUNKING_STRATEGY = os.getenv('CHUNKING_STRATEGY', 'recursive')
+
+# Token sizes of the token, page and heading strategies: chunk size of the token strategy and
+# overlap, largest page or section kept whole, and smallest section kept on its own
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', '256'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '32'))
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', '512'))
+CHUNK_MIN_TOKENS = int(os.getenv('CHUNK_MIN_TOKENS', '48'))
+
+# Numbered headings of the prospectus ("8.6 FEE REFUND POLICY", "8.6.1 Admission Fee"),
+# stand-alone upper case titles and letter-spaced banners ("M I S S I O N")
+NUMBERED_HEADING = re.compile(r"^(\d{1,2}(?:\.\d{1,2}){0,3})\.?\s+([A-Z][A-Za-z0-9&,/()'\- ]{2,80})$")
+CAPS_HEADING = re.compile(r"^[A-Z][A-Z0-9&,/()'\- ]{5,80}$")
+SPACED_HEADING = re.compile(r"^[A-Z](?: {1,2}[A-Z]){3,}$")
+
+# Longest numbered heading title, longer numbered lines are the first line of a clause
+HEADING_MAX_WORDS = 8
+CLAUSE_ENDINGS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'not', 'of', 'on', 'or',
+                  'shall', 'the', 'to', 'who', 'which', 'that', 'with'}
+
+
+def clean_text(text: str) -> str:
+    """
+    Collapses the runs of spaces and blank lines PDF extraction leaves between lines.
+    """
+    text = re.sub(r"[ \t\xa0]+", " ", text)
+    text = re.sub(r" ?\n[ \n]*", "\n", text)
+    return text.strip()
+
+
+class RecursiveChunker:
+    """
+    The original splitter: fixed 300 character chunks overlapping by 100 characters.
+    """
+
+    name = 'recursive'
+
+    def __init__(self, chunk_size: int = 300, chunk_overlap: int = 100):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def signature(self) -> str:
+        return f"{self.name}:{self.chunk_size}:{self.chunk_overlap}"
+
+    def split(self, documents: list) -> list:
+        return self.splitter.split_documents(documents)
+
+
+class TokenChunker:
+    """
+    Splits on paragraph, line and word boundaries into chunks measured in tokens of the
+    embedding tokenizer rather than characters.
+    """
+
+    name = 'token'
+
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_tokens, chunk_overlap=overlap_tokens,
+                                                       length_function=count_tokens)
+
+    def signature(self) -> str:
+        return f"{self.name}:{self.chunk_tokens}:{self.overlap_tokens}"
+
+    def split_text(self, text: str) -> list:
+        return self.splitter.split_text(text)
+
+    def split(self, documents: list) -> list:
+        chunks = []
+        for document in documents:
+            for text in self.split_text(clean_text(document.page_content)):
+                chunks.append(Document(page_content=text, metadata=dict(document.metadata)))
+        return chunks
+
+
+class PageChunker:
+    """
+    One chunk per page (or per crawled web page). Pages longer than max_tokens are split
+    with the token strategy, pages shorter than min_tokens are joined to the next page.
+    """
+
+    name = 'page'
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS,
+                 overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.token_chunker = TokenChunker(max_tokens, overlap_tokens)
+
+    def signature(self) -> str:
+        return f"{self.name}:{self.max_tokens}:{self.min_tokens}:{self.token_chunker.overlap_tokens}"
+
+    def split(self, documents: list) -> list:
+        chunks = []
+        pending_text, pending_metadata = "", None
+        for document in documents:
+            text = clean_text(document.page_content)
+            if not text:
+                continue
+            if pending_text:
+                text = pending_text + "\n" + text
+            metadata = pending_metadata or dict(document.metadata)
+            if count_tokens(text) < self.min_tokens:
+                pending_text, pending_metadata = text, metadata
+                continue
+            pending_text, pending_metadata = "", None
+            for part in self.token_chunker.split_text(text) if count_tokens(text) > self.max_tokens else [text]:
+                chunks.append(Document(page_content=part, metadata=dict(metadata)))
+        if pending_text:
+            chunks.append(Document(page_content=pending_text, metadata=pending_metadata))
+        return chunks
+
+
+class HeadingChunker:
+    """
+    Splits a source into the sections under its headings, across page breaks, which suits
+    the numbered sections of the prospectus. Each chunk starts with its heading path (e.g.
+    "8.6 FEE REFUND POLICY > 8.6.1 Admission Fee") so the section title is embedded with
+    the text. Sections longer than max_tokens are split with the token strategy, sections
+    shorter than min_tokens are joined to the next one.
+    """
+
+    name = 'heading'
+    # Bumped when the output changes for the same settings, so ingested sources are split again
+    version = 2
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS,
+                 overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.token_chunker = TokenChunker(max_tokens, overlap_tokens)
+
+    def signature(self) -> str:
+        return f"{self.name}:{self.max_tokens}:{self.min_tokens}:{self.token_chunker.overlap_tokens}:v{self.version}"
+
+    @staticmethod
+    def parse_heading(line: str):
+        """
+        Recognizes a heading line.
+
+        Returns:
+            tuple: (section number or None for an unnumbered title, heading text), None if the
+            line is not a heading.
+        """
+        match = NUMBERED_HEADING.match(line)
+        if match:
+            number, title = match.group(1), match.group(2).strip()
+            words = title.split()
+            if title.isupper() or ('.' in number and len(words) <= HEADING_MAX_WORDS
+                                   and words[-1].lower() not in CLAUSE_ENDINGS and not title.endswith((',', '-'))):
+                return number, f"{number} {title}"
+            return None
+        if SPACED_HEADING.match(line):
+            return None, line.replace(" ", "")
+        if CAPS_HEADING.match(line) and len(line.split()) >= 2 and any(len(word) >= 4 for word in line.split()):
+            return None, line
+        return None
+
+    def sections(self, documents: list) -> list:
+        """
+        Returns (heading path, text, metadata of the page the section starts on) tuples. The
+        path holds the numbered headings above the section (8.6 above 8.6.1) and the last
+        unnumbered title under them.
+        """
+        sections = []
+        path = []  # (section number or None, heading text)
+        lines, metadata = [], None
+        for document in documents:
+            for line in clean_text(document.page_content).split("\n"):
+                heading = self.parse_heading(line)
+                if heading is None:
+                    if metadata is None:
+                        metadata = dict(document.metadata)
+                    lines.append(line)
+                    continue
+                if lines:
+                    sections.append((" > ".join(text for _, text in path[-2:]), "\n".join(lines), metadata))
+                number, text = heading
+                if number is None:
+                    path = [entry for entry in path if entry[0] is not None] + [heading]
+                else:
+                    path = [entry for entry in path
+                            if entry[0] is not None and number.startswith(entry[0] + '.')] + [heading]
+                lines, metadata = [], dict(document.metadata)
+        if lines:
+            sections.append((" > ".join(text for _, text in path[-2:]), "\n".join(lines), metadata))
+        return sections
+
+    def split(self, documents: list) -> list:
+        chunks = []
+        pending, pending_metadata = "", None
+        for heading, text, metadata in self.sections(documents):
+            body = pending + (heading + "\n" if heading else "") + text
+            if count_tokens(body) < self.min_tokens:
+                pending, pending_metadata = body + "\n", pending_metadata or metadata
+                continue
+            if count_tokens(body) > self.max_tokens:
+                # The short sections held back go in a chunk of their own before the long one is split
+                if pending.strip():
+                    chunks.append(Document(page_content=pending.strip(), metadata=dict(pending_metadata)))
+                parts = self.token_chunker.split_text(text)
+            else:
+                parts = [body]
+            pending, pending_metadata = "", None
+            for part in parts:
+                if part is not body and heading:
+                    part = heading + "\n" + part
+                chunks.append(Document(page_content=part, metadata={**metadata, 'section': heading}))
+        if pending.strip():
+            chunks.append(Document(page_content=pending.strip(), metadata=dict(pending_metadata)))
+        return chunks
+
+
+STRATEGIES = {
+    'recursive': RecursiveChunker,
+    'token': TokenChunker,
+    'page': PageChunker,
+    'heading': HeadingChunker,
+}
+
+# Chunker of the sources ingested before the chunker was recorded in the manifest
+LEGACY_SIGNATURE = RecursiveChunker().signature()
+
+
+def get_chunker(strategy: str = CHUNKING_STRATEGY):
+    """
+    Returns the chunker of a strategy name, with its sizes from the environment.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown chunking strategy '{strategy}', expected one of {', '.join(STRATEGIES)}")
+    return STRATEGIES[strategy]()
@@ -0,0 +1,167 @@
+# Post-retrieval compression of the context stuffed into the QA prompt
+from langchain.docstore.document import Document
+from modules.history_window import count_tokens, get_encoding
+import re
+import os
+
+# Token budget of the stuffed context, shortest overlap merged (the splitter overlaps chunks
+# by up to 100 characters) and share of a chunk's word shingles already in a better ranked
+# chunk above which it is a near-duplicate
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '2000'))
+CONTEXT_MIN_OVERLAP_CHARS = int(os.getenv('CONTEXT_MIN_OVERLAP_CHARS', '20'))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv('CONTEXT_DUPLICATE_THRESHOLD', '0.8'))
+
+# Words per shingle in the near-duplicate comparison
+SHINGLE_SIZE = 3
+
+# Smallest remainder worth keeping when the last chunk is truncated to the budget
+MIN_TRUNCATED_TOKENS = 50
+
+
+def location(document) -> tuple:
+    """
+    Returns the (source, page) a chunk was split from, chunks are only merged within one.
+    """
+    metadata = document.metadata
+    return (metadata.get('filename') or metadata.get('source'), metadata.get('page'))
+
+
+def overlap_length(first: str, second: str, min_chars: int = CONTEXT_MIN_OVERLAP_CHARS) -> int:
+    """
+    Returns the length of the longest suffix of first that is a prefix of second, 0 if
+    it is shorter than min_chars.
+    """
+    probe = second[:min_chars]
+    if len(probe) < min_chars:
+        return 0
+    start = first.find(probe)
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(probe, start + 1)
+    return 0
+
+
+def merge_overlapping(documents: list) -> tuple:
+    """
+    Merges chunks of the same source and page whose text overlaps, and drops chunks whose
+    text is contained in another one. A merged chunk takes the rank of its best ranked part.
+
+    Returns:
+        tuple: (documents, number of chunks merged or dropped)
+    """
+    merged = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+    removed = 0
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(len(merged)):
+                if i == j or location(merged[i]) != location(merged[j]):
+                    continue
+                first, second = merged[i].page_content, merged[j].page_content
+                if second in first:
+                    text = first
+                else:
+                    overlap = overlap_length(first, second)
+                    if not overlap:
+                        continue
+                    text = first + second[overlap:]
+                keep, drop = min(i, j), max(i, j)
+                merged[keep].page_content = text
+                del merged[drop]
+                removed += 1
+                changed = True
+                break
+            if changed:
+                break
+    return merged, removed
+
+
+def shingles(text: str) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def drop_near_duplicates(documents: list, threshold: float = CONTEXT_DUPLICATE_THRESHOLD) -> tuple:
+    """
+    Drops chunks whose word shingles are, above the threshold fraction, already in a better
+    ranked chunk (the same page crawled under two URLs, repeated prospectus text, a chunk
+    covered by a merged one). Retrieval returns a handful of chunks, so the shingle sets are
+    compared exactly rather than through MinHash signatures.
+
+    Returns:
+        tuple: (documents, number of chunks dropped)
+    """
+    kept, kept_shingles = [], []
+    for document in documents:
+        document_shingles = shingles(document.page_content)
+        duplicate = any(
+            len(document_shingles & other) / len(document_shingles) >= threshold
+            for other in kept_shingles
+        )
+        if not duplicate:
+            kept.append(document)
+            kept_shingles.append(document_shingles)
+    return kept, len(documents) - len(kept)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def enforce_budget(documents: list, budget: int = CONTEXT_TOKEN_BUDGET) -> tuple:
+    """
+    Keeps the best ranked chunks that fit in the token budget, truncating the first one
+    that does not fit if enough of the budget is left.
+
+    Returns:
+        tuple: (documents, number of chunks dropped or truncated)
+    """
+    kept = []
+    used = 0
+    for document in documents:
+        tokens = count_tokens(document.page_content)
+        if used + tokens <= budget:
+            kept.append(document)
+            used += tokens
+            continue
+        remaining = budget - used
+        if remaining >= MIN_TRUNCATED_TOKENS:
+            kept.append(Document(page_content=truncate_to_tokens(document.page_content, remaining),
+                                 metadata={**document.metadata, 'truncated': True}))
+        break
+    return kept, len(documents) - len(kept) + sum(1 for doc in kept if doc.metadata.get('truncated'))
+
+
+def compress(documents: list, budget: int = CONTEXT_TOKEN_BUDGET) -> tuple:
+    """
+    Merges overlapping chunks, drops near-duplicates and fits the rest in the token budget.
+
+    Args:
+        documents (list): Retrieved chunks, best ranked first.
+        budget (int): Token budget of the context.
+
+    Returns:
+        tuple: (compressed documents, dict with the tokens before and after and what was removed)
+    """
+    tokens_before = sum(count_tokens(doc.page_content) for doc in documents)
+    merged_documents, merged = merge_overlapping(documents)
+    unique_documents, duplicates = drop_near_duplicates(merged_documents)
+    compressed, over_budget = enforce_budget(unique_documents, budget)
+    tokens_after = sum(count_tokens(doc.page_content) for doc in compressed)
+    return compressed, {
+        'chunks_in': len(documents),
+        'chunks_out': len(compressed),
+        'merged': merged,
+        'duplicates': duplicates,
+        'over_budget': over_budget,
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved': tokens_before - tokens_after
+    }
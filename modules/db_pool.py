@@ -0,0 +1,219 @@
+# Shared MySQL connection pool used by ChatDatabase and auth
+from contextlib import contextmanager
+import mysql.connector
+from mysql.connector import Error
+import threading
+import time
+import os
+
+# Pool settings from environment variables
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30'))
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no connection becomes available within the pool timeout. Not a mysql
+    Error, so the query helpers that handle database errors let it through and the API
+    answers 503 instead of treating the pool being busy as a missing record.
+    """
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of database connections with a fixed size, a bounded
+    overflow and health checks of idle connections.
+
+    Attributes:
+        connect (callable): Factory that opens a new connection.
+        max_size (int): Connections kept open when idle.
+        max_overflow (int): Extra connections opened under load and closed when released.
+        timeout (float): Seconds to wait for a free connection before raising PoolTimeoutError.
+        health_check_interval (float): Idle seconds after which a connection is pinged before reuse.
+    """
+
+    def __init__(self, connect, max_size: int = DB_POOL_SIZE, max_overflow: int = DB_POOL_MAX_OVERFLOW,
+                 timeout: float = DB_POOL_TIMEOUT, health_check_interval: float = DB_POOL_HEALTH_CHECK_INTERVAL):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # (connection, released_at) pairs
+        self._open = 0
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._stats = {
+            'acquired': 0,
+            'created': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+
+    def _is_healthy(self, connection, released_at: float) -> bool:
+        """
+        Pings a connection that has been idle longer than the health check interval.
+        """
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            connection.ping(reconnect=True, attempts=1, delay=0)
+            return True
+        except Error:
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def acquire(self):
+        """
+        Takes a connection from the pool, opening a new one if allowed.
+
+        Returns:
+            A database connection.
+
+        Raises:
+            PoolTimeoutError: If the pool stays exhausted for longer than the timeout.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, released_at = self._idle.pop()
+                    break
+                if self._open < self.max_size + self.max_overflow:
+                    connection, released_at = None, None
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(f"No database connection available after {self.timeout}s")
+                self._condition.wait(remaining)
+            self._in_use += 1
+
+        wait_ms = (time.monotonic() - start) * 1000
+        try:
+            if connection is not None and not self._is_healthy(connection, released_at):
+                self._close(connection)
+                connection = None
+                with self._condition:
+                    self._stats['discarded'] += 1
+            if connection is None:
+                connection = self.connect()
+                with self._condition:
+                    self._stats['created'] += 1
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._stats['acquired'] += 1
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+        return connection
+
+    def release(self, connection):
+        """
+        Returns a connection to the pool, closing it if the pool is above its idle size.
+        """
+        try:
+            # End any open transaction so the next user does not see a stale snapshot,
+            # without a round trip when the last statement was committed
+            if connection.in_transaction:
+                connection.rollback()
+            reusable = True
+        except Error:
+            reusable = False
+
+        with self._condition:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.max_size:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._open -= 1
+                self._close(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that acquires a connection and always releases it.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def metrics(self) -> dict:
+        """
+        Returns pool usage metrics: in-use and idle counts, connections created and wait times.
+        """
+        with self._condition:
+            acquired = self._stats['acquired']
+            return {
+                **self._stats,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'open': self._open,
+                'max_size': self.max_size,
+                'max_overflow': self.max_overflow,
+                'avg_wait_ms': self._stats['total_wait_ms'] / acquired if acquired else 0.0
+            }
+
+    def close_all(self):
+        """
+        Closes all idle connections.
+        """
+        with self._condition:
+            for connection, _ in self._idle:
+                self._close(connection)
+                self._open -= 1
+            self._idle = []
+
+
+# Pools shared across modules, keyed by connection parameters
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host: str, user: str, password: str, database: str) -> ConnectionPool:
+    """
+    Returns the shared pool for the given MySQL credentials, creating it on first use.
+
+    Args:
+        host (str): Database host.
+        user (str): Database user.
+        password (str): Database password.
+        database (str): Database name.
+
+    Returns:
+        ConnectionPool: The shared connection pool.
+    """
+    key = (host, user, password, database)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                lambda: mysql.connector.connect(host=host, user=user, password=password, database=database)
+            )
+        return _pools[key]
+
+
+def pool_metrics() -> list:
+    """
+    Returns the metrics of every shared pool.
+    """
+    with _pools_lock:
+        return [{'host': key[0], 'database': key[3], **pool.metrics()} for key, pool in _pools.items()]
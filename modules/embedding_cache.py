@@ -0,0 +1,343 @@
+# Persistent embedding cache keyed by (model, sha256(text))
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import threading
+import hashlib
+import asyncio
+import json
+import uuid
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows, the cache is then only safe within one process
+    fcntl = None
+
+# Embedding cache settings from environment variables
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'vectorstore/embedding_cache')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '20000'))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Fixed-capacity store of embeddings for one model: a memory-mapped float32
+    matrix with one row per slot, the text hash held in each slot, and an
+    append-only log of slot assignments that workers replay incrementally to see
+    each other's writes. The least recently used slot is overwritten when the
+    store is full.
+
+    Attributes:
+        model (str): Embeddings model name.
+        max_entries (int): Number of rows of the matrix.
+        stats (dict): Hit, miss and eviction counters.
+    """
+
+    def __init__(self, model: str, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.model = model
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(path, exist_ok=True)
+        base = os.path.join(path, model.replace('/', '_'))
+        self.matrix_path = base + '.f32'
+        self.keys_path = base + '.keys'
+        self.log_path = base + '.log'
+        self.meta_path = base + '.meta.json'
+        self.legacy_index_path = base + '.index.json'
+        self.lock_path = base + '.lock'
+        self.dim = None
+        self._matrix = None
+        self._keys = None
+        self._slots = {}          # text hash -> slot
+        self._slot_keys = {}      # slot -> text hash
+        self._lru = OrderedDict() # text hashes, least recently used first
+        self._next_slot = 0       # slots from here on are free
+        self._log_generation = None
+        self._log_offset = 0
+        self._log_lines = 0
+        self._lock = threading.Lock()
+        with self._lock, self._file_lock() as lock_file:
+            self._migrate_index(lock_file)
+            self._load_log(lock_file)
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        """
+        Holds the lock file shared (readers) or exclusive (writers) across worker processes.
+        The file holds the generation of the log, changed each time the log is compacted.
+        """
+        with open(self.lock_path, 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield lock_file
+
+    @staticmethod
+    def _check(key: str) -> int:
+        # First 64 bits of the text hash, stored with the slot
+        return int(key[:16], 16)
+
+    def _open_matrix(self):
+        if self._matrix is None:
+            mode = 'r+' if os.path.exists(self.matrix_path) else 'w+'
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode=mode, shape=(self.max_entries, self.dim))
+        return self._matrix
+
+    def _open_keys(self):
+        if self._keys is None:
+            mode = 'r+' if os.path.exists(self.keys_path) else 'w+'
+            self._keys = np.memmap(self.keys_path, dtype=np.uint64, mode=mode, shape=(self.max_entries,))
+        return self._keys
+
+    def _assign(self, key: str, slot: int):
+        """
+        Records that slot holds key, forgetting the text that held the slot before.
+        """
+        previous = self._slot_keys.get(slot)
+        if previous is not None and previous != key:
+            self._slots.pop(previous, None)
+            self._lru.pop(previous, None)
+        old_slot = self._slots.get(key)
+        if old_slot is not None and old_slot != slot:
+            self._slot_keys.pop(old_slot, None)
+        self._slots[key] = slot
+        self._slot_keys[slot] = key
+        self._lru[key] = None
+        self._lru.move_to_end(key)
+        self._next_slot = max(self._next_slot, slot + 1)
+
+    def _load_log(self, lock_file):
+        """
+        Replays the slot assignments appended to the log since the last call, e.g. by another
+        worker, or the whole log after it was compacted. Called with the file lock held.
+        """
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return
+        lock_file.seek(0)
+        generation = lock_file.read()
+        if generation != self._log_generation or size < self._log_offset:
+            self._slots, self._slot_keys, self._lru = {}, {}, OrderedDict()
+            self._next_slot, self._log_offset, self._log_lines = 0, 0, 0
+            self._log_generation = generation
+        if size == self._log_offset:
+            return
+        if self.dim is None:
+            with open(self.meta_path) as meta_file:
+                self.dim = json.load(meta_file)['dim']
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(self._log_offset)
+            data = log_file.read()
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.decode().splitlines():
+            key, slot = line.split()
+            self._assign(key, int(slot))
+            self._log_lines += 1
+        self._log_offset += len(data)
+
+    def _append_log(self, lock_file, lines: list):
+        with open(self.log_path, 'a') as log_file:
+            log_file.write("".join(lines))
+        self._log_offset = os.path.getsize(self.log_path)
+        self._log_lines += len(lines)
+        # Rewrite the log with one line per stored text once reassigned slots dominate it
+        if self._log_lines > 2 * self.max_entries:
+            self._write_log(lock_file)
+
+    def _write_log(self, lock_file):
+        temp_path = self.log_path + '.tmp'
+        with open(temp_path, 'w') as log_file:
+            log_file.write("".join(f"{key} {self._slots[key]}\n" for key in self._lru))
+        os.replace(temp_path, self.log_path)
+        # Other workers see the new generation and replay the compacted log from the start
+        self._log_generation = uuid.uuid4().hex
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(self._log_generation)
+        lock_file.flush()
+        self._log_offset, self._log_lines = os.path.getsize(self.log_path), len(self._slots)
+
+    def _write_meta(self):
+        with open(self.meta_path, 'w') as meta_file:
+            json.dump({'model': self.model, 'dim': self.dim}, meta_file)
+
+    def _migrate_index(self, lock_file):
+        """
+        Converts the JSON index of earlier versions to the slot hashes and the log.
+        """
+        if not os.path.exists(self.legacy_index_path) or os.path.exists(self.log_path):
+            return
+        with open(self.legacy_index_path) as index_file:
+            index = json.load(index_file)
+        self.dim = index['dim']
+        self._write_meta()
+        keys = self._open_keys()
+        for key in sorted(index['slots'], key=lambda key: index['last_used'].get(key, 0)):
+            slot = index['slots'][key]
+            keys[slot] = self._check(key)
+            self._assign(key, slot)
+        keys.flush()
+        self._write_log(lock_file)
+        os.remove(self.legacy_index_path)
+
+    def get_many(self, hashes: list) -> list:
+        """
+        Returns the cached embedding of each hash, None where it is missing.
+        """
+        with self._lock, self._file_lock(shared=True) as lock_file:
+            self._load_log(lock_file)
+            results = []
+            for key in hashes:
+                slot = self._slots.get(key)
+                # The hash stored with the slot guards against reading a slot reassigned to another text
+                if slot is None or self._open_keys()[slot] != self._check(key):
+                    self.stats['misses'] += 1
+                    results.append(None)
+                    continue
+                self.stats['hits'] += 1
+                self._lru.move_to_end(key)
+                results.append(self._open_matrix()[slot].tolist())
+            return results
+
+    def put_many(self, hashes: list, vectors: list):
+        """
+        Stores embeddings, evicting the least recently used ones when the store is full.
+        """
+        if not hashes:
+            return
+        with self._lock, self._file_lock() as lock_file:
+            self._load_log(lock_file)
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                self._write_meta()
+            matrix, keys = self._open_matrix(), self._open_keys()
+            lines = []
+            for key, vector in zip(hashes, vectors):
+                if key in self._slots:
+                    continue
+                if self._next_slot < self.max_entries:
+                    slot = self._next_slot
+                else:
+                    slot = self._slots[next(iter(self._lru))]
+                    self.stats['evictions'] += 1
+                matrix[slot] = vector
+                keys[slot] = self._check(key)
+                self._assign(key, slot)
+                lines.append(f"{key} {slot}\n")
+            if lines:
+                matrix.flush()
+                keys.flush()
+                self._append_log(lock_file, lines)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'model': self.model,
+                'size': len(self._slots),
+                'max_entries': self.max_entries,
+                'hit_rate': self.stats['hits'] / lookups if lookups else 0.0
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves repeated texts from an EmbeddingStore and
+    only sends the missing ones to the underlying embeddings client.
+    """
+
+    def __init__(self, underlying: Embeddings, store: EmbeddingStore):
+        self.underlying = underlying
+        self.store = store
+
+    @staticmethod
+    def _missing(hashes: list, vectors: list) -> dict:
+        """
+        Maps each distinct missing hash to the index of its first text, so duplicates are embedded once.
+        """
+        missing = {}
+        for i, (key, vector) in enumerate(zip(hashes, vectors)):
+            if vector is None and key not in missing:
+                missing[key] = i
+        return missing
+
+    def _fill(self, hashes: list, vectors: list, missing: dict, new_vectors: list) -> list:
+        """
+        Stores the new embeddings and fills them in for every text that was missing.
+        """
+        self.store.put_many(list(missing), new_vectors)
+        computed = dict(zip(missing, new_vectors))
+        return [computed[key] if vector is None else vector for key, vector in zip(hashes, vectors)]
+
+    def embed_documents(self, texts: list) -> list:
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.store.get_many(hashes)
+        missing = self._missing(hashes, vectors)
+        if missing:
+            new_vectors = self.underlying.embed_documents([texts[i] for i in missing.values()])
+            return self._fill(hashes, vectors, missing, new_vectors)
+        return vectors
+
+    def embed_query(self, text: str) -> list:
+        key = text_hash(text)
+        vector = self.store.get_many([key])[0]
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self.store.put_many([key], [vector])
+        return vector
+
+    # The store takes file locks and replays other workers' writes, so the async methods
+    # call it on a thread and keep the event loop free for chat traffic
+    async def aembed_documents(self, texts: list) -> list:
+        hashes = [text_hash(text) for text in texts]
+        vectors = await asyncio.to_thread(self.store.get_many, hashes)
+        missing = self._missing(hashes, vectors)
+        if missing:
+            new_vectors = await self.underlying.aembed_documents([texts[i] for i in missing.values()])
+            return await asyncio.to_thread(self._fill, hashes, vectors, missing, new_vectors)
+        return vectors
+
+    async def aembed_query(self, text: str) -> list:
+        key = text_hash(text)
+        vector = (await asyncio.to_thread(self.store.get_many, [key]))[0]
+        if vector is None:
+            vector = await self.underlying.aembed_query(text)
+            await asyncio.to_thread(self.store.put_many, [key], [vector])
+        return vector
+
+
+# One store per model, shared by the query and ingestion paths
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_cached_embeddings(model: str = 'text-embedding-3-large') -> CachedEmbeddings:
+    """
+    Returns OpenAI embeddings for the model wrapped with the shared persistent cache.
+
+    Args:
+        model (str): OpenAI embeddings model name.
+
+    Returns:
+        CachedEmbeddings: The cached embeddings client.
+    """
+    with _stores_lock:
+        if model not in _stores:
+            _stores[model] = EmbeddingStore(model)
+        store = _stores[model]
+    return CachedEmbeddings(OpenAIEmbeddings(model=model), store)
+
+
+def embedding_cache_stats() -> list:
+    """
+    Returns the statistics of every embedding store.
+    """
+    with _stores_lock:
+        return [store.get_stats() for store in _stores.values()]
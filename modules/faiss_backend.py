@@ -0,0 +1,270 @@
+# Local FAISS retrieval backend, an in-process alternative to Pinecone
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from modules.ingestion_manifest import source_key
+import numpy as np
+import faiss
+import pickle
+import shutil
+import uuid
+import math
+import os
+
+# Path to the FAISS vector database
+DB_FAISS_PATH = os.getenv('DB_FAISS_PATH', 'vectorstore/db_faiss')
+
+# 'hnsw', 'ivfpq' or 'flat' (exact search)
+FAISS_INDEX_TYPE = os.getenv('FAISS_INDEX_TYPE', 'hnsw')
+FAISS_HNSW_M = int(os.getenv('FAISS_HNSW_M', '32'))
+FAISS_HNSW_EF_SEARCH = int(os.getenv('FAISS_HNSW_EF_SEARCH', '64'))
+FAISS_IVF_NPROBE = int(os.getenv('FAISS_IVF_NPROBE', '16'))
+
+# Marker file naming the version directory that holds the current index.faiss and index.pkl
+CURRENT_MARKER = 'CURRENT'
+
+
+def build_index(vectors: np.ndarray, index_type: str = FAISS_INDEX_TYPE):
+    """
+    Builds a FAISS inner-product index over L2 normalized vectors (cosine similarity).
+
+    Args:
+        vectors (np.ndarray): float32 matrix of shape (n, dim), already normalized.
+        index_type (str): 'hnsw', 'ivfpq' or 'flat'.
+
+    Returns:
+        faiss.Index: The populated index.
+    """
+    count, dim = vectors.shape
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+    elif index_type == 'ivfpq' and count >= 256 * 39:
+        # PQ needs the sub-vector count to divide the dimension, and enough vectors to train the codebooks
+        sub_vectors = max(m for m in range(1, 65) if dim % m == 0)
+        nlist = max(1, int(math.sqrt(count)))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, nlist, sub_vectors, 8, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.nprobe = FAISS_IVF_NPROBE
+    else:
+        if index_type == 'ivfpq':
+            print(f"Only {count} vectors, too few to train IVF-PQ, using exact search")
+        index = faiss.IndexFlatIP(dim)
+    index.add(vectors)
+    return index
+
+
+def normalize(vectors) -> np.ndarray:
+    """
+    Returns the vectors as an L2 normalized float32 matrix.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(matrix)
+    return matrix
+
+
+def current_directory(path: str = DB_FAISS_PATH) -> str:
+    """
+    Returns the directory holding the current index.faiss and index.pkl. Stores saved
+    before versioning keep both files directly in path.
+    """
+    try:
+        with open(os.path.join(path, CURRENT_MARKER)) as marker_file:
+            return os.path.join(path, marker_file.read().strip())
+    except OSError:
+        return path
+
+
+def write_version(index, docstore, index_to_docstore_id: dict, path: str = DB_FAISS_PATH):
+    """
+    Writes the index and documents into a new version directory, then switches to it by
+    replacing the marker file, so readers never pair an index with another version's
+    documents. The previous version is kept for readers still loading it.
+    """
+    os.makedirs(path, exist_ok=True)
+    previous = os.path.basename(current_directory(path))
+    version = uuid.uuid4().hex
+    version_path = os.path.join(path, version)
+    os.makedirs(version_path)
+    faiss.write_index(index, os.path.join(version_path, 'index.faiss'))
+    with open(os.path.join(version_path, 'index.pkl'), 'wb') as store_file:
+        pickle.dump((docstore, index_to_docstore_id), store_file)
+
+    with open(os.path.join(path, CURRENT_MARKER + '.tmp'), 'w') as marker_file:
+        marker_file.write(version)
+    os.replace(os.path.join(path, CURRENT_MARKER + '.tmp'), os.path.join(path, CURRENT_MARKER))
+
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry) and name not in (version, previous):
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def save_store(documents: list, vectors, path: str = DB_FAISS_PATH, index_type: str = FAISS_INDEX_TYPE):
+    """
+    Builds the index and saves it with the documents in the same layout as
+    FAISS.save_local (index.faiss and index.pkl), in a new version directory.
+
+    Args:
+        documents (list): LangChain documents, in the same order as the vectors.
+        vectors: Embeddings of the documents.
+        path (str): Directory of the local store.
+        index_type (str): 'hnsw', 'ivfpq' or 'flat'.
+    """
+    index = build_index(normalize(vectors), index_type)
+    ids = [str(uuid.uuid4()) for _ in documents]
+    docstore = InMemoryDocstore(dict(zip(ids, documents)))
+    index_to_docstore_id = dict(enumerate(ids))
+    write_version(index, docstore, index_to_docstore_id, path)
+    print(f"Saved local FAISS {index_type} index with {len(documents)} vectors")
+
+
+def load_documents(path: str = DB_FAISS_PATH) -> list:
+    """
+    Returns the documents of the local store, in index order.
+    """
+    pickle_path = os.path.join(current_directory(path), 'index.pkl')
+    if not os.path.exists(pickle_path):
+        return []
+    with open(pickle_path, 'rb') as store_file:
+        docstore, index_to_docstore_id = pickle.load(store_file)
+    return [docstore.search(index_to_docstore_id[i]) for i in sorted(index_to_docstore_id)]
+
+
+def load_store(embeddings, path: str = DB_FAISS_PATH) -> FAISS:
+    """
+    Loads the local store once, memory-mapping the index file when the index type allows it.
+    A store with documents but no index file (as shipped in the repo) is rebuilt first.
+
+    Args:
+        embeddings: Embeddings client used to embed the queries.
+        path (str): Directory of the local store.
+
+    Returns:
+        FAISS: LangChain vector store backed by the local index.
+
+    Raises:
+        FileNotFoundError: If the store has no documents to build the index from.
+    """
+    index_path = os.path.join(current_directory(path), 'index.faiss')
+    if not os.path.exists(index_path):
+        documents = load_documents(path)
+        if not documents:
+            raise FileNotFoundError(f"No local FAISS index in {path}, ingest documents with "
+                                    "RETRIEVER_BACKEND=faiss or run python -m modules.faiss_backend")
+        print(f"No FAISS index file in {path}, building it from {len(documents)} stored documents")
+        rebuild(documents, embeddings, path)
+        index_path = os.path.join(current_directory(path), 'index.faiss')
+    store_path = os.path.dirname(index_path)
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # HNSW graphs cannot be memory-mapped, load them in RAM
+        index = faiss.read_index(index_path)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+    elif hasattr(index, 'nprobe'):
+        index.nprobe = FAISS_IVF_NPROBE
+
+    with open(os.path.join(store_path, 'index.pkl'), 'rb') as store_file:
+        docstore, index_to_docstore_id = pickle.load(store_file)
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        normalize_L2=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+
+
+def index_version(path: str = DB_FAISS_PATH) -> str:
+    """
+    Returns the name of the current version directory, empty if there is none. The
+    marker file is replaced last when saving, so a new version is complete when it shows.
+    """
+    directory = current_directory(path)
+    return os.path.basename(directory) if directory != path else ""
+
+
+def rebuild(documents: list, embeddings, path: str = DB_FAISS_PATH):
+    """
+    Rebuilds the local store from documents. Embeddings come from the embedding
+    cache, so only documents never embedded before cost an API call.
+    """
+    if not documents:
+        delete_store(path)
+        return
+    vectors = embeddings.embed_documents([doc.page_content for doc in documents])
+    save_store(documents, vectors, path)
+
+
+def apply_changes(added_documents: list, removed_ids: list, embeddings, path: str = DB_FAISS_PATH):
+    """
+    Applies an incremental ingestion to the local store: chunks whose 'chunk_id'
+    metadata is in removed_ids are dropped and the new chunks are added.
+
+    When nothing is removed, the new vectors are appended to the current index (IVF-PQ
+    codebooks are not retrained). Removals rebuild the whole index, since HNSW cannot
+    delete vectors: that re-reads every stored chunk's embedding from the embedding cache
+    and rebuilds the graph, which takes time proportional to the corpus.
+    """
+    removed = set(removed_ids)
+    documents = load_documents(path)
+    remaining = [doc for doc in documents if doc.metadata.get('chunk_id') not in removed]
+    index_path = os.path.join(current_directory(path), 'index.faiss')
+    if len(remaining) != len(documents) or not documents or not os.path.exists(index_path):
+        rebuild(remaining + list(added_documents), embeddings, path)
+        return
+    if not added_documents:
+        return
+
+    index = faiss.read_index(index_path)
+    index.add(normalize(embeddings.embed_documents([doc.page_content for doc in added_documents])))
+    ids = [str(uuid.uuid4()) for _ in documents + list(added_documents)]
+    docstore = InMemoryDocstore(dict(zip(ids, documents + list(added_documents))))
+    write_version(index, docstore, dict(enumerate(ids)), path)
+    print(f"Added {len(added_documents)} vectors to the local FAISS index")
+
+
+def delete_file_documents(file_names: list, embeddings, path: str = DB_FAISS_PATH):
+    """
+    Removes the chunks of files from the local store (HNSW does not support removal, so it is rebuilt).
+    """
+    names = set(file_names)
+    documents = load_documents(path)
+    remaining = [doc for doc in documents if doc.metadata.get('filename') not in names]
+    if len(remaining) != len(documents):
+        rebuild(remaining, embeddings, path)
+
+
+def delete_legacy_documents(keys: list, embeddings, path: str = DB_FAISS_PATH):
+    """
+    Removes the chunks of sources that were stored before chunks had a 'chunk_id'.
+    """
+    keys = set(keys)
+    documents = load_documents(path)
+    remaining = [doc for doc in documents
+                 if doc.metadata.get('chunk_id') or source_key(doc) not in keys]
+    if len(remaining) != len(documents):
+        rebuild(remaining, embeddings, path)
+
+
+def delete_store(path: str = DB_FAISS_PATH):
+    """
+    Deletes the local index and documents.
+    """
+    for name in (CURRENT_MARKER, 'index.faiss', 'index.pkl'):
+        file_path = os.path.join(path, name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    # Builds the index from the documents already in vectorstore/db_faiss/index.pkl
+    from modules.embedding_cache import get_cached_embeddings
+    rebuild(load_documents(), get_cached_embeddings('text-embedding-3-large'))
@@ -0,0 +1,130 @@
+# Token-budgeted chat history window with a rolling summary of the older turns
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from functools import lru_cache
+import tiktoken
+import os
+
+# Tokens of recent history sent with each question, and the model whose tokenizer counts them
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '1500'))
+TOKENIZER_MODEL = os.getenv('TOKENIZER_MODEL', 'gpt-4o')
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", """You maintain a running summary of a conversation between a student and the \
+        NED University admissions assistant. Extend the current summary with the new lines, keeping \
+        the facts, names, programmes, dates and open questions a follow-up question could refer to. \
+        Answer with the updated summary only, in at most 150 words."""),
+        ("human", "Current summary:\n{summary}\n\nNew lines of conversation:\n{new_lines}"),
+    ]
+)
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str = TOKENIZER_MODEL):
+    """
+    Returns the tiktoken encoding of the model, None if it cannot be loaded (tiktoken
+    downloads the BPE file on first use, set TIKTOKEN_CACHE_DIR on offline servers).
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print(f"Tokenizer for {model} unavailable, estimating tokens from characters: {e}")
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str, model: str = TOKENIZER_MODEL) -> int:
+    """
+    Counts the tokens of a text with the local tokenizer of the model. Cached, since the
+    same history messages are counted again on every turn of a chat.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def window_start(chat_history: list, budget: int = HISTORY_TOKEN_BUDGET) -> tuple:
+    """
+    Finds the oldest whole turn (question and answer) that still fits in the budget,
+    counting back from the latest turn.
+
+    Returns:
+        tuple: (index of the first history message kept, tokens of the kept messages)
+    """
+    start = len(chat_history)
+    used = 0
+    last_turn = (len(chat_history) - 1) // 2 * 2
+    for turn_start in range(last_turn, -1, -2):
+        turn_tokens = sum(count_tokens(text) for text in chat_history[turn_start:turn_start + 2])
+        if used + turn_tokens > budget:
+            break
+        used += turn_tokens
+        start = turn_start
+    return start, used
+
+
+def build_history(session, budget: int = HISTORY_TOKEN_BUDGET) -> tuple:
+    """
+    Builds the chat_history messages of a prompt: the rolling summary of the older turns,
+    if any were left out, followed by the most recent turns that fit in the budget.
+
+    Args:
+        session (ChatSession): Conversation state with chat_history and summary.
+        budget (int): Token budget of the recent turns.
+
+    Returns:
+        tuple: (list of messages, dict of token counts)
+    """
+    history = session.chat_history
+    start, history_tokens = window_start(history, budget)
+    messages = []
+    summary_tokens = 0
+    if start > 0 and session.summary:
+        messages.append(SystemMessage(content="Summary of the earlier conversation: " + session.summary))
+        summary_tokens = count_tokens(session.summary)
+    for i in range(start, len(history)):
+        messages.append(HumanMessage(content=history[i]) if i % 2 == 0 else AIMessage(content=history[i]))
+    stats = {
+        'history_tokens': history_tokens,
+        'summary_tokens': summary_tokens,
+        'turns_sent': (len(history) - start + 1) // 2,
+        'turns_summarized': min(start, session.summarized_upto) // 2,
+        'turns_dropped': max(0, start - session.summarized_upto) // 2
+    }
+    return messages, stats
+
+
+async def update_summary(chat_history: list, summary: str, summarized_upto: int, llm,
+                         budget: int = HISTORY_TOKEN_BUDGET):
+    """
+    Folds the turns that fell out of the window since the last update into the rolling
+    summary. Only the new turns are sent with the current summary, so the cost of an
+    update does not grow with the length of the chat. Works on a copy of the session
+    state, the caller applies the result.
+
+    Args:
+        chat_history (list): Messages of the chat.
+        summary (str): Current rolling summary.
+        summarized_upto (int): Number of messages already folded into the summary.
+        llm: Chat model writing the summary.
+        budget (int): Token budget of the recent turns.
+
+    Returns:
+        tuple: (new summary, number of messages it covers), None if no turn left the window.
+    """
+    start, _ = window_start(chat_history, budget)
+    if start <= summarized_upto:
+        return None
+    new_lines = "\n".join(
+        f"{'Student' if i % 2 == 0 else 'Assistant'}: {chat_history[i]}"
+        for i in range(summarized_upto, start)
+    )
+    chain = SUMMARY_PROMPT | llm | StrOutputParser()
+    new_summary = await chain.ainvoke({"summary": summary or "(empty)", "new_lines": new_lines})
+    return new_summary, start
@@ -0,0 +1,334 @@
+# Background ingestion jobs, run off the event loop so uploads do not stall chat traffic
+from langchain.docstore.document import Document
+from contextlib import contextmanager
+import threading
+import sqlite3
+import shutil
+import random
+import json
+import uuid
+import time
+import os
+
+# SQLite database of the job queue, shared by the API worker processes of a host
+INGEST_JOB_DB_PATH = os.getenv('INGEST_JOB_DB_PATH', 'vectorstore/ingestion_jobs.db')
+
+# Ingestion jobs running at once in each process, more are queued
+INGEST_JOB_WORKERS = int(os.getenv('INGEST_JOB_WORKERS', '1'))
+
+# Maximum jobs queued or running before new submissions are rejected
+INGEST_QUEUE_MAX = int(os.getenv('INGEST_QUEUE_MAX', '20'))
+
+# Attempts of a stage before the job fails, and base backoff between attempts
+INGEST_STAGE_ATTEMPTS = int(os.getenv('INGEST_STAGE_ATTEMPTS', '3'))
+INGEST_STAGE_BACKOFF_SECONDS = float(os.getenv('INGEST_STAGE_BACKOFF_SECONDS', '2'))
+
+# Finished jobs kept for status queries
+INGEST_JOB_HISTORY = int(os.getenv('INGEST_JOB_HISTORY', '100'))
+
+# Directory where uploaded files wait for their job
+INGEST_SPOOL_PATH = os.getenv('INGEST_SPOOL_PATH', 'vectorstore/uploads')
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue is at INGEST_QUEUE_MAX.
+    """
+
+
+def documents_to_json(documents: list) -> list:
+    return [{'page_content': doc.page_content, 'metadata': doc.metadata} for doc in documents]
+
+
+def documents_from_json(items: list) -> list:
+    return [Document(page_content=item['page_content'], metadata=item['metadata']) for item in items]
+
+
+class IngestionJobs:
+    """
+    Persistent queue of ingestion jobs. A job runs the stages of a registered pipeline in
+    order, passing a JSON payload from one stage to the next. The payload is saved after
+    every stage, so a retried or interrupted job resumes at the stage that did not finish.
+    Files a job spooled in payload['spool_dir'] are removed when the job leaves the history.
+
+    Attributes:
+        path (str): SQLite database file.
+        workers (int): Worker threads of this process.
+        max_queued (int): Maximum jobs queued or running.
+        attempts (int): Attempts of a stage before the job fails.
+        pipelines (dict): kind -> list of (stage name, function(payload, progress) -> payload).
+    """
+
+    def __init__(self, path: str = INGEST_JOB_DB_PATH, workers: int = INGEST_JOB_WORKERS,
+                 max_queued: int = INGEST_QUEUE_MAX, attempts: int = INGEST_STAGE_ATTEMPTS,
+                 backoff: float = INGEST_STAGE_BACKOFF_SECONDS, history: int = INGEST_JOB_HISTORY):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.attempts = attempts
+        self.backoff = backoff
+        self.history = history
+        self.pipelines = {}
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._stopping = False
+        self._create_table()
+
+    @contextmanager
+    def _connect(self):
+        """
+        Yields a connection that commits on success, rolls back on error and is closed afterwards.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _create_table(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    stage_index INTEGER NOT NULL DEFAULT 0,
+                    stages TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    progress TEXT NOT NULL DEFAULT '{}',
+                    error TEXT,
+                    owner_pid INTEGER,
+                    submitted_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, submitted_at)")
+
+    def register(self, kind: str, stages: list):
+        """
+        Registers the stages of a job kind.
+
+        Args:
+            kind (str): Job kind used in submit.
+            stages (list): (stage name, function(payload, progress) -> payload) tuples, run in order.
+        """
+        self.pipelines[kind] = stages
+
+    def submit(self, kind: str, name: str, payload: dict) -> str:
+        """
+        Queues a job and returns its ID.
+
+        Args:
+            kind (str): Registered pipeline to run.
+            name (str): Short description shown in the job status.
+            payload (dict): JSON serializable input of the first stage.
+
+        Returns:
+            str: The job ID.
+
+        Raises:
+            QueueFullError: If max_queued jobs are already queued or running.
+        """
+        job_id = uuid.uuid4().hex
+        stages = [{'name': stage_name, 'state': 'pending', 'attempts': 0, 'seconds': None, 'error': None}
+                  for stage_name, _ in self.pipelines[kind]]
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            active = connection.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')").fetchone()[0]
+            if active >= self.max_queued:
+                raise QueueFullError(f"{active} ingestion jobs are already queued or running")
+            connection.execute(
+                "INSERT INTO jobs (job_id, kind, name, state, stages, payload, submitted_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, name, json.dumps(stages), json.dumps(payload), time.time())
+            )
+        self._notify()
+        return job_id
+
+    def retry(self, job_id: str) -> bool:
+        """
+        Re-queues a failed job. It resumes at the stage that failed.
+
+        Returns:
+            bool: False if the job does not exist or has not failed.
+        """
+        with self._connect() as connection:
+            updated = connection.execute(
+                "UPDATE jobs SET state = 'queued', error = NULL, finished_at = NULL WHERE job_id = ? AND state = 'failed'",
+                (job_id,)
+            ).rowcount
+        self._notify()
+        return updated == 1
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _claim(self):
+        """
+        Marks the oldest queued job as running by this process and returns it, None if the
+        queue is empty. BEGIN IMMEDIATE takes the write lock, so two processes never claim the same job.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' ORDER BY submitted_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = 'running', owner_pid = ?, started_at = COALESCE(started_at, ?) WHERE job_id = ?",
+                (os.getpid(), time.time(), row['job_id'])
+            )
+            return row
+
+    def _save(self, job_id: str, **fields):
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        values = [json.dumps(value) if column in ('stages', 'payload', 'progress') else value
+                  for column, value in fields.items()]
+        with self._connect() as connection:
+            connection.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*values, job_id))
+
+    def _run(self, row):
+        job_id = row['job_id']
+        stages = json.loads(row['stages'])
+        payload = json.loads(row['payload'])
+        pipeline = self.pipelines[row['kind']]
+
+        for stage_index in range(row['stage_index'], len(pipeline)):
+            stage_name, function = pipeline[stage_index]
+            stage = stages[stage_index]
+            stage.update(state='running', error=None)
+            self._save(job_id, stages=stages, stage_index=stage_index)
+            progress = lambda value: self._save(job_id, progress={'stage': stage_name, **value})
+
+            for attempt in range(1, self.attempts + 1):
+                stage['attempts'] += 1
+                start = time.perf_counter()
+                try:
+                    payload = function(payload, progress)
+                    stage.update(state='succeeded', seconds=round(time.perf_counter() - start, 3))
+                    break
+                except Exception as e:
+                    print(f"Ingestion job {job_id} stage {stage_name} attempt {attempt} failed: {e}")
+                    stage.update(error=str(e), seconds=round(time.perf_counter() - start, 3))
+                    if attempt == self.attempts:
+                        stage['state'] = 'failed'
+                        self._save(job_id, state='failed', stages=stages, error=f"{stage_name}: {e}",
+                                   finished_at=time.time())
+                        self._trim()
+                        return
+                    self._save(job_id, stages=stages)
+                    time.sleep(self.backoff * (2 ** (attempt - 1)) + random.random())
+            # Payload is saved with the stage so a retry starts from the next one
+            self._save(job_id, stages=stages, payload=payload, stage_index=stage_index + 1)
+
+        self._save(job_id, state='succeeded', finished_at=time.time())
+        self._trim()
+
+    def _worker(self):
+        while not self._stopping:
+            row = self._claim()
+            if row is None:
+                with self._wakeup:
+                    # Poll as well, jobs may be submitted by another process
+                    self._wakeup.wait(timeout=2)
+                continue
+            try:
+                self._run(row)
+            except Exception as e:
+                print(f"Ingestion job {row['job_id']} crashed: {e}")
+                self._save(row['job_id'], state='failed', error=str(e), finished_at=time.time())
+                self._trim()
+
+    def _trim(self):
+        """
+        Deletes the finished jobs beyond the history, with their spooled files. A failed job
+        keeps its spool while it can still be retried.
+        """
+        with self._connect() as connection:
+            expired = connection.execute("""
+                SELECT job_id, payload FROM jobs WHERE state IN ('succeeded', 'failed') AND job_id NOT IN (
+                    SELECT job_id FROM jobs WHERE state IN ('succeeded', 'failed')
+                    ORDER BY finished_at DESC LIMIT ?
+                )
+            """, (self.history,)).fetchall()
+            connection.executemany("DELETE FROM jobs WHERE job_id = ?", [(row['job_id'],) for row in expired])
+        for row in expired:
+            spool_dir = json.loads(row['payload']).get('spool_dir')
+            if spool_dir:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+
+    @staticmethod
+    def _process_alive(pid) -> bool:
+        if not pid or pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def start(self):
+        """
+        Re-queues jobs interrupted by a restart and starts the worker threads.
+        """
+        if self._threads:
+            return
+        with self._connect() as connection:
+            running = connection.execute("SELECT job_id, owner_pid FROM jobs WHERE state = 'running'").fetchall()
+            for row in running:
+                if not self._process_alive(row['owner_pid']):
+                    connection.execute("UPDATE jobs SET state = 'queued' WHERE job_id = ?", (row['job_id'],))
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._worker, daemon=True, name=f'ingestion-{i}')
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the workers after their current job.
+        """
+        self._stopping = True
+        self._notify()
+        self._threads = []
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        return {
+            'job_id': row['job_id'],
+            'kind': row['kind'],
+            'name': row['name'],
+            'state': row['state'],
+            'stages': json.loads(row['stages']),
+            'progress': json.loads(row['progress']),
+            'error': row['error'],
+            'submitted_at': row['submitted_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at']
+        }
+
+    def get(self, job_id: str):
+        """
+        Returns the job status with per-stage state, attempts and timings, None for unknown IDs.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self) -> list:
+        with self._connect() as connection:
+            rows = connection.execute("SELECT * FROM jobs ORDER BY submitted_at DESC").fetchall()
+        return [self._to_dict(row) for row in rows]
+
+
+# Shared job queue of the API process, started by the FastAPI lifespan
+jobs = IngestionJobs()
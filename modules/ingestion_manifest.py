@@ -0,0 +1,135 @@
+# Manifest of ingested sources and chunks, used to re-embed only what changed
+from contextlib import contextmanager
+import threading
+import hashlib
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows, ingestion is then only serialized within one process
+    fcntl = None
+
+# Path of the manifest file, next to the local vector store
+MANIFEST_PATH = os.getenv('INGESTION_MANIFEST_PATH', 'vectorstore/ingestion_manifest.json')
+
+# Lock file serializing ingestion and deletions across threads and API worker processes
+INGESTION_LOCK_PATH = os.getenv('INGESTION_LOCK_PATH', 'vectorstore/ingestion.lock')
+
+_thread_lock = threading.Lock()
+
+
+@contextmanager
+def ingestion_lock(path: str = INGESTION_LOCK_PATH):
+    """
+    Holds the exclusive ingestion lock. The manifest, chunk store and BM25 index are loaded,
+    changed and saved as a whole, so every update of them must run under this lock or
+    concurrent jobs overwrite each other's changes.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with _thread_lock, open(path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def source_key(document) -> str:
+    """
+    Returns the identifier of the source a document comes from: the uploaded
+    file name, or the PDF path / web page URL set by the LangChain loaders.
+    """
+    return document.metadata.get('filename') or document.metadata.get('source') or 'unknown'
+
+
+class IngestionManifest:
+    """
+    Records, for every ingested source, the hash of its content and the vector IDs
+    of its chunks. Chunk IDs are derived from the source and the chunk text, so an
+    unchanged chunk always maps to the same vector.
+
+    Attributes:
+        path (str): Path of the JSON manifest file.
+        sources (dict): source key -> {'hash': content hash, 'chunks': [vector IDs], 'chunker': signature,
+            'origin': flow that ingested the source ('corpus', 'upload' or 'site')}
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.exists = os.path.exists(path)
+        if self.exists:
+            with open(path) as manifest_file:
+                self.sources = json.load(manifest_file)
+        else:
+            self.sources = {}
+
+    def source_hash(self, key: str):
+        entry = self.sources.get(key)
+        return entry['hash'] if entry else None
+
+    def chunker(self, key: str):
+        """
+        Returns the signature of the chunker the source was split with, None for sources
+        recorded before chunkers were.
+        """
+        entry = self.sources.get(key)
+        return entry.get('chunker') if entry else None
+
+    def origin(self, key: str):
+        """
+        Returns the flow that ingested the source, None for sources recorded before origins were.
+        """
+        entry = self.sources.get(key)
+        return entry.get('origin') if entry else None
+
+    def set_origin(self, key: str, origin: str):
+        if key in self.sources:
+            self.sources[key]['origin'] = origin
+
+    def sources_from(self, origin: str) -> list:
+        return [key for key, entry in self.sources.items() if entry.get('origin') == origin]
+
+    def chunk_ids(self, key: str) -> list:
+        entry = self.sources.get(key)
+        return entry['chunks'] if entry else []
+
+    @staticmethod
+    def assign_chunk_ids(key: str, chunks: list) -> list:
+        """
+        Computes the vector ID of each chunk of a source and stores it in the chunk metadata.
+        Repeated identical chunks within a source get distinct IDs.
+        """
+        seen = {}
+        ids = []
+        for chunk in chunks:
+            text_key = content_hash(chunk.page_content)
+            occurrence = seen.get(text_key, 0)
+            seen[text_key] = occurrence + 1
+            chunk_id = content_hash(f"{key}\0{text_key}\0{occurrence}")[:40]
+            chunk.metadata['chunk_id'] = chunk_id
+            ids.append(chunk_id)
+        return ids
+
+    def update(self, key: str, source_hash: str, chunk_ids: list, chunker: str = None, origin: str = None):
+        self.sources[key] = {'hash': source_hash, 'chunks': chunk_ids, 'chunker': chunker, 'origin': origin}
+
+    def remove_source(self, key: str) -> list:
+        """
+        Forgets a source and returns the vector IDs of its chunks.
+        """
+        entry = self.sources.pop(key, None)
+        return entry['chunks'] if entry else []
+
+    def clear(self):
+        self.sources = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(self.sources, manifest_file)
+        os.replace(temp_path, self.path)
+        self.exists = True
@@ -21,6 +21,8 @@ class Token(BaseModel):
 
 class ChatInfo(BaseModel):
     chat_id: str
+    limit: Optional[int] = None   # Number of most recent turns to fetch, all if not set
+    before: Optional[int] = None  # Cursor from a previous response to fetch older turns
     
 class LoginInfo(BaseModel):
     email: str
@@ -30,4 +32,11 @@ class FileName(BaseModel):
     file_name: str
 
 class webURLS(BaseModel):
-    urls : list
\ No newline at end of file
+    urls : list
+
+class ChainConfig(BaseModel):
+    llm_model: Optional[str] = None
+    embedding_model: Optional[str] = None
+    index_name: Optional[str] = None
+    retriever_backend: Optional[str] = None
+    summary_model: Optional[str] = None
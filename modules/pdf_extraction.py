@@ -0,0 +1,108 @@
+# Parallel PDF text extraction on a process pool, one LangChain document per page
+from langchain.docstore.document import Document
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import fitz  # PyMuPDF for PDF handling
+import sys
+import os
+
+try:
+    import resource
+except ImportError:  # Windows, worker memory is then not capped
+    resource = None
+
+# Extraction processes, pages handled per task, and address space limit of each process
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '16'))
+PDF_WORKER_MEMORY_MB = int(os.getenv('PDF_WORKER_MEMORY_MB', '1024'))
+
+# Tasks a worker process runs before it is replaced, so fragmented memory is given back
+PDF_TASKS_PER_WORKER = int(os.getenv('PDF_TASKS_PER_WORKER', '50'))
+
+
+def _limit_worker_memory(memory_mb: int):
+    """
+    Process pool initializer: caps the address space of the worker, so a malformed PDF
+    fails with MemoryError in its own process instead of exhausting the server.
+    """
+    if resource is not None and memory_mb > 0:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def extract_pages(path: str, start: int, end: int) -> list:
+    """
+    Extracts the text of pages [start, end) of a PDF.
+
+    Returns:
+        list: (page number, text) tuples of the non-empty pages.
+    """
+    pages = []
+    with fitz.open(path) as pdf_document:
+        for page_number in range(start, min(end, pdf_document.page_count)):
+            text = pdf_document[page_number].get_text()
+            if text.strip():
+                pages.append((page_number, text))
+    return pages
+
+
+def page_count(path: str) -> int:
+    with fitz.open(path) as pdf_document:
+        return pdf_document.page_count
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """
+    Returns the shared extraction process pool, created on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking the multithreaded API process is unsafe, start workers from a clean server process
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            options = {'max_workers': PDF_WORKERS, 'initializer': _limit_worker_memory,
+                       'initargs': (PDF_WORKER_MEMORY_MB,), 'mp_context': multiprocessing.get_context(method)}
+            if sys.version_info >= (3, 11):
+                options['max_tasks_per_child'] = PDF_TASKS_PER_WORKER
+            _pool = ProcessPoolExecutor(**options)
+        return _pool
+
+
+def extract_files(files: list, progress=None, pool: ProcessPoolExecutor = None) -> list:
+    """
+    Extracts several PDFs in parallel. Every file is split into page ranges so large
+    files are spread over the workers too; each page becomes a Document with the same
+    'page' metadata as PyPDFLoader (0-based).
+
+    Args:
+        files (list): (file name, path) pairs.
+        progress (callable): Optional callback receiving {'pages_extracted', 'pages_total'}.
+        pool (ProcessPoolExecutor): Pool to run on, the shared pool by default.
+
+    Returns:
+        list: Documents in file and page order.
+    """
+    pool = pool or get_pool()
+    tasks = []
+    total_pages = 0
+    for file_name, path in files:
+        count = page_count(path)
+        total_pages += count
+        for start in range(0, count, PDF_PAGES_PER_TASK):
+            task_pages = min(PDF_PAGES_PER_TASK, count - start)
+            tasks.append((file_name, pool.submit(extract_pages, path, start, start + task_pages), task_pages))
+
+    documents = []
+    pages_extracted = 0
+    for file_name, future, task_pages in tasks:
+        for page_number, text in future.result():
+            documents.append(Document(page_content=text, metadata={"filename": file_name, "page": page_number}))
+        pages_extracted += task_pages
+        if progress:
+            progress({'pages_extracted': pages_extracted, 'pages_total': total_pages})
+    return documents
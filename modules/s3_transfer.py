@@ -0,0 +1,192 @@
+# Streaming, concurrent S3 uploads, listing and bulk deletion for the knowledge base files
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import asyncio
+import time
+import os
+
+# Size of each multipart upload part (S3 minimum is 5 MB)
+UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE_MB', '8')) * 1024 * 1024
+
+# Files uploaded at once, and parts of one file in flight (each in-flight part is held in memory)
+S3_TRANSFER_WORKERS = int(os.getenv('S3_TRANSFER_WORKERS', '4'))
+S3_PART_CONCURRENCY = int(os.getenv('S3_PART_CONCURRENCY', '2'))
+
+# Keys per listing page and per DeleteObjects request (S3 maximum for both)
+S3_KEYS_PER_REQUEST = 1000
+
+# Client configuration with enough pooled connections for every part in flight, so they are reused
+CLIENT_CONFIG = Config(max_pool_connections=S3_TRANSFER_WORKERS * S3_PART_CONCURRENCY + 2,
+                       retries={'max_attempts': 5, 'mode': 'adaptive'})
+
+
+class TransferService:
+    """
+    Uploads files to S3 on a shared thread pool: several files at once, and several parts
+    of each file at once. Each file is copied to a local spool file in the same pass.
+    Part size and per-file concurrency come from a boto3 TransferConfig. Also lists the
+    bucket page by page and deletes keys in concurrent 1000-key batches.
+
+    Attributes:
+        client: boto3 S3 client, shared by all uploads so its connection pool is reused.
+        config (TransferConfig): Multipart threshold, part size and parts in flight per file.
+    """
+
+    def __init__(self, client, workers: int = S3_TRANSFER_WORKERS, part_size: int = UPLOAD_PART_SIZE,
+                 part_concurrency: int = S3_PART_CONCURRENCY):
+        self.client = client
+        self.config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                     max_concurrency=part_concurrency)
+        self.file_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-file')
+        self.part_pool = ThreadPoolExecutor(max_workers=workers * part_concurrency, thread_name_prefix='s3-part')
+
+    def _upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes) -> dict:
+        response = self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                           PartNumber=part_number, Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def tee_upload(self, fileobj, bucket: str, key: str, spool_path: str) -> dict:
+        """
+        Copies a file stream to S3 and to a local spool file in one pass. Files smaller than
+        a part are sent with a single PUT, larger ones as a multipart upload with up to
+        config.max_concurrency parts in flight, which is aborted if anything fails so no
+        orphaned parts are billed.
+
+        Args:
+            fileobj: Readable binary stream, rewound before reading.
+            bucket (str): Destination bucket.
+            key (str): Destination object key.
+            spool_path (str): Local copy read by the PDF extractor, which needs random access.
+
+        Returns:
+            dict: Key, spool path, size in bytes, number of parts and upload seconds.
+        """
+        start = time.perf_counter()
+        part_size = self.config.multipart_chunksize
+        fileobj.seek(0)
+        with open(spool_path, 'wb') as spool_file:
+            chunk = fileobj.read(part_size)
+            spool_file.write(chunk)
+            if len(chunk) < self.config.multipart_threshold:
+                self.client.put_object(Bucket=bucket, Key=key, Body=chunk)
+                return {'key': key, 'spool_path': spool_path, 'size': len(chunk), 'parts': 1,
+                        'seconds': round(time.perf_counter() - start, 3)}
+
+            upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+            try:
+                parts = []
+                in_flight = deque()
+                size = 0
+                while chunk:
+                    if len(in_flight) >= self.config.max_concurrency:
+                        parts.append(in_flight.popleft().result())
+                    part_number = len(parts) + len(in_flight) + 1
+                    in_flight.append(self.part_pool.submit(self._upload_part, bucket, key, upload_id, part_number, chunk))
+                    size += len(chunk)
+                    chunk = None  # The part is referenced by its future only, until it is sent
+                    chunk = fileobj.read(part_size)
+                    spool_file.write(chunk)
+                while in_flight:
+                    parts.append(in_flight.popleft().result())
+                self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                      MultipartUpload={'Parts': parts})
+            except Exception:
+                for future in in_flight:
+                    future.cancel()
+                self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+                raise
+        return {'key': key, 'spool_path': spool_path, 'size': size, 'parts': len(parts),
+                'seconds': round(time.perf_counter() - start, 3)}
+
+    async def upload_many(self, bucket: str, uploads: list) -> list:
+        """
+        Uploads several files concurrently without blocking the event loop.
+
+        Args:
+            bucket (str): Destination bucket.
+            uploads (list): (file stream, key, spool path) tuples.
+
+        Returns:
+            list: tee_upload results, in the order of uploads.
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self.file_pool, self.tee_upload, fileobj, bucket, key, spool_path)
+            for fileobj, key, spool_path in uploads
+        ])
+
+    def list_page(self, bucket: str, limit: int = S3_KEYS_PER_REQUEST, cursor: str = None):
+        """
+        Returns one page of the bucket listing.
+
+        Args:
+            bucket (str): Bucket to list.
+            limit (int): Maximum objects in the page, at most 1000.
+            cursor (str): next_cursor of the previous page, None for the first page.
+
+        Returns:
+            tuple: (list of object metadata dicts, next cursor or None after the last page).
+        """
+        options = {'Bucket': bucket, 'MaxKeys': min(limit, S3_KEYS_PER_REQUEST)}
+        if cursor:
+            options['ContinuationToken'] = cursor
+        response = self.client.list_objects_v2(**options)
+        files = [
+            {
+                'File': item['Key'],
+                'LastModified': item['LastModified'],
+                'Size': item['Size'],
+                'StorageClass': item.get('StorageClass'),
+            }
+            for item in response.get('Contents', [])
+        ]
+        return files, response.get('NextContinuationToken')
+
+    def iter_key_pages(self, bucket: str):
+        """
+        Yields the keys of the bucket, one list of up to 1000 keys per listing page.
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, PaginationConfig={'PageSize': S3_KEYS_PER_REQUEST}):
+            keys = [item['Key'] for item in page.get('Contents', [])]
+            if keys:
+                yield keys
+
+    def _delete_batch(self, bucket: str, keys: list) -> tuple:
+        response = self.client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': False}
+        )
+        deleted = [item['Key'] for item in response.get('Deleted', [])]
+        errors = [{'Key': item['Key'], 'Message': item.get('Message')} for item in response.get('Errors', [])]
+        return deleted, errors
+
+    async def delete_keys(self, bucket: str, key_batches) -> tuple:
+        """
+        Deletes keys in 1000-key DeleteObjects requests running concurrently on the file pool.
+
+        Args:
+            bucket (str): Bucket to delete from.
+            key_batches: Iterable of key lists, such as iter_key_pages; longer lists are split.
+
+        Returns:
+            tuple: (deleted keys, list of {'Key', 'Message'} for keys S3 could not delete).
+        """
+        loop = asyncio.get_running_loop()
+        requests = []
+        batches = iter(key_batches)
+        while True:
+            # The listing is paged with blocking calls, fetch each page off the event loop
+            keys = await loop.run_in_executor(self.file_pool, next, batches, None)
+            if keys is None:
+                break
+            for start in range(0, len(keys), S3_KEYS_PER_REQUEST):
+                requests.append(loop.run_in_executor(self.file_pool, self._delete_batch, bucket,
+                                                     keys[start:start + S3_KEYS_PER_REQUEST]))
+        deleted, errors = [], []
+        for batch_deleted, batch_errors in await asyncio.gather(*requests):
+            deleted.extend(batch_deleted)
+            errors.extend(batch_errors)
+        return deleted, errors
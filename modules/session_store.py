@@ -0,0 +1,282 @@
+# Per-session conversation state keyed by (user_id, chat_id)
+from collections import OrderedDict
+import threading
+import asyncio
+import json
+import time
+import os
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Session store settings from environment variables
+SESSION_MAX_SIZE = int(os.getenv('SESSION_MAX_SIZE', '1000'))
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', '1800'))
+SESSION_BACKEND_URL = os.getenv('SESSION_BACKEND_URL')
+
+
+class ChatSession:
+    """
+    Conversation state of a single chat.
+
+    Attributes:
+        user_id (int): ID of the user.
+        chat_id (str): ID of the chat.
+        chat_history (list): Alternating human and chatbot messages.
+        summary (str): Rolling summary of the turns that no longer fit in the prompt.
+        summarized_upto (int): Number of chat_history messages folded into the summary.
+        lock (asyncio.Lock): Serializes turns of the same chat, created on first use.
+        persist_task (asyncio.Task): Latest background save of the chat history, the next
+            save waits for it so an older snapshot never overwrites a newer one.
+    """
+
+    def __init__(self, user_id: int, chat_id: str, chat_history: list = None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.chat_history = chat_history if chat_history is not None else []
+        self.summary = ""
+        self.summarized_upto = 0
+        self._lock = None
+        self.persist_task = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """
+        Returns the turn lock, creating it inside the event loop on first use. Sessions are
+        built in worker threads, where Python 3.9 cannot create an asyncio.Lock (it binds to
+        the loop current at creation).
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def busy(self) -> bool:
+        """
+        Tells whether a turn holds or waits for the lock, without creating it (safe outside the
+        event loop). A released lock stays unlocked until its next waiter resumes, so waiters count.
+        """
+        return self._lock is not None and (self._lock.locked() or bool(getattr(self._lock, '_waiters', None)))
+
+    @property
+    def user_chat_details(self) -> dict:
+        """
+        Returns the ids in the dictionary format used by ChatDatabase.
+        """
+        return {'user_id': self.user_id, 'chat_id': self.chat_id}
+
+
+class LocalSharedStore:
+    """
+    In-process stand-in for a shared key-value store such as Redis, with the
+    same get/set/delete interface. Selected with SESSION_BACKEND_URL=local for
+    development and tests.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, None))
+            if value is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key: str, value: str, ex: int = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ex or float('inf')))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+def create_shared_store(url: str = SESSION_BACKEND_URL):
+    """
+    Creates the shared session backend from a URL.
+
+    Args:
+        url (str): 'redis://...' for Redis, 'local' for the in-process stand-in, None for no backend.
+
+    Returns:
+        The backend object, or None if sessions are only kept in this worker.
+    """
+    if not url:
+        return None
+    if url == 'local':
+        return LocalSharedStore()
+    if redis is None:
+        raise ImportError("The redis package is required for SESSION_BACKEND_URL=" + url)
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+class SessionStore:
+    """
+    In-memory LRU of chat sessions with TTL eviction and a size cap, optionally
+    backed by a shared store so several uvicorn workers see the same history.
+
+    Attributes:
+        max_size (int): Maximum number of sessions kept in memory.
+        ttl (int): Seconds a session stays cached after its last use.
+        backend: Optional shared store with get/set/delete methods.
+    """
+
+    def __init__(self, max_size: int = SESSION_MAX_SIZE, ttl: int = SESSION_TTL_SECONDS, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}  # (user_id, chat_id) -> lock held while the history of a missed session loads
+
+    @staticmethod
+    def _backend_key(user_id: int, chat_id: str) -> str:
+        return f"chat_session:{user_id}:{chat_id}"
+
+    def _evict(self, now: float):
+        """
+        Drops expired sessions and the least recently used ones above the size cap. Sessions
+        with a running turn are kept, the next request of the chat must get the same lock.
+        """
+        expired = [key for key, (session, last_used) in self._sessions.items()
+                   if now - last_used > self.ttl and not session.busy]
+        for key in expired:
+            del self._sessions[key]
+        excess = len(self._sessions) - self.max_size
+        if excess > 0:
+            idle = [key for key, (session, _) in self._sessions.items() if not session.busy]
+            for key in idle[:excess]:
+                del self._sessions[key]
+
+    def get(self, user_id: int, chat_id: str):
+        """
+        Returns the cached session, or None if it is not cached or has expired. With a backend,
+        the shared state is copied into the cached session object, so every request of this
+        worker holds the same session and its lock.
+        """
+        key = (user_id, chat_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry and (now - entry[1] <= self.ttl or entry[0].busy):
+                session = entry[0]
+                self._sessions[key] = (session, now)
+                self._sessions.move_to_end(key)
+            else:
+                session = None
+                self._sessions.pop(key, None)
+
+        if self.backend is not None:
+            # The shared store is the source of truth when several workers are running
+            value = self.backend.get(self._backend_key(user_id, chat_id))
+            if value is None:
+                return session
+            state = json.loads(value)
+            if isinstance(state, list):  # Written before summaries were shared
+                state = {'chat_history': state}
+            if session is None:
+                session = self._put_if_absent(ChatSession(user_id, chat_id))
+            if session.busy:
+                # A turn of this worker is running, its state is newer than the backend's
+                return session
+            session.chat_history = state['chat_history']
+            session.summary = state.get('summary', "")
+            session.summarized_upto = state.get('summarized_upto', 0)
+        return session
+
+    def _put_if_absent(self, session: ChatSession) -> ChatSession:
+        """
+        Caches the session unless another thread cached one for the chat first, and returns the cached one.
+        """
+        key = (session.user_id, session.chat_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry and (now - entry[1] <= self.ttl or entry[0].busy):
+                session = entry[0]
+            self._sessions[key] = (session, now)
+            self._sessions.move_to_end(key)
+            self._evict(now)
+        return session
+
+    def _put(self, session: ChatSession):
+        key = (session.user_id, session.chat_id)
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[key] = (session, now)
+            self._sessions.move_to_end(key)
+            self._evict(now)
+
+    def put(self, session: ChatSession):
+        """
+        Adds or refreshes a session in the cache and the shared store.
+        """
+        self._put(session)
+        if self.backend is not None:
+            self.backend.set(
+                self._backend_key(session.user_id, session.chat_id),
+                json.dumps({
+                    'chat_history': session.chat_history,
+                    'summary': session.summary,
+                    'summarized_upto': session.summarized_upto
+                }),
+                ex=self.ttl
+            )
+
+    async def aput(self, session: ChatSession):
+        """
+        put for the event loop: the blocking write to the shared store runs in a thread.
+        """
+        if self.backend is None:
+            self._put(session)
+        else:
+            await asyncio.to_thread(self.put, session)
+
+    def get_or_create(self, user_id: int, chat_id: str, chat_history: list) -> ChatSession:
+        """
+        Returns the session of the chat, creating it with chat_history if there is none. An
+        existing session is kept as it is: its history is at least as recent as the
+        database's, and a turn may be running on it.
+        """
+        session = self.get(user_id, chat_id)
+        if session is None:
+            session = self._put_if_absent(ChatSession(user_id, chat_id, chat_history))
+            if session.chat_history is chat_history:
+                self.put(session)
+        return session
+
+    def get_or_load(self, user_id: int, chat_id: str, loader) -> ChatSession:
+        """
+        Returns the session, loading its history with `loader(user_chat_ids)` on a miss.
+        Concurrent misses of the same chat load it once and share one session.
+        """
+        session = self.get(user_id, chat_id)
+        if session is not None:
+            return session
+        key = (user_id, chat_id)
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            session = self.get(user_id, chat_id)
+            if session is None:
+                session = self.get_or_create(user_id, chat_id, loader({'user_id': user_id, 'chat_id': chat_id}))
+        with self._lock:
+            self._loading.pop(key, None)
+        return session
+
+    def delete(self, user_id: int, chat_id: str):
+        """
+        Removes a session from the cache and the shared store.
+        """
+        with self._lock:
+            self._sessions.pop((user_id, chat_id), None)
+        if self.backend is not None:
+            self.backend.delete(self._backend_key(user_id, chat_id))
+
+    def __len__(self):
+        return len(self._sessions)
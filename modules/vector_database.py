@@ -1,13 +1,23 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 # from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores.faiss import FAISS
 from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader
-from langchain_community.document_loaders import WebBaseLoader
 # import google.generativeai as genai
 
-from langchain_pinecone import PineconeVectorStore
 from pinecone import Pinecone
+from modules.answer_cache import bump_knowledge_base_version
+from modules.embedding_cache import get_cached_embeddings
+from modules import faiss_backend
+from modules import web_crawler
+from modules.bm25_index import get_index
+from modules.chunking import LEGACY_SIGNATURE, get_chunker
+from modules.chunk_store import ChunkStore
+from modules.ingestion_manifest import IngestionManifest, content_hash, ingestion_lock, source_key
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import asyncio
+import queue
 import os
 from dotenv import load_dotenv
 
@@ -15,10 +25,67 @@ from dotenv import load_dotenv
 DATA_PATH = 'data/'
 
 # Path for vectorstore to store text embeddings made from the data
-DB_FAISS_PATH = 'vectorstore/db_faiss'
+DB_FAISS_PATH = faiss_backend.DB_FAISS_PATH
 
 # Load environment variables
 load_dotenv()
+
+# Vector store serving chatbot queries: 'pinecone' or 'faiss' (local index kept in sync on ingestion)
+RETRIEVER_BACKEND = os.getenv('RETRIEVER_BACKEND', 'pinecone')
+
+# University website pages (certificate is not verified for the main site)
+NED_WEBSITES = [
+    'https://www.neduet.edu.pk/faculties_and_departments',
+    'https://www.neduet.edu.pk/academic_programmes',
+    'https://www.neduet.edu.pk/asrb',
+    'https://www.neduet.edu.pk/teaching_system',
+    'https://www.neduet.edu.pk/students_affairs',
+    'https://www.neduet.edu.pk/students_chapter_of_professional_bodies',
+    'https://www.neduet.edu.pk/contact-us'
+]
+
+# Department website pages
+DEPARTMENT_WEBSITES = [
+    'https://ced.neduet.edu.pk/',
+    'https://cct.neduet.edu.pk/research',
+    'https://cct.neduet.edu.pk/contact-us',
+    'https://cct.neduet.edu.pk/aboutus',
+    'https://cct.neduet.edu.pk/achievements',
+    'https://cis.neduet.edu.pk/',
+    'https://cct.neduet.edu.pk/faculty',
+    'https://cct.neduet.edu.pk/faculty_achievements',
+    'https://cis.neduet.edu.pk/about_us',
+    'https://se.neduet.edu.pk/',
+    'https://eqd.neduet.edu.pk',
+    'https://end.neduet.edu.pk',
+    'https://ped.neduet.edu.pk',
+    'https://eed.neduet.edu.pk',
+    'https://eld.neduet.edu.pk/',
+    'https://tcd.neduet.edu.pk/',
+    'https://bmd.neduet.edu.pk/',
+    'https://med.neduet.edu.pk/',
+    'https://imd.neduet.edu.pk/',
+    'https://txd.neduet.edu.pk/',
+    'https://atd.neduet.edu.pk/',
+    'https://ard.neduet.edu.pk/',
+    'https://emd.neduet.edu.pk/',
+    'https://dph.neduet.edu.pk/aboutus',
+    'https://dcy.neduet.edu.pk/',
+    'https://dmt.neduet.edu.pk/',
+    'https://del.neduet.edu.pk/',
+    'https://des.neduet.edu.pk/'
+]
+
+# Maximum number of IDs per Pinecone delete request, and of file names per metadata filter delete
+PINECONE_DELETE_BATCH = 1000
+FILTER_DELETE_BATCH = 100
+
+# Ingestion pipeline settings: chunks per embedding request, embedding requests in flight,
+# upsert threads and embedded batches allowed to wait for upsert before embedding pauses
+INGEST_EMBED_BATCH_SIZE = int(os.getenv('INGEST_EMBED_BATCH_SIZE', '100'))
+INGEST_EMBED_PARALLELISM = int(os.getenv('INGEST_EMBED_PARALLELISM', '4'))
+INGEST_UPSERT_PARALLELISM = int(os.getenv('INGEST_UPSERT_PARALLELISM', '2'))
+INGEST_QUEUE_DEPTH = int(os.getenv('INGEST_QUEUE_DEPTH', '4'))
 # google_api_key = os.getenv("GOOGLE_API_KEY")
 pinecone_api_key = os.getenv("PINECONE_API_KEY")
 
@@ -37,128 +104,329 @@ def create_vector_db():
     Creates a vector database by loading data from websites and PDFs, 
     generating text embeddings, and saving them in a Pinecone vector store.
     """
-    # Load data from various websites
-    website_loader = WebBaseLoader([
-        'https://www.neduet.edu.pk/faculties_and_departments', 
-        'https://www.neduet.edu.pk/academic_programmes', 
-        'https://www.neduet.edu.pk/asrb', 
-        'https://www.neduet.edu.pk/teaching_system', 
-        'https://www.neduet.edu.pk/students_affairs', 
-        'https://www.neduet.edu.pk/students_chapter_of_professional_bodies', 
-        'https://www.neduet.edu.pk/contact-us'
-    ])
-    website_loader.requests_kwargs = {'verify': False}
-    
-    # Load data from specific department websites
-    civil_dept_web = WebBaseLoader(['https://ced.neduet.edu.pk/']).load()
-    csit_dept_web = WebBaseLoader([
-        'https://cct.neduet.edu.pk/research', 
-        'https://cct.neduet.edu.pk/contact-us', 
-        'https://cct.neduet.edu.pk/aboutus', 
-        'https://cct.neduet.edu.pk/achievements', 
-        'https://cis.neduet.edu.pk/' , 
-        'https://cct.neduet.edu.pk/faculty',
-        'https://cct.neduet.edu.pk/faculty_achievements',
-        'https://cis.neduet.edu.pk/about_us', 
-        'https://se.neduet.edu.pk/'
-    ]).load()
-    other_depts_web = WebBaseLoader([
-        'https://eqd.neduet.edu.pk', 
-        'https://end.neduet.edu.pk', 
-        'https://ped.neduet.edu.pk'
-    ]).load()
-    electrical_depts_web = WebBaseLoader([
-        'https://eed.neduet.edu.pk', 
-        'https://eld.neduet.edu.pk/', 
-        'https://tcd.neduet.edu.pk/', 
-        'https://bmd.neduet.edu.pk/'
-    ]).load()
-    mechanical_manf_depts_web = WebBaseLoader([
-        'https://med.neduet.edu.pk/', 
-        'https://imd.neduet.edu.pk/', 
-        'https://txd.neduet.edu.pk/', 
-        'https://atd.neduet.edu.pk/'
-    ]).load()
-    arch_sci_depts = WebBaseLoader([
-        'https://ard.neduet.edu.pk/', 
-        'https://emd.neduet.edu.pk/', 
-        'https://dph.neduet.edu.pk/aboutus', 
-        'https://dcy.neduet.edu.pk/', 
-        'https://dmt.neduet.edu.pk/', 
-        'https://del.neduet.edu.pk/', 
-        'https://des.neduet.edu.pk/'
-    ]).load()
-    
-    # Load main website data
-    web_doc = website_loader.load()
+    # Load data from the university and department websites concurrently
+    crawler = web_crawler.WebCrawler()
+    web_docs = asyncio.run(crawler.crawl(NED_WEBSITES + DEPARTMENT_WEBSITES, insecure_hosts={'www.neduet.edu.pk'}))
     
     # Load PDF documents
     loader = DirectoryLoader(DATA_PATH, glob='*.pdf', loader_cls=PyPDFLoader)
     documents = loader.load()
     
     # Combine all loaded documents
-    docs = documents + web_doc + civil_dept_web + csit_dept_web + other_depts_web + electrical_depts_web + mechanical_manf_depts_web + arch_sci_depts
+    docs = documents + web_docs
     print(len(docs))
     
-    # Split the text into chunks
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=100)
-    texts = text_splitter.split_documents(docs)
-
-    # Generate text embeddings using OpenAI Embeddings
-    embeddings = OpenAIEmbeddings(model='text-embedding-3-large')
-    
-    # Create a Pinecone vector store from the documents and embeddings
-    db = PineconeVectorStore.from_documents(texts, embeddings, index_name="langchain-ned-data")
-    
-    # Save the embeddings in the vector store
-    # db.save_local(DB_FAISS_PATH)
+    # Embed and upsert only the chunks that changed since the last run, and drop the corpus sources
+    # no longer listed. Pages that failed to load keep their vectors until the next successful crawl.
+    sync_documents(docs, remove_missing=True, origin='corpus', keep_sources=crawler.failed_urls)
     print("Successfully made and saved text embeddings!")
 
 def delete_all_embeddings():
     """
     Deletes all embeddings from the Pinecone index.
     """
-    status = index.delete(delete_all=True, namespace="")
+    with ingestion_lock():
+        status = index.delete(delete_all=True, namespace="")
+        manifest = IngestionManifest()
+        manifest.clear()
+        manifest.save()
+        ChunkStore().clear()
+        lexical_index = get_index()
+        lexical_index.clear()
+        lexical_index.save()
+        if RETRIEVER_BACKEND == 'faiss':
+            faiss_backend.delete_store()
+        bump_knowledge_base_version()  # Cached answers may come from the deleted embeddings
     
     if status is not None:
         print("Deleted!")
     
 def delete_file_embeddings(file_name: str):
     """
-    Deletes a file embeddings from the Pinecone index with meta-data filtering.
+    Deletes a file embeddings from the Pinecone index.
+    """
+    delete_files_embeddings([file_name])
+    print("Embeddings of file:" + file_name + " deleted successfully!")
+
+def delete_vector_ids(ids: list):
+    """
+    Deletes vectors by ID in PINECONE_DELETE_BATCH sized requests, several at once.
     """
-    status = index.delete(
-        filter={
-            "filename" : file_name
-        }
-    )
+    batches = [ids[start:start + PINECONE_DELETE_BATCH] for start in range(0, len(ids), PINECONE_DELETE_BATCH)]
+    if batches:
+        with ThreadPoolExecutor(max_workers=INGEST_UPSERT_PARALLELISM) as pool:
+            list(pool.map(lambda batch: index.delete(ids=batch), batches))
+
+def delete_files_embeddings(file_names: list) -> dict:
+    """
+    Deletes the embeddings of uploaded files. Vector IDs come from the ingestion manifest;
+    files ingested before the manifest existed are deleted with a filename metadata filter,
+    a batch of names per request. Serverless indexes reject filtered deletes, so a failed
+    batch is reported instead of raised.
     
-    if status == {}:
-        print("Embeddings of file:" + file_name + " deleted successfully!")
-    else:
-        print(file_name + ": File not found")
+    Args:
+        file_names (list): Names of the uploaded files (the 'filename' metadata of their chunks).
+    
+    Returns:
+        dict: Number of vectors deleted by ID and the files whose filter delete failed.
+    """
+    with ingestion_lock():
+        manifest = IngestionManifest()
+        ids, unknown_files = [], []
+        for file_name in file_names:
+            chunk_ids = manifest.remove_source(file_name)
+            if chunk_ids:
+                ids.extend(chunk_ids)
+            else:
+                unknown_files.append(file_name)
     
+        delete_vector_ids(ids)
+        failed_files = []
+        for start in range(0, len(unknown_files), FILTER_DELETE_BATCH):
+            batch = unknown_files[start:start + FILTER_DELETE_BATCH]
+            try:
+                index.delete(filter={"filename": {"$in": batch}})
+            except Exception as e:
+                print(f"Could not delete vectors of {len(batch)} files by metadata filter: {e}")
+                failed_files.extend(batch)
+        manifest.save()
+        ChunkStore().remove_sources(file_names)
+        lexical_index = get_index()
+        lexical_index.remove(ids)
+        lexical_index.remove_where('filename', unknown_files)
+        lexical_index.save()
+        if RETRIEVER_BACKEND == 'faiss':
+            faiss_backend.delete_file_documents(file_names, get_cached_embeddings('text-embedding-3-large'))
+        bump_knowledge_base_version()
+    print(f"Deleted {len(ids)} vectors of {len(file_names) - len(unknown_files)} files by ID, "
+          f"{len(unknown_files) - len(failed_files)} files by metadata filter")
+    return {"deleted_vectors": len(ids), "failed_files": failed_files}
 
-def add_docs(documents):
+def add_docs(documents, progress=None, origin: str = 'upload'):
     """
     Adds new documents to the Pinecone vector store.
-    """
-    # Split the text into chunks
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=100)
-    texts = text_splitter.split_documents(documents)
-    print(len(texts))
     
-    # Generate text embeddings using OpenAI Embeddings
-    embeddings = OpenAIEmbeddings(model='text-embedding-3-large')
+    Args:
+        documents (list): Loaded LangChain documents.
+        progress (callable): Optional callback receiving the pipeline progress dict.
+        origin (str): Flow adding the documents, 'upload' or 'site'.
     
-    # Initialize Pinecone vector store and add documents
-    vectorstore = PineconeVectorStore(embedding=embeddings, index_name="langchain-ned-data")
-    vectors = vectorstore.add_documents(texts)
+    Returns:
+        dict: Ingestion statistics from sync_documents.
+    """
+    stats = sync_documents(documents, progress=progress, origin=origin)
     
-    if vectors is not None:
+    if stats['chunks_added'] or stats['sources_skipped']:
         print('Vectors Embeddings created successfully!')
     else:
         print('Failed creating embeddings!')
+    return stats
+
+def embed_and_upsert(chunks: list, ids: list, embeddings, progress=None,
+                     batch_size: int = INGEST_EMBED_BATCH_SIZE, parallelism: int = INGEST_EMBED_PARALLELISM,
+                     upsert_parallelism: int = INGEST_UPSERT_PARALLELISM, queue_depth: int = INGEST_QUEUE_DEPTH):
+    """
+    Streams chunks through batch embedding and batch upsert. Up to parallelism embedding
+    requests run at once and embedded batches go through a bounded queue to the upsert
+    threads, so embedding pauses when Pinecone falls behind instead of holding every
+    vector in memory.
+    
+    Args:
+        chunks (list): Chunks to ingest.
+        ids (list): Vector ID of each chunk.
+        embeddings: Embeddings client.
+        progress (callable): Optional callback receiving {'stage', 'total', 'embedded', 'upserted'}.
+        batch_size (int): Chunks per embedding request and per upsert.
+        parallelism (int): Embedding requests in flight.
+        upsert_parallelism (int): Threads upserting embedded batches.
+        queue_depth (int): Embedded batches allowed to wait for upsert.
+    """
+    state = {'stage': 'embedding', 'total': len(chunks), 'embedded': 0, 'upserted': 0}
+    state_lock = threading.Lock()
+    upsert_queue = queue.Queue(maxsize=queue_depth)
+    errors = []
+    
+    def report(**counts):
+        with state_lock:
+            for key, value in counts.items():
+                state[key] += value
+            snapshot = dict(state)
+        if progress:
+            progress(snapshot)
+    
+    def embed_batch(start: int):
+        batch = chunks[start:start + batch_size]
+        return start, embeddings.embed_documents([chunk.page_content for chunk in batch])
+    
+    def upsert_worker():
+        while True:
+            item = upsert_queue.get()
+            if item is None:
+                return
+            start, vectors = item
+            if errors:
+                continue  # Drain the queue without upserting after a failure
+            try:
+                index.upsert(vectors=[
+                    {'id': ids[start + i], 'values': vector,
+                     'metadata': {**chunks[start + i].metadata, 'text': chunks[start + i].page_content}}
+                    for i, vector in enumerate(vectors)
+                ])
+                report(upserted=len(vectors))
+            except Exception as e:
+                errors.append(e)
+    
+    upserters = [threading.Thread(target=upsert_worker, daemon=True) for _ in range(upsert_parallelism)]
+    for thread in upserters:
+        thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=parallelism) as pool:
+            in_flight = deque()
+            for start in range(0, len(chunks), batch_size):
+                if errors:
+                    break
+                in_flight.append(pool.submit(embed_batch, start))
+                if len(in_flight) >= parallelism:
+                    batch_start, vectors = in_flight.popleft().result()
+                    report(embedded=len(vectors))
+                    upsert_queue.put((batch_start, vectors))  # Blocks while the upsert queue is full
+            while in_flight:
+                batch_start, vectors = in_flight.popleft().result()
+                report(embedded=len(vectors))
+                upsert_queue.put((batch_start, vectors))
+    finally:
+        for _ in upserters:
+            upsert_queue.put(None)
+        for thread in upserters:
+            thread.join()
+    if errors:
+        raise errors[0]
+    with state_lock:
+        state['stage'] = 'done'
+    if progress:
+        progress(dict(state))
+
+def delete_legacy_vectors(by_source: dict):
+    """
+    Deletes the vectors that sources got before the manifest existed. They have random IDs, so
+    they are deleted with a 'filename' (uploads) or 'source' (PDF path, URL) metadata filter.
+    Serverless indexes reject filtered deletes; the failure is reported and ingestion goes on.
+    """
+    fields = {}
+    for key, source_docs in by_source.items():
+        field = 'filename' if source_docs[0].metadata.get('filename') else 'source'
+        fields.setdefault(field, []).append(key)
+    for field, keys in fields.items():
+        for start in range(0, len(keys), FILTER_DELETE_BATCH):
+            try:
+                index.delete(filter={field: {"$in": keys[start:start + FILTER_DELETE_BATCH]}})
+            except Exception as e:
+                print(f"Could not delete vectors ingested before the manifest by {field}: {e}")
+                break
+    if RETRIEVER_BACKEND == 'faiss':
+        faiss_backend.delete_legacy_documents(list(by_source), get_cached_embeddings('text-embedding-3-large'))
+
+def sync_documents(documents, remove_missing: bool = False, progress=None, chunker=None,
+                   origin: str = 'upload', keep_sources=()) -> dict:
+    """
+    Incrementally ingests documents using the ingestion manifest: sources whose content
+    hash and chunker are unchanged are skipped, only new chunks are embedded and upserted,
+    and vectors of chunks that disappeared are deleted. The chunks of every changed source
+    are saved in the chunk store.
+    
+    Args:
+        documents (list): Loaded LangChain documents (one or more per source).
+        remove_missing (bool): Also delete the sources of the same origin that are not in documents (full refresh).
+        progress (callable): Optional callback receiving the embed/upsert progress dict.
+        chunker: Chunking strategy, CHUNKING_STRATEGY by default (see modules/chunking.py).
+        origin (str): Flow ingesting the documents, recorded in the manifest: 'corpus'
+            (create_vector_db), 'upload' or 'site'.
+        keep_sources (list): Sources missing from documents that remove_missing must keep,
+            such as pages that failed to load.
+    
+    Returns:
+        dict: Counts of skipped sources and added/deleted chunks.
+    """
+    # One ingestion or deletion at a time across threads and processes, the manifest is read-modify-write
+    with ingestion_lock():
+        manifest = IngestionManifest()
+        chunk_store = ChunkStore()
+        lexical_index = get_index()
+        # Chunks embedded before the BM25 index existed are indexed when their source is next seen
+        backfill = manifest.exists and len(lexical_index) == 0
+    
+        by_source = {}
+        for document in documents:
+            by_source.setdefault(source_key(document), []).append(document)
+        if not manifest.exists:
+            # Replace the vectors the sources being ingested got before the manifest, other sources keep theirs
+            delete_legacy_vectors(by_source)
+    
+        # Split the text into chunks
+        chunker = chunker or get_chunker()
+        signature = chunker.signature()
+        stats = {'sources_skipped': 0, 'chunks_added': 0, 'chunks_deleted': 0}
+        added_chunks, added_ids, removed_ids, backfill_chunks = [], [], [], []
+        # Chunk store writes, applied with the manifest once the vector store is updated
+        stored_sources, missing_sources = [], set()
+    
+        for key, source_docs in by_source.items():
+            source_hash = content_hash("\0".join(doc.page_content for doc in source_docs))
+            if manifest.source_hash(key) == source_hash and (manifest.chunker(key) or LEGACY_SIGNATURE) == signature:
+                stats['sources_skipped'] += 1
+                if manifest.origin(key) is None:
+                    manifest.set_origin(key, origin)
+                if backfill:
+                    chunks = chunk_store.source_chunks(key)
+                    if not chunks:
+                        chunks = chunker.split(source_docs)
+                        manifest.assign_chunk_ids(key, chunks)
+                        stored_sources.append((key, chunks))
+                    backfill_chunks.extend(chunks)
+                continue
+            chunks = chunker.split(source_docs)
+            chunk_ids = manifest.assign_chunk_ids(key, chunks)
+            stored_ids = set(manifest.chunk_ids(key))
+            for chunk, chunk_id in zip(chunks, chunk_ids):
+                if chunk_id not in stored_ids:
+                    added_chunks.append(chunk)
+                    added_ids.append(chunk_id)
+            removed_ids.extend(stored_ids - set(chunk_ids))
+            manifest.update(key, source_hash, list(dict.fromkeys(chunk_ids)), signature, origin)
+            stored_sources.append((key, chunks))
+    
+        if remove_missing:
+            # Only sources this flow added, uploads and extracted sites are never part of a refresh
+            missing_sources = set(manifest.sources_from(origin)) - set(by_source) - set(keep_sources)
+            for key in missing_sources:
+                removed_ids.extend(manifest.remove_source(key))
+    
+        # Generate text embeddings using OpenAI Embeddings, reusing cached embeddings of unchanged chunks
+        embeddings = get_cached_embeddings('text-embedding-3-large')
+    
+        if added_chunks:
+            embed_and_upsert(added_chunks, added_ids, embeddings, progress)
+        delete_vector_ids(removed_ids)
+    
+        if RETRIEVER_BACKEND == 'faiss' and (added_chunks or removed_ids):
+            faiss_backend.apply_changes(added_chunks, removed_ids, embeddings)
+        # Only now the vector store holds the new chunks, an earlier failure leaves the sources to re-ingest
+        for key, chunks in stored_sources:
+            chunk_store.replace_source(key, chunks, signature)
+        chunk_store.remove_sources(list(missing_sources))
+        manifest.save()
+        # Keep the local BM25 index of the hybrid retriever in step with the vector store
+        if added_chunks or removed_ids or backfill_chunks:
+            lexical_index.remove(removed_ids)
+            lexical_index.add(added_chunks + backfill_chunks)
+            lexical_index.save()
+    
+        stats['chunks_added'] = len(added_chunks)
+        stats['chunks_deleted'] = len(removed_ids)
+        if added_chunks or removed_ids:
+            bump_knowledge_base_version()  # New documents can change the answers of cached questions
+    print(f"Ingestion: {stats}")
+    return stats
     
     
 if __name__ == "__main__":
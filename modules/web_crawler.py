@@ -0,0 +1,189 @@
+# Concurrent web page loader for the knowledge base ingestion
+from langchain.docstore.document import Document
+from urllib.parse import urlparse
+from bs4 import BeautifulSoup
+import threading
+import asyncio
+import random
+import httpx
+import json
+import time
+import os
+
+# Crawler settings from environment variables
+CRAWL_CONCURRENCY = int(os.getenv('CRAWL_CONCURRENCY', '8'))
+CRAWL_PER_HOST_CONCURRENCY = int(os.getenv('CRAWL_PER_HOST_CONCURRENCY', '2'))
+CRAWL_HOST_DELAY_SECONDS = float(os.getenv('CRAWL_HOST_DELAY_SECONDS', '0.25'))
+CRAWL_RETRIES = int(os.getenv('CRAWL_RETRIES', '3'))
+CRAWL_TIMEOUT_SECONDS = float(os.getenv('CRAWL_TIMEOUT_SECONDS', '20'))
+
+# ETag / Last-Modified and page content of previous crawls, for conditional GETs
+CRAWL_CACHE_PATH = os.getenv('CRAWL_CACHE_PATH', 'vectorstore/crawl_cache.json')
+
+# Status codes worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HostLimiter:
+    """
+    Limits the number of concurrent requests to a host and spaces their start times.
+    """
+
+    def __init__(self, concurrency: int, delay: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.delay = delay
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        async with self.lock:
+            wait = self.next_start - time.monotonic()
+            self.next_start = max(self.next_start, time.monotonic()) + self.delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+class WebCrawler:
+    """
+    Fetches web pages with a bounded pool of concurrent requests, per-host rate limits,
+    retries with exponential backoff and conditional GETs, and returns them as LangChain
+    documents with the same metadata as WebBaseLoader.
+
+    Attributes:
+        concurrency (int): Maximum requests in flight overall.
+        per_host_concurrency (int): Maximum requests in flight per host.
+        host_delay (float): Minimum seconds between request starts to the same host.
+        retries (int): Retries after the first attempt.
+        cache_path (str): JSON file of validators and content of previous crawls, None to disable.
+        stats (dict): Fetched, not modified, failed and retried counters of the last crawl.
+        failed_urls (list): URLs of the last crawl that could not be loaded.
+    """
+
+    def __init__(self, concurrency: int = CRAWL_CONCURRENCY, per_host_concurrency: int = CRAWL_PER_HOST_CONCURRENCY,
+                 host_delay: float = CRAWL_HOST_DELAY_SECONDS, retries: int = CRAWL_RETRIES,
+                 timeout: float = CRAWL_TIMEOUT_SECONDS, cache_path: str = CRAWL_CACHE_PATH):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.host_delay = host_delay
+        self.retries = retries
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.stats = {}
+        self.failed_urls = []
+        self._cache = self._load_cache()
+        self._cache_lock = threading.Lock()
+
+    def _load_cache(self) -> dict:
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file)
+        return {}
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with self._cache_lock:
+            temp_path = self.cache_path + '.tmp'
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self._cache, cache_file)
+            os.replace(temp_path, self.cache_path)
+
+    @staticmethod
+    def parse_page(url: str, html: str) -> dict:
+        """
+        Extracts the text and metadata of a page like WebBaseLoader does.
+        """
+        soup = BeautifulSoup(html, 'html.parser')
+        metadata = {'source': url}
+        if soup.title:
+            metadata['title'] = soup.title.get_text()
+        description = soup.find('meta', attrs={'name': 'description'})
+        if description:
+            metadata['description'] = description.get('content', 'No description found.')
+        html_tag = soup.find('html')
+        if html_tag:
+            metadata['language'] = html_tag.get('lang', 'No language found.')
+        return {'text': soup.get_text(), 'metadata': metadata}
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str, limiter: HostLimiter, pool: asyncio.Semaphore):
+        """
+        Fetches one page, returning its Document or None if it could not be loaded.
+        """
+        cached = self._cache.get(url)
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with limiter, pool:
+                    response = await client.get(url, headers=headers)
+                if response.status_code == 304 and cached:
+                    self.stats['not_modified'] += 1
+                    return Document(page_content=cached['text'], metadata=cached['metadata'])
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    break
+            except httpx.HTTPStatusError as e:
+                print(f"Error fetching {url}: {e}")
+                self.stats['failed'] += 1
+                return None
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    print(f"Error fetching {url}: {e}")
+                    self.stats['failed'] += 1
+                    return None
+            if attempt == self.retries:
+                print(f"Error fetching {url}: status {response.status_code}")
+                self.stats['failed'] += 1
+                return None
+            self.stats['retried'] += 1
+            # Exponential backoff with jitter before the next attempt
+            await asyncio.sleep((2 ** attempt) * 0.5 + random.random() * 0.25)
+
+        page = await asyncio.to_thread(self.parse_page, url, response.text)
+        self.stats['fetched'] += 1
+        with self._cache_lock:
+            self._cache[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                **page
+            }
+        return Document(page_content=page['text'], metadata=page['metadata'])
+
+    async def crawl(self, urls: list, insecure_hosts: set = frozenset()) -> list:
+        """
+        Fetches all URLs concurrently.
+
+        Args:
+            urls (list): Pages to load.
+            insecure_hosts (set): Hosts whose TLS certificate is not verified.
+
+        Returns:
+            list: Documents of the pages that could be loaded, in the order of urls.
+        """
+        self.stats = {'fetched': 0, 'not_modified': 0, 'failed': 0, 'retried': 0}
+        pool = asyncio.Semaphore(self.concurrency)
+        limiters = {}
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits, follow_redirects=True) as client, \
+                httpx.AsyncClient(timeout=self.timeout, limits=limits, follow_redirects=True, verify=False) as insecure_client:
+            tasks = []
+            for url in urls:
+                host = urlparse(url).netloc
+                if host not in limiters:
+                    limiters[host] = HostLimiter(self.per_host_concurrency, self.host_delay)
+                selected_client = insecure_client if host in insecure_hosts else client
+                tasks.append(self._fetch(selected_client, url, limiters[host], pool))
+            documents = await asyncio.gather(*tasks)
+        self.failed_urls = [url for url, document in zip(urls, documents) if document is None]
+        self._save_cache()
+        print(f"Crawled {len(urls)} pages: {self.stats}")
+        return [document for document in documents if document is not None]
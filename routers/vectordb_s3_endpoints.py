@@ -1,19 +1,23 @@
 # Importing necessary modules and libraries
 from typing import Annotated
 
-from fastapi import APIRouter, File, UploadFile, HTTPException, Body
+from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, Body, status
 from fastapi.responses import HTMLResponse
 
-import fitz  # PyMuPDF for PDF handling
+import asyncio
+import shutil
+import uuid
 import os
 
-from langchain_community.document_loaders import WebBaseLoader
-from langchain.docstore.document import Document
-
 import boto3
 from botocore.exceptions import NoCredentialsError
 
 from modules import vector_database
+from modules import auth
+from modules import web_crawler
+from modules import ingestion_jobs
+from modules import pdf_extraction
+from modules import s3_transfer
 from modules import models
 
 # AWS Credentials
@@ -27,110 +31,171 @@ s3_client = boto3.client(
     's3',
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION
+    region_name=AWS_REGION,
+    config=s3_transfer.CLIENT_CONFIG
 )
 
+# Shared transfer service, uploads files and their parts concurrently over the client's connection pool
+transfer_service = s3_transfer.TransferService(s3_client)
+
 # Initialize Router
 router = APIRouter(
     prefix='/chatbot_data',
     tags=['Chatbot knowledge base endpoints']
 )
 
-@router.post("/uploadfiles")
+def extract_stage(payload: dict, progress) -> dict:
+    """
+    Job stage: extracts the text content of the spooled PDFs on the extraction process pool,
+    one Document per page.
+    """
+    docs = pdf_extraction.extract_files(payload['files'], progress)
+    return {**payload, 'documents': ingestion_jobs.documents_to_json(docs)}
+
+def crawl_stage(payload: dict, progress) -> dict:
+    """
+    Job stage: fetches the web pages concurrently with per-host rate limits and retries.
+    """
+    docs = asyncio.run(web_crawler.WebCrawler().crawl(payload['urls']))
+    return {**payload, 'documents': ingestion_jobs.documents_to_json(docs)}
+
+def embed_stage(payload: dict, progress) -> dict:
+    """
+    Job stage: embeds and upserts the extracted documents, then removes the spooled files.
+    """
+    stats = vector_database.add_docs(ingestion_jobs.documents_from_json(payload['documents']), progress=progress,
+                                     origin=payload.get('origin', 'upload'))
+    if payload.get('spool_dir'):
+        shutil.rmtree(payload['spool_dir'], ignore_errors=True)
+    # The documents are in the vector store now, keep only the statistics in the job record
+    result = {key: value for key, value in payload.items() if key != 'documents'}
+    result['stats'] = stats
+    return result
+
+ingestion_jobs.jobs.register('upload', [('extract', extract_stage), ('embed_upsert', embed_stage)])
+ingestion_jobs.jobs.register('sites', [('crawl', crawl_stage), ('embed_upsert', embed_stage)])
+
+@router.post("/uploadfiles", status_code=status.HTTP_202_ACCEPTED)
 async def upload_files(files: Annotated[list[UploadFile], File()]):
     """
-    Uploads multiple files to an S3 bucket and extracts text content from PDFs.
+    Uploads multiple files to an S3 bucket, then queues a job that extracts text content
+    from the PDFs and adds it to the vector database.
 
     Parameters:
     - files: List of files to be uploaded.
 
     Returns:
-    - dict: A dictionary containing URLs of the uploaded files and a success message.
+    - dict: A dictionary containing the job ID, the URLs and upload timings of the files and a message.
     """
-    file_urls = []
-    docs = []
-
-    for file in files:
-        # Read the file content
-        pdf_content = await file.read()
-        
-        try:
-            # Upload file to S3
-            file_path = file.filename
-            s3_client.upload_fileobj(file.file, BUCKET_NAME, file_path)
-            file_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{file_path}"
-            file_urls.append(file_url)
-        except NoCredentialsError:
-            return {"error": "AWS credentials not available"}
-        
-        # Extract text content from the PDF
-        pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
-        text = ""
-        for page in pdf_document:
-            text += page.get_text()
-        
-        # Create a Document object for LangChain
-        doc = Document(page_content=text, metadata={"filename": file.filename})
-        docs.append(doc)
-    
-    # Add documents to vector database
-    vector_database.add_docs(docs)
+    spool_dir = os.path.join(ingestion_jobs.INGEST_SPOOL_PATH, uuid.uuid4().hex)
+    os.makedirs(spool_dir, exist_ok=True)
+    try:
+        # Stream every file to S3 and to the spool directory concurrently. Spool names are
+        # prefixed with the file's position, a/FAQ.pdf and b/FAQ.pdf must not share one
+        uploads = await transfer_service.upload_many(BUCKET_NAME, [
+            (file.file, file.filename, os.path.join(spool_dir, f"{position}_{os.path.basename(file.filename)}"))
+            for position, file in enumerate(files)
+        ])
+    except NoCredentialsError:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        return {"error": "AWS credentials not available"}
+    for upload in uploads:
+        print(f"Uploaded {upload['key']}: {upload['size']} bytes in {upload['parts']} parts, {upload['seconds']}s")
+    spooled = [(upload['key'], upload['spool_path']) for upload in uploads]
+    try:
+        job_id = ingestion_jobs.jobs.submit('upload', f"upload {len(spooled)} files",
+                                            {'files': spooled, 'spool_dir': spool_dir, 'origin': 'upload'})
+    except ingestion_jobs.QueueFullError as e:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
     
-    return {"file_urls": file_urls, "message": "Files uploaded to S3 successfully"}
+    file_urls = [f"https://{BUCKET_NAME}.s3.amazonaws.com/{file_name}" for file_name, _ in spooled]
+    timings = [{'file': upload['key'], 'size': upload['size'], 'seconds': upload['seconds']} for upload in uploads]
+    return {"job_id": job_id, "file_urls": file_urls, "uploads": timings, "message": "Files uploaded to S3 successfully, embedding progress is available from /chatbot_data/ingestion-jobs/" + job_id}
 
-@router.post("/extract-and-store-sites")
+@router.post("/extract-and-store-sites", status_code=status.HTTP_202_ACCEPTED)
 async def extract_and_store_webpages(urls: models.webURLS):
     """
-    Extracts content from a list of URLs and stores them in the vector database.
+    Queues a job that extracts content from a list of URLs and stores it in the vector database.
 
     Parameters:
     - urls (list): List of URLs from which to extract content.
 
     Returns:
-    - dict: A dictionary containing a message indicating success.
+    - dict: A dictionary containing the job ID and a message.
     """
     urls = urls.urls
     print(urls)
     try:
-        docs = []
-        for url in urls:
-            # Use a web loader to fetch content from URL
-            web_loader = WebBaseLoader(url)
-            content = web_loader.load()
-            docs.extend(content)
-        
-        # Adding documents to Pinecone vector store
-        vector_database.add_docs(docs)
-        
-        return {"message": "Content extracted and stored successfully."}
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        job_id = ingestion_jobs.jobs.submit('sites', f"extract {len(urls)} sites", {'urls': urls, 'origin': 'site'})
+    except ingestion_jobs.QueueFullError as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    return {"job_id": job_id, "message": "Extraction queued, progress is available from /chatbot_data/ingestion-jobs/" + job_id}
+
+@router.get("/ingestion-jobs")
+async def list_ingestion_jobs(user: dict = Depends(auth.admin_user)):
+    """
+    Lists the queued, running and recently finished ingestion jobs.
+
+    Returns:
+    - dict: A dictionary containing the list of jobs.
+    """
+    return {"jobs": ingestion_jobs.jobs.list()}
+
+@router.get("/ingestion-jobs/{job_id}")
+async def get_ingestion_job(job_id: str, user: dict = Depends(auth.admin_user)):
+    """
+    Returns the state, progress and per-stage attempts and timings of an ingestion job.
+
+    Parameters:
+    - job_id (str): ID returned by /uploadfiles or /extract-and-store-sites.
+
+    Returns:
+    - dict: The job status.
+    """
+    job = ingestion_jobs.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.post("/ingestion-jobs/{job_id}/retry")
+async def retry_ingestion_job(job_id: str, user: dict = Depends(auth.admin_user)):
+    """
+    Re-queues a failed ingestion job, resuming at the stage that failed.
+
+    Parameters:
+    - job_id (str): ID of the failed job.
+
+    Returns:
+    - dict: A message indicating the job was queued again.
+    """
+    if not ingestion_jobs.jobs.retry(job_id):
+        raise HTTPException(status_code=404, detail="No failed job with this ID")
+    return {"job_id": job_id, "message": "Job queued again"}
 
 @router.get("/get-all-files")
-async def get_all_files_s3():
+async def get_all_files_s3(limit: int = 1000, cursor: str = None):
     """
-    Retrieves all files from the S3 bucket.
+    Retrieves one page of files from the S3 bucket.
+
+    Parameters:
+    - limit (int): Maximum number of files in the page, at most 1000.
+    - cursor (str): next_cursor of the previous page, omitted for the first page.
 
     Returns:
-    - dict: A dictionary containing the list of files and a success message.
+    - dict: A dictionary containing the file names, their metadata, the cursor of the next page and a success message.
     """
     try:
-        response = s3_client.list_objects_v2(Bucket=BUCKET_NAME)
-        if 'Contents' not in response:
+        files, next_cursor = await asyncio.to_thread(transfer_service.list_page, BUCKET_NAME, limit, cursor)
+        if not files and cursor is None:
             return {"message": "No files found in the bucket"}
-        
-        files = [
-            {
-                'File': item['Key'],
-                'LastModified': item['LastModified'],
-                'Size': item['Size'],
-                'StorageClass': item['StorageClass'],
-            }
-            for item in response['Contents']
-        ]
-
-        return {"files": [item['Key'] for item in response['Contents']], "message": "Files fetched successfully"}
+
+        return {
+            "files": [item['File'] for item in files],
+            "details": files,
+            "next_cursor": next_cursor,
+            "message": "Files fetched successfully"
+        }
     except NoCredentialsError:
         return {"error": "AWS credentials not available"}
     except Exception as e:
@@ -142,28 +207,29 @@ async def delete_all_files():
     Deletes all files from the S3 bucket and their embeddings from the vector database.
 
     Returns:
-    - dict: A dictionary containing the list of deleted files and a success message.
+    - dict: A dictionary containing the list of deleted files, the files that could not be deleted and a success message.
     """
     try:
-        # List all files in the S3 bucket
-        response = s3_client.list_objects_v2(Bucket=BUCKET_NAME)
-        if 'Contents' not in response:
-            return {"message": "No files found in the bucket"}
-
-        files_to_delete = [{'Key': item['Key']} for item in response['Contents']]
-
-        # Batch delete operation
-        delete_response = s3_client.delete_objects(
-            Bucket=BUCKET_NAME,
-            Delete={'Objects': files_to_delete}
+        # Page through the bucket listing
+        keys = await asyncio.to_thread(
+            lambda: [key for page in transfer_service.iter_key_pages(BUCKET_NAME) for key in page]
         )
-
-        deleted_files = [item['Key'] for item in delete_response.get('Deleted', [])]
+        if not keys:
+            return {"message": "No files found in the bucket"}
         
-        # Delete all embeddings from the vector database
-        vector_database.delete_all_embeddings()
+        # Delete the embeddings first, web page embeddings are kept; a file whose embeddings
+        # could not be deleted stays in the bucket
+        result = await asyncio.to_thread(vector_database.delete_files_embeddings, keys)
+        failed_files = set(result["failed_files"])
         
-        return {"deleted_files": deleted_files, "message": "Files deleted successfully"}
+        # Delete the files in concurrent 1000-key batches
+        deleted_files, errors = await transfer_service.delete_keys(
+            BUCKET_NAME, [[key for key in keys if key not in failed_files]]
+        )
+        errors.extend({"Key": key, "Message": "Embeddings could not be deleted, file kept"}
+                      for key in result["failed_files"])
+        
+        return {"deleted_files": deleted_files, "errors": errors, "message": "Files deleted successfully"}
     except NoCredentialsError:
         return {"error": "AWS credentials not available"}
     except Exception as e:
@@ -181,13 +247,17 @@ async def delete_file(file: models.FileName):
     - dict: A message indicating the status of the deletion operation.
     """
     try:
-        # Delete the file from the S3 bucket
-        s3_client.delete_object(Bucket=BUCKET_NAME, Key=file.file_name)
+        # Delete vector embeddings of the file first, so a failure leaves the file in place
+        result = await asyncio.to_thread(vector_database.delete_files_embeddings, [file.file_name])
         
-        # Delete vector embeddings with meta_data filtering
-        # vector_database.delete_file_embeddings(file.file_name)
+        # Delete the file from the S3 bucket
+        await asyncio.to_thread(s3_client.delete_object, Bucket=BUCKET_NAME, Key=file.file_name)
         
-        return {"message": f"File '{file.file_name}' deleted successfully from S3."}
+        response = {"message": f"File '{file.file_name}' deleted successfully from S3."}
+        if result["failed_files"]:
+            response["embedding_errors"] = {"files": result["failed_files"],
+                                            "message": "Embeddings of this file could not be deleted"}
+        return response
     except NoCredentialsError:
         return {"error": "AWS credentials not available"}
     except Exception as e: